@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the cdist resource layer and of the plugin startup.
+
+Every benchmark reports operations per second and p50/p99 latencies, so the
+results can be saved as JSON and compared with a baseline:
+
+    python benchmarks/bench.py --output baseline.json
+    python benchmarks/bench.py --baseline baseline.json
+
+When hostname is not given, benchmarks are executed against a local stand-in
+of the Redis server, which requires ``fakeredis[lua]``. Numbers obtained on
+the stand-in are only meaningful when compared with each other.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import textwrap
+import threading
+import subprocess
+import click
+from cdist import __version__
+from cdist.redis import RedisResource
+
+
+def percentile(values, percent):
+    """
+    Return the percentile of a list of values, using the nearest rank.
+    """
+    values = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def statistics(latencies, elapsed):
+    """
+    Return the statistics of a benchmark from the latencies of its operations
+    and from its total duration, in seconds.
+    """
+    return dict(
+        ops=len(latencies),
+        ops_per_sec=len(latencies) / elapsed if elapsed else 0,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+    )
+
+
+def measure(operation, count):
+    """
+    Execute an operation ``count`` times and return its statistics.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for index in range(count):
+        begin = time.perf_counter()
+        operation(index)
+        latencies.append(time.perf_counter() - begin)
+
+    return statistics(latencies, time.perf_counter() - start)
+
+
+def bench_push(resource, count):
+    """
+    Push configurations with a few options.
+    """
+    config = dict(("option%d" % i, "value%d" % i) for i in range(10))
+    return measure(lambda i: resource.push("push-%d" % i, config), count)
+
+
+def bench_pull(resource, count):
+    """
+    Pull the same configuration many times.
+    """
+    resource.push("pull", dict(("option%d" % i, "value") for i in range(10)))
+    return measure(lambda i: resource.pull("pull"), count)
+
+
+def bench_pull_large(resource, count):
+    """
+    Pull the same large configuration many times, with long options and
+    many testpaths.
+    """
+    config = dict(("option%d" % i, "value%d " % i * 50) for i in range(200))
+    config["testpaths"] = " ".join("tests/path%d" % i for i in range(1000))
+    resource.push("pull-large", config)
+    return measure(lambda i: resource.pull("pull-large"), count)
+
+
+def bench_lock_contention(factory, clients, count):
+    """
+    Many clients are competing for the same configuration. Every client
+    waits for the lock, then it unlocks it immediately.
+    """
+    resources = [factory(owner="client%d" % i) for i in range(clients)]
+    resources[0].push("contention", dict(option="value"))
+
+    latencies = []
+    errors = []
+    mutex = threading.Lock()
+
+    def _client(resource):
+        for _ in range(count):
+            begin = time.perf_counter()
+            try:
+                resource.lock("contention", timeout=60, blocking=True)
+                resource.unlock("contention")
+            except Exception as err:  # pylint: disable=broad-except
+                errors.append(err)
+                return
+
+            with mutex:
+                latencies.append(time.perf_counter() - begin)
+
+    threads = [threading.Thread(target=_client, args=(resource,))
+               for resource in resources]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    for resource in resources:
+        resource.close()
+
+    if errors:
+        raise click.ClickException("lock contention failed: %s" % errors[0])
+
+    result = statistics(latencies, elapsed)
+    result["clients"] = clients
+    return result
+
+
+def bench_keys(factory, size, repeat):
+    """
+    List all the configurations of a namespace with ``size`` entries.
+    Configurations are created with raw pipelines, to speed up the setup.
+    """
+    resource = factory(namespace="bench-keys-%d" % size)
+    client = resource._connect()
+
+    pipe = client.pipeline(transaction=False)
+    for index in range(size):
+        pipe.hset(resource._config_name("config%d" % index), "option", "1")
+        if index % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+
+    def _keys(_):
+        if len(resource.keys()) != size:
+            raise click.ClickException("wrong number of keys")
+
+    result = measure(_keys, repeat)
+    result["keys"] = size
+
+    for batch in resource._batches(resource.iter_keys()):
+        client.delete(*[resource._config_name(key) for key in batch])
+
+    resource.close()
+    return result
+
+
+def bench_plugin(address, repeat):
+    """
+    Measure the wall clock time of ``pytest --collect-only`` with and without
+    the cdist plugin. The difference is the overhead of the plugin.
+    """
+    resource = RedisResource(hostname=address[0], port=address[1])
+    resource.push("plugin", dict(option="value"))
+    resource.close()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "pytest.ini"), "w") as ini:
+            ini.write(textwrap.dedent("""
+                [pytest]
+                cdist_hostname = %s
+                cdist_port = %s
+                cdist_cache = False
+            """ % address))
+
+        with open(os.path.join(tmpdir, "test_bench.py"), "w") as test:
+            for index in range(100):
+                test.write("def test_%d():\n    pass\n\n" % index)
+
+        def _run(args):
+            def _pytest(_):
+                subprocess.run(
+                    [sys.executable, "-m", "pytest", "--collect-only", "-q",
+                     "-p", "no:cacheprovider"] + args,
+                    cwd=tmpdir,
+                    stdout=subprocess.DEVNULL,
+                    check=True)
+
+            return measure(_pytest, repeat)
+
+        without = _run(["-p", "no:cdist"])
+        with_plugin = _run(["--cdist-config=plugin"])
+
+    result = with_plugin
+    result["overhead_ms"] = with_plugin["p50_ms"] - without["p50_ms"]
+    result["baseline_p50_ms"] = without["p50_ms"]
+    return result
+
+
+def bench_import(repeat):
+    """
+    Measure the import time of the plugin entry point with ``-X importtime``,
+    which is paid by every pytest session, even when cdist is not used.
+    """
+    latencies = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import cdist.plugin"],
+            stderr=subprocess.PIPE,
+            check=True).stderr.decode()
+
+        for line in output.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "cdist.plugin":
+                # cumulative time is reported in microseconds
+                latencies.append(int(fields[1]) / 1e6)
+
+    return statistics(latencies, sum(latencies))
+
+
+def start_server():
+    """
+    Start the local stand-in of the Redis server and return its address.
+    """
+    try:
+        import fakeredis
+    except ImportError:
+        raise click.ClickException(
+            "fakeredis[lua] is required when hostname is not given")
+
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server.server_address
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline. Return the list of regressions, which
+    are benchmarks with less operations per second, or with a higher p99
+    latency, over the threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name, None)
+        if not base:
+            continue
+
+        if base["ops_per_sec"] and \
+                result["ops_per_sec"] < base["ops_per_sec"] * (1 - threshold):
+            regressions.append("%s: %.1f ops/sec (baseline %.1f)" % (
+                name, result["ops_per_sec"], base["ops_per_sec"]))
+
+        if base["p99_ms"] and \
+                result["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            regressions.append("%s: p99 %.3f ms (baseline %.3f ms)" % (
+                name, result["p99_ms"], base["p99_ms"]))
+
+    return regressions
+
+
+@click.command()
+@click.option("--hostname", "-h", default=None,
+              help="Redis server hostname (default: local stand-in)")
+@click.option("--port", "-p", default=6379, type=int,
+              help="Redis server port")
+@click.option("--count", "-c", default=1000, type=int,
+              help="operations executed by push/pull benchmarks")
+@click.option("--clients", default=16, type=int,
+              help="clients competing for the same lock")
+@click.option("--keys", "keys_sizes", default="10000,100000",
+              help="comma separated number of configurations to list")
+@click.option("--repeat", "-r", default=5, type=int,
+              help="repetitions of the keys and plugin benchmarks")
+@click.option("--output", "-o", default=None, type=click.Path(),
+              help="JSON file where results are saved")
+@click.option("--baseline", "-b", default=None, type=click.Path(exists=True),
+              help="JSON file with the results to compare with")
+@click.option("--threshold", "-t", default=0.2, type=float,
+              help="tolerated slowdown over the baseline (default: 0.2)")
+def bench(hostname, port, count, clients, keys_sizes, repeat, output,
+          baseline, threshold):
+    """
+    Run cdist benchmarks.
+    """
+    address = (hostname, port)
+    if not hostname:
+        address = start_server()
+
+    def _factory(**kwargs):
+        return RedisResource(
+            hostname=address[0],
+            port=address[1],
+            namespace=kwargs.pop("namespace", "bench"),
+            **kwargs)
+
+    benchmarks = [
+        ("push", lambda: bench_push(_factory(), count)),
+        ("pull", lambda: bench_pull(_factory(), count)),
+        ("pull_large", lambda: bench_pull_large(_factory(), count)),
+        ("pull_large_blob", lambda: bench_pull_large(
+            _factory(namespace="bench-blob", blob_threshold=0), count)),
+        ("lock_contention", lambda: bench_lock_contention(
+            _factory, clients, max(1, count // clients))),
+    ]
+    for size in keys_sizes.split(","):
+        size = int(size)
+        benchmarks.append(("keys_%d" % size, lambda size=size: bench_keys(
+            _factory, size, repeat)))
+    benchmarks.append(("plugin_collect", lambda: bench_plugin(
+        address, repeat)))
+    benchmarks.append(("plugin_import", lambda: bench_import(
+        max(repeat, 20))))
+
+    results = dict()
+    for name, benchmark in benchmarks:
+        results[name] = benchmark()
+        click.echo("%-20s %10.1f ops/sec  p50 %8.3f ms  p99 %8.3f ms" % (
+            name,
+            results[name]["ops_per_sec"],
+            results[name]["p50_ms"],
+            results[name]["p99_ms"]))
+
+    click.echo("plugin overhead: %.3f ms" %
+               results["plugin_collect"]["overhead_ms"])
+
+    if output:
+        with open(output, "w") as fdata:
+            json.dump(dict(
+                version=__version__,
+                python=platform.python_version(),
+                server="%s:%s" % address if hostname else "stand-in",
+                results=results,
+            ), fdata, indent=4)
+
+    if baseline:
+        with open(baseline, "r") as fdata:
+            regressions = compare(
+                results,
+                json.load(fdata)["results"],
+                threshold)
+
+        for regression in regressions:
+            click.secho("regression -- %s" % regression, fg="red")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench()
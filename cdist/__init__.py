@@ -1,29 +1,40 @@
 """
-cdist library.
+cdist library. The public API is imported on first access, so loading the
+pytest plugin doesn't import it when cdist is not used.
 
 Author:
     Andrea Cervesato <andrea.cervesato@mailbox.org>
 """
-from cdist.resource import Resource
-from cdist.resource import ResourceError
-from cdist.resource import ResourceConnectionError
-from cdist.resource import ResourcePushError
-from cdist.resource import ResourcePullError
-from cdist.resource import ResourceLockError
-from cdist.resource import ResourceUnlockError
-from cdist.resource import ResourceNotExistError
-from cdist.resource import ResourceDeleteError
 
 __version__ = "0.1"
 
 __all__ = [
     "Resource",
+    "AsyncResource",
+    "ConfigStatus",
+    "LockInfo",
+    "LockStats",
+    "Event",
     "ResourceError",
     "ResourceConnectionError",
     "ResourcePushError",
     "ResourcePullError",
     "ResourceLockError",
     "ResourceUnlockError",
+    "ResourceInheritanceError",
     "ResourceNotExistError",
     "ResourceDeleteError",
 ]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(
+            "module '%s' has no attribute '%s'" % (__name__, name))
+
+    from cdist import resource
+    return getattr(resource, name)
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
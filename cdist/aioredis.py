@@ -0,0 +1,592 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous Redis resource implementation, based on ``redis.asyncio``.
+
+Keys layout and server side scripts are the same of the ``cdist.redis``
+module, so asynchronous and synchronous clients can share the same server and
+the same locks. Waiting for a lock suspends the coroutine until the lock
+changes: all the waiters of a resource share a single subscription to the
+events channel, which is read by a dedicated connection, so waiters don't
+hold any connection of the pool and many concurrent lock attempts need
+neither threads nor connections. A waiter polls the lock periodically as
+well, so it doesn't miss any lock which expired without being released.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+from __future__ import absolute_import
+import time
+import asyncio
+from redis import RedisError
+from redis.asyncio import Redis
+from redis.asyncio import Connection
+from redis.asyncio import BlockingConnectionPool
+from cdist import instrument
+from cdist.redis import SCRIPTS
+from cdist.redis import WAIT_POLL_INTERVAL
+from cdist.redis import RedisNamespace
+from cdist.resource import AsyncResource
+from cdist.resource import ResourceError
+from cdist.resource import ResourceConnectionError
+from cdist.resource import ResourcePushError
+from cdist.resource import ResourcePullError
+from cdist.resource import ResourceLockError
+from cdist.resource import ResourceUnlockError
+from cdist.resource import ResourceNotExistError
+from cdist.resource import ResourceDeleteError
+
+
+async def register_scripts(connection):
+    """
+    Connection callback which registers the cdist scripts as soon as a new
+    connection is opened, so they can always be executed by SHA in a single
+    round trip.
+    """
+    await connection.on_connect()
+
+    # all the scripts are loaded with a single round trip
+    await connection.send_packed_command(
+        connection.pack_commands(
+            [("SCRIPT", "LOAD", src) for src in SCRIPTS.values()]))
+
+    for _ in SCRIPTS:
+        await connection.read_response()
+
+
+async def _aclose(closable):
+    """
+    Close a client or a subscription. ``aclose`` was introduced in
+    redis 5.0.1, older versions only provide ``close``.
+    """
+    close = getattr(closable, "aclose", None) or closable.close
+    await close()
+
+
+class AsyncRedisConnection(Connection):
+    """
+    Redis connection reporting round trips and sent bytes to the
+    instrumented operations. Received bytes are not measured.
+    """
+
+    async def send_packed_command(self, command, check_health=True):
+        instrument.count_roundtrip()
+        if isinstance(command, (bytes, str)):
+            command = [command]
+
+        if instrument.current() is not None:
+            instrument.count_sent(sum(len(item) for item in command))
+
+        await super().send_packed_command(command, check_health=check_health)
+
+
+class AsyncRedisResource(RedisNamespace, AsyncResource):
+    """
+    Asynchronous Redis resource implementation. All the coroutines share a
+    single bounded connection pool, so the instance must be used by one event
+    loop only.
+    """
+
+    def __init__(self, **kwargs: dict):
+        """
+        Args:
+            kwargs: ``RedisNamespace`` arguments. ``idle_timeout`` is not
+                used, since idle connections are checked with
+                ``health_check_interval``.
+        """
+        super().__init__(**kwargs)
+        self._pool = None
+        self._client = None
+        self._scripts = dict()
+        self._waiters = dict()
+        self._listener = None
+        self._listening = None
+
+    def _connect(self):
+        """
+        Return the Redis client bound to the shared connection pool. The
+        client is created once and sockets are opened on demand.
+        """
+        if self._client is not None:
+            return self._client
+
+        try:
+            self._pool = BlockingConnectionPool(
+                host=self._hostname,
+                port=self._port,
+                db=self._db,
+                username=self._username,
+                password=self._password,
+                decode_responses=True,
+                redis_connect_func=register_scripts,
+                connection_class=AsyncRedisConnection,
+                max_connections=self._max_connections,
+                timeout=self._pool_timeout,
+                health_check_interval=self._health_check_interval,
+            )
+
+            self._client = Redis(connection_pool=self._pool)
+
+            # scripts are executed by SHA and loaded by register_scripts
+            for name, src in SCRIPTS.items():
+                self._scripts[name] = self._client.register_script(src)
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+        return self._client
+
+    async def close(self):
+        """
+        Close all the connections inside the pool and the events
+        subscription of the waiters.
+        """
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+
+            self._listener = None
+
+        if self._pool is not None:
+            await self._pool.disconnect()
+
+    def _wake(self, name=None):
+        """
+        Wake up the waiters of a configuration, or all of them if name is
+        None.
+        """
+        for key, waiters in self._waiters.items():
+            if name is None or key == name:
+                for waiter in waiters:
+                    waiter.set()
+
+    async def _listen(self):
+        """
+        Wake up the waiters of a configuration every time its lock changes.
+        Events are read with a dedicated connection, which doesn't belong to
+        the pool.
+        """
+        client = Redis(
+            host=self._hostname,
+            port=self._port,
+            db=self._db,
+            username=self._username,
+            password=self._password,
+            decode_responses=True,
+            health_check_interval=self._health_check_interval)
+
+        try:
+            while True:
+                pubsub = client.pubsub()
+                try:
+                    await pubsub.subscribe(self._events_name())
+                    async for message in pubsub.listen():
+                        if message["type"] == "subscribe":
+                            self._listening.set()
+
+                            # changes published before subscribing are lost
+                            self._wake()
+                        elif message["type"] == "message":
+                            event, name, _ = self._event(message["data"])
+
+                            # renewals don't release the lock
+                            if event != "renew":
+                                self._wake(name)
+                except RedisError:
+                    # waiters poll the locks until subscription is restored
+                    self._listening.clear()
+                    await asyncio.sleep(WAIT_POLL_INTERVAL)
+                finally:
+                    await _aclose(pubsub)
+        finally:
+            await _aclose(client)
+
+    async def _subscribe_waiters(self):
+        """
+        Start reading the events of the waiters, once. If subscription is
+        not confirmed in time, waiters poll the locks until it is.
+        """
+        if self._listener is None:
+            self._listening = asyncio.Event()
+            self._listener = asyncio.ensure_future(self._listen())
+
+        if not self._listening.is_set():
+            try:
+                await asyncio.wait_for(
+                    self._listening.wait(),
+                    self._pool_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def push(self, key: str, config: dict) -> bool:
+        self._check_push_args(key, config)
+
+        if not config:
+            raise ResourcePushError("'%s' config is empty" % key)
+
+        client = self._connect()
+        try:
+            keys, args = self._push_script_args(key, config)
+            ret = await self._scripts["push"](
+                keys=keys,
+                args=args,
+                client=client)
+        except RedisError as err:
+            raise ResourcePushError(err)
+
+        return bool(ret)
+
+    async def pull(self, key: str, resolve: bool = True) -> dict:
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        config = None
+        try:
+            # blobs are binary, so replies are decoded by _decode_config
+            if resolve:
+                config = self._resolve(key, await client.execute_command(
+                    "EVALSHA",
+                    self._scripts["resolve"].sha,
+                    0,
+                    *self._resolve_script_args(key, "config"),
+                    NEVER_DECODE=True))
+            else:
+                config = self._decode_config(await client.execute_command(
+                    "HGETALL", self._config_name(key), NEVER_DECODE=True))
+        except RedisError as err:
+            raise ResourcePullError(err)
+
+        # an empty hash can't exist inside Redis
+        if not config:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        if resolve:
+            return config[1]
+
+        return config
+
+    async def version(self, key: str) -> str:
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        try:
+            resolved = self._resolve(key, await client.execute_command(
+                "EVALSHA",
+                self._scripts["resolve"].sha,
+                0,
+                *self._resolve_script_args(key, "version"),
+                NEVER_DECODE=True))
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+        if not resolved:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        # configurations pushed by older clients don't have any version
+        return resolved[0]
+
+    async def _acquire(self, client, key, blocking):
+        """
+        Try to acquire a lock, eventually queueing the owner as a waiter.
+        """
+        keys, args = self._lock_script_args(key, blocking)
+        return await self._scripts["lock"](
+            keys=keys,
+            args=args,
+            client=client)
+
+    async def _cancel(self, client, key):
+        """
+        Stop waiting for a lock. Return True if lock has been acquired.
+        """
+        keys, args = self._cancel_script_args(key)
+        return await self._scripts["cancel"](
+            keys=keys,
+            args=args,
+            client=client)
+
+    async def lock(
+            self,
+            key: str,
+            timeout: float = None,
+            blocking: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        # waiter is registered before the first attempt, so the lock changes
+        # published in the meantime are not lost
+        wake = asyncio.Event()
+        waiters = self._waiters.setdefault(key, set())
+        waiters.add(wake)
+
+        try:
+            if blocking:
+                await self._subscribe_waiters()
+
+            ret = await self._acquire(client, key, blocking)
+
+            while ret == 0 and blocking:
+                wait = WAIT_POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+
+                if wait <= 0:
+                    ret = await self._cancel(client, key)
+                    break
+
+                # unlock() hands the lock over to the first waiter and
+                # publishes it, so waiters don't hold any connection while
+                # they wait
+                started = time.monotonic()
+                try:
+                    await asyncio.wait_for(wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                instrument.count_wait(time.monotonic() - started)
+                wake.clear()
+
+                # handover is confirmed by the lock script, which keeps the
+                # waiter alive as well. Lock could have expired without being
+                # released
+                ret = await self._acquire(client, key, blocking)
+        except RedisError as err:
+            raise ResourceLockError(err)
+        finally:
+            waiters.discard(wake)
+            if not waiters and self._waiters.get(key, None) is waiters:
+                del self._waiters[key]
+
+        if ret < 0:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        if not ret:
+            raise ResourceLockError("'%s' config is already locked" % key)
+
+    async def _lock_group(self, client, pattern, tags):
+        """
+        Scan the configurations of a group and lock the first free one.
+        Return the reply of the lock_any script.
+        """
+        prefix = self._config_name("")
+        names = set()
+        async for item in client.scan_iter(
+                match=self._group_match(pattern),
+                count=self._scan_count):
+            names.add(item[len(prefix):])
+
+        matched = False
+        for batch in self._batches(sorted(names)):
+            keys, args = self._lock_any_script_args(batch, tags)
+            ret = await self._scripts["lock_any"](
+                keys=keys,
+                args=args,
+                client=client)
+
+            if ret[0] > 0:
+                return ret
+
+            matched = matched or ret[0] == 0
+
+        return [0] if matched else [-1]
+
+    async def lock_any(
+            self,
+            pattern: str = "*",
+            tags: list = None,
+            timeout: float = None,
+            blocking: bool = False) -> str:
+        if not pattern:
+            raise ValueError("pattern is empty")
+
+        client = self._connect()
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        try:
+            while True:
+                ret = await self._lock_group(client, pattern, tags)
+                if ret[0] != 0 or not blocking:
+                    break
+
+                # group members can be released by many owners, so waiters
+                # try again periodically
+                wait = WAIT_POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+
+                if wait <= 0:
+                    break
+
+                await asyncio.sleep(wait)
+                instrument.count_wait(wait)
+        except RedisError as err:
+            raise ResourceLockError(err)
+
+        if ret[0] < 0:
+            raise ResourceNotExistError(
+                "no configurations are matching '%s'" % pattern)
+
+        if not ret[0]:
+            raise ResourceLockError(
+                "all configurations matching '%s' are locked" % pattern)
+
+        return ret[1]
+
+    async def unlock(self, key: str, force: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        try:
+            keys, args = self._unlock_script_args(key, force)
+            ret = await self._scripts["unlock"](
+                keys=keys,
+                args=args,
+                client=client)
+        except RedisError as err:
+            raise ResourceUnlockError(err)
+
+        if ret < 0:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        if not ret:
+            raise ResourceUnlockError(
+                "'%s' config is locked by another owner" % key)
+
+    async def renew(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        try:
+            keys, args = self._renew_script_args(key)
+            ret = await self._scripts["renew"](
+                keys=keys, args=args, client=client)
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+        if not ret:
+            raise ResourceLockError("'%s' config lock has been lost" % key)
+
+    async def is_locked(self, key: str) -> bool:
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.exists(self._config_name(key))
+            pipe.hmget(self._lock_name(key), "owner", "expires")
+            pipe.time()
+            exists, record, now = await pipe.execute()
+        except RedisError as err:
+            raise ResourceError(err)
+
+        if not exists:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        return self._record_owner(record, self._time_ms(now)) is not None
+
+    async def status_many(self, keys) -> dict:
+        client = self._connect()
+        statuses = dict()
+
+        for batch in self._batches(keys):
+            if not all(batch):
+                raise ValueError("key is empty")
+
+            try:
+                pipe = client.pipeline(transaction=False)
+                for key in batch:
+                    pipe.exists(self._config_name(key))
+                for key in batch:
+                    pipe.hmget(self._lock_name(key), "owner", "expires")
+                pipe.time()
+                replies = await pipe.execute()
+            except RedisError as err:
+                raise ResourceConnectionError(err)
+
+            statuses.update(self._statuses(batch, replies))
+
+        return statuses
+
+    async def locks(self) -> dict:
+        client = self._connect()
+        try:
+            reply = await self._scripts["locks"](
+                keys=[self._held_name()],
+                args=[self._lock_name("")],
+                client=client)
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+        return self._locks(reply)
+
+    async def break_stale(self) -> list:
+        stale = [name for name, info in (await self.locks()).items()
+                 if info.stale]
+        if not stale:
+            return []
+
+        client = self._connect()
+        sha = self._scripts["unlock"].sha
+        try:
+            # locks are released only if they are still stale
+            pipe = client.pipeline(transaction=False)
+            for name in stale:
+                keys, args = self._unlock_script_args(name, True, stale=True)
+                pipe.evalsha(sha, len(keys), *(keys + args))
+            replies = await pipe.execute()
+        except RedisError as err:
+            raise ResourceUnlockError(err)
+
+        return [name for name, ret in zip(stale, replies) if ret == 1]
+
+    async def lock_stats(self) -> dict:
+        client = self._connect()
+        try:
+            reply = await client.hgetall(self._stats_name())
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+        return self._lock_stats(reply)
+
+    async def iter_keys(self, count: int = None):
+        client = self._connect()
+        prefix = self._config_name("")
+        match = self._escape_glob(prefix) + "*"
+
+        try:
+            async for item in client.scan_iter(
+                    match=match,
+                    count=count or self._scan_count):
+                yield item[len(prefix):]
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+    async def delete(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        try:
+            # always delete the locking variable
+            keys, args = self._delete_script_args(key)
+            deleted = await self._scripts["delete"](
+                keys=keys,
+                args=args,
+                client=client)
+        except RedisError as err:
+            raise ResourceDeleteError(err)
+
+        if not deleted:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Compact serialization of pytest configurations. A configuration is stored as
+a single blob, instead of one value for each option, so large configurations
+are transferred and decoded at once. Blobs are optionally compressed when
+they are bigger than a threshold.
+
+A blob starts with a 4 bytes header: the "cd" magic, the format version and
+the compression codec. The body is the configuration encoded as a compact
+JSON object, which is decoded by the C accelerated ``json`` module:
+
+    b"cd" | version (1 byte) | codec (1 byte) | body
+
+Supported codecs are "none", "zlib" and "zstd". zstd requires Python 3.14 or
+the ``zstandard`` package.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import zlib
+import json
+
+# first bytes of every blob
+MAGIC = b"cd"
+
+# version of the blob format
+FORMAT_VERSION = 1
+
+# codecs by name, and their identifier inside the header
+CODECS = dict(
+    none=0,
+    zlib=1,
+    zstd=2,
+)
+
+
+def _zstd():
+    """
+    Return the zstd module, or raise ValueError if it's not available.
+    """
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ValueError("zstd compression requires 'zstandard' package")
+
+
+def check_codec(codec: str):
+    """
+    Raise ValueError if a compression codec is not supported.
+
+    Args:
+        codec (str): name of the codec.
+    """
+    if codec not in CODECS:
+        raise ValueError("'%s' compression is not supported" % codec)
+
+    if codec == "zstd":
+        _zstd()
+
+
+def encode_config(
+        config: dict,
+        codec: str = "zlib",
+        threshold: int = 1024) -> bytes:
+    """
+    Serialize a configuration as a blob.
+
+    Args:
+        config (dict): configuration options and values.
+        codec (str): compression codec.
+        threshold (int): size in bytes after which the body is compressed.
+
+    Returns:
+        bytes: the blob.
+
+    Raises:
+        ValueError: if codec is not supported.
+    """
+    body = json.dumps(
+        config,
+        ensure_ascii=False,
+        separators=(",", ":")).encode("utf-8")
+
+    if len(body) < threshold:
+        codec = "none"
+
+    check_codec(codec)
+
+    if codec == "zlib":
+        body = zlib.compress(body)
+    elif codec == "zstd":
+        body = _zstd().compress(body)
+
+    return MAGIC + bytes([FORMAT_VERSION, CODECS[codec]]) + body
+
+
+def decode_config(blob: bytes) -> dict:
+    """
+    Deserialize a configuration blob.
+
+    Args:
+        blob (bytes): the blob.
+
+    Returns:
+        dict: configuration options and values.
+
+    Raises:
+        ValueError: if blob is not valid, or if its format is not supported.
+    """
+    blob = bytes(blob)
+    if len(blob) < 4 or blob[:2] != MAGIC:
+        raise ValueError("not a configuration blob")
+
+    if blob[2] != FORMAT_VERSION:
+        raise ValueError(
+            "configuration blob version %d is not supported" % blob[2])
+
+    body = blob[4:]
+    codec = blob[3]
+
+    errors = (zlib.error, UnicodeDecodeError, json.JSONDecodeError)
+    if codec == CODECS["zstd"]:
+        errors += (_zstd().ZstdError,)
+
+    try:
+        if codec == CODECS["zlib"]:
+            body = zlib.decompress(body)
+        elif codec == CODECS["zstd"]:
+            body = _zstd().decompress(body)
+        elif codec != CODECS["none"]:
+            raise ValueError("configuration blob codec %d is unknown" % codec)
+
+        config = json.loads(body.decode("utf-8"))
+    except errors as err:
+        raise ValueError("corrupted configuration blob: %s" % err)
+
+    if not isinstance(config, dict):
+        raise ValueError("corrupted configuration blob")
+
+    return config
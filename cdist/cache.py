@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of pytest configurations. Cached configurations are stored with
+the version they had when they have been pulled, so they can be validated by
+checking the configuration version only, instead of pulling it again. Within
+a maximum age, cached configurations are used without asking the resource.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import time
+import hashlib
+from cdist.resource import ResourceError
+from cdist.resource import ResourceNotExistError
+from cdist.resource import ResourceInheritanceError
+
+
+class ConfigCache:
+    """
+    Cache of pytest configurations pulled from a resource. Entries are stored
+    inside a storage exposing ``get(key, default)`` and ``set(key, value)``
+    methods, such as the pytest ``config.cache`` object.
+    """
+
+    def __init__(self, storage, prefix: str, max_age: float = 0):
+        """
+        Args:
+            storage (object): storage of the cached entries.
+            prefix (str): identifier of the resource, such as its address and
+                namespace. Configurations of different resources are cached
+                separately.
+            max_age (float): seconds during which a cached configuration is
+                used without validating its version. 0 to always validate.
+        """
+        self._storage = storage
+        self._prefix = prefix
+        self._max_age = max_age
+        self.warning = None
+
+    def _entry_name(self, key):
+        """
+        Return the name of the entry storing a cached configuration.
+        """
+        digest = hashlib.sha1(
+            ("%s/%s" % (self._prefix, key)).encode()).hexdigest()
+        return "cdist/%s" % digest
+
+    def _store(self, key, config, version, fetched):
+        """
+        Store a configuration inside the cache.
+        """
+        self._storage.set(self._entry_name(key), dict(
+            name=key,
+            config=config,
+            version=version,
+            fetched=fetched))
+
+    def get(self, resource, key: str) -> dict:
+        """
+        Return a pytest configuration, pulling it from the resource only if
+        cached configuration is missing or outdated. If the resource is not
+        reachable, a cached configuration is returned even if it can't be
+        validated and ``warning`` is set.
+
+        Args:
+            resource (Resource): resource storing configurations.
+            key (str): tag associated to a pytest configuration.
+
+        Returns:
+            dict: dictionary representing a pytest configuration.
+
+        Raises:
+            ValueError: if one of the parameters is None or empty.
+            ResourceError: if configuration can't be fetched.
+            ResourceNotExistError: if configuration doesn't exist.
+            ResourceInheritanceError: if an inherited configuration can't
+                be resolved. Cached configuration is never returned in this
+                case, since inheritance is broken and not unreachable.
+        """
+        if not key:
+            raise ValueError("key is empty")
+
+        self.warning = None
+
+        entry = self._storage.get(self._entry_name(key), None)
+        if entry and entry.get("name") != key:
+            entry = None
+
+        now = time.time()
+        if entry and self._max_age > 0 and \
+                0 <= now - entry["fetched"] < self._max_age:
+            return entry["config"]
+
+        try:
+            version = resource.version(key)
+            if entry and version and entry["version"] == version:
+                self._store(key, entry["config"], version, now)
+                return entry["config"]
+
+            config = resource.pull(key)
+        except (ResourceNotExistError, ResourceInheritanceError):
+            raise
+        except ResourceError as err:
+            if not entry:
+                raise
+
+            self.warning = "using cached '%s' config: %s" % (key, err)
+            return entry["config"]
+
+        self._store(key, config, version, now)
+
+        return config
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Client side cache of a resource. ``CachedResource`` wraps any resource and
+keeps the configurations, their versions and their lock status inside an LRU
+cache, limited in size and in age, so repeated reads don't hit the network.
+
+Cached entries are invalidated as soon as they change, by subscribing to the
+events of the wrapped resource, which are published by the resource itself
+when a configuration is pushed, locked, released or deleted. A lock can also
+expire without being released: lock events carry the lease expiration, so
+the status of a lock is never cached after its lease expired. The status of
+a lock acquired before the subscription, whose lease is not known, is never
+cached until the lock is renewed.
+
+Events are published for the changed configuration only, so pushing or
+deleting a configuration invalidates all the cached configurations which
+inherit from other ones, together with all the cached versions.
+
+If the wrapped resource doesn't publish its changes, lock status is never
+cached and configurations are cached for ``ttl`` seconds only.
+
+    resource = CachedResource(resource=RedisResource(), max_size=256)
+    resource.pull("myconfig")
+    resource.pull("myconfig")
+    print(resource.hits, resource.misses)
+
+Lease expirations are compared with the local clock, so clients must keep
+their clock synchronized with the server one.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import time
+import threading
+from collections import OrderedDict
+from cdist.resource import Resource
+from cdist.resource import ConfigStatus
+from cdist.resource import config_parents
+from cdist.resource import ResourceNotExistError
+
+# marker of a value which is not cached
+_MISSING = object()
+
+# cached entries invalidated by each event
+_INVALIDATED = dict(
+    push=("config", "version", "status"),
+    lock=("status",),
+    renew=("status",),
+    unlock=("status",),
+    delete=("config", "version", "status"),
+)
+
+
+class CachedResource(Resource):
+    """
+    Resource wrapper caching the reads of another resource. The same instance
+    can be used by multiple threads.
+    """
+
+    def __init__(self, **kwargs: dict):
+        """
+        Args:
+            resource (Resource): cached resource.
+            max_size (int): maximum number of cached entries (default: 1024).
+            ttl (float): seconds after which a cached entry expires. None or
+                0 for entries which expire only when they change
+                (default: 60).
+        """
+        self._resource = kwargs.get("resource", None)
+        if self._resource is None:
+            raise ValueError("resource is None")
+
+        self._max_size = int(kwargs.get("max_size", 1024))
+        if self._max_size <= 0:
+            raise ValueError("max_size must be positive")
+
+        self._ttl = float(kwargs.get("ttl", 60) or 0)
+        self._entries = OrderedDict()
+        self._leases = dict()
+        self._generation = 0
+        self._mutex = threading.Lock()
+        self._subscribe_mutex = threading.Lock()
+        self._subscription = None
+        self._subscribed = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def resource(self) -> Resource:
+        """
+        The cached resource.
+        """
+        return self._resource
+
+    @property
+    def process_locks(self) -> bool:
+        """
+        True if locks of the cached resource are released when the process
+        which acquired them exits.
+        """
+        return self._resource.process_locks
+
+    @property
+    def size(self) -> int:
+        """
+        Number of cached entries.
+        """
+        with self._mutex:
+            return len(self._entries)
+
+    def _subscribe(self):
+        """
+        Subscribe to the events of the cached resource, once. Return True if
+        resource publishes its changes.
+        """
+        with self._subscribe_mutex:
+            if not self._subscribed:
+                try:
+                    self._subscription = self._resource.subscribe(
+                        self._on_event)
+                except NotImplementedError:
+                    self._subscription = None
+
+                self._subscribed = True
+
+            return self._subscription is not None
+
+    def close(self):
+        """
+        Cancel the subscription to the cached resource events and clear the
+        cache. The cached resource is not closed.
+        """
+        with self._subscribe_mutex:
+            if self._subscription is not None:
+                self._subscription.close()
+
+            self._subscription = None
+            self._subscribed = False
+
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all the cached entries.
+        """
+        with self._mutex:
+            self._generation += 1
+            self._entries.clear()
+
+    def _on_event(self, event, name, expires):
+        """
+        Invalidate the entries changed by an event of the cached resource.
+        """
+        with self._mutex:
+            self._generation += 1
+
+            if event == "reset":
+                self._entries.clear()
+                self._leases.clear()
+                return
+
+            for kind in _INVALIDATED.get(event, ()):
+                self._entries.pop((kind, name), None)
+
+            if event in ("push", "delete"):
+                self._invalidate_inherited()
+
+            if event in ("lock", "renew"):
+                self._leases[name] = expires
+            elif event in ("unlock", "delete"):
+                self._leases.pop(name, None)
+
+    def _invalidate(self, key, event):
+        """
+        Invalidate the entries changed by an operation of this instance,
+        before its event is received.
+        """
+        with self._mutex:
+            self._generation += 1
+            for kind in _INVALIDATED[event]:
+                self._entries.pop((kind, key), None)
+
+            if event in ("push", "delete"):
+                self._invalidate_inherited()
+
+    def _invalidate_inherited(self):
+        """
+        Invalidate the entries which can depend on other configurations:
+        configurations with parents and versions. Mutex must be held.
+        """
+        for entry, (value, _) in list(self._entries.items()):
+            if entry[0] == "version" or \
+                    (entry[0] == "config" and config_parents(value)):
+                del self._entries[entry]
+
+    def _lookup(self, entry):
+        """
+        Return a cached value, or _MISSING if it's not cached. Hits and
+        misses are counted.
+        """
+        with self._mutex:
+            item = self._entries.get(entry, None)
+            if item is not None:
+                value, deadline = item
+                if deadline is None or time.time() < deadline:
+                    self._entries.move_to_end(entry)
+                    self.hits += 1
+                    return value
+
+                del self._entries[entry]
+
+            self.misses += 1
+            return _MISSING
+
+    def _store(self, entry, value, generation):
+        """
+        Cache a value fetched from the resource when the generation was
+        ``generation``. Value is dropped if something changed while it was
+        fetched, or if it can't be cached.
+        """
+        deadline = None
+        if self._ttl > 0:
+            deadline = time.time() + self._ttl
+
+        with self._mutex:
+            if generation != self._generation:
+                return
+
+            if entry[0] == "status":
+                if self._subscription is None:
+                    return
+
+                # a lock can expire without any event
+                if value.locked:
+                    if entry[1] not in self._leases:
+                        return
+
+                    expires = self._leases[entry[1]]
+                    if expires is not None:
+                        deadline = expires if deadline is None \
+                            else min(deadline, expires)
+
+            self._entries[entry] = (value, deadline)
+            self._entries.move_to_end(entry)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def _generation_now(self):
+        """
+        Return the current generation of the cached entries.
+        """
+        with self._mutex:
+            return self._generation
+
+    def push(self, key: str, config: dict) -> bool:
+        try:
+            return self._resource.push(key, config)
+        finally:
+            if key:
+                self._invalidate(key, "push")
+
+    def pull(self, key: str, resolve: bool = True) -> dict:
+        if not key:
+            raise ValueError("key is empty")
+
+        # only merged configurations are cached
+        if not resolve:
+            return self._resource.pull(key, resolve=False)
+
+        self._subscribe()
+
+        config = self._lookup(("config", key))
+        if config is not _MISSING:
+            return dict(config)
+
+        generation = self._generation_now()
+        config = self._resource.pull(key)
+        self._store(("config", key), dict(config), generation)
+
+        return config
+
+    def push_many(self, items) -> dict:
+        items = list(items)
+        try:
+            return self._resource.push_many(items)
+        finally:
+            for key, _ in items:
+                if key:
+                    self._invalidate(key, "push")
+
+    def pull_many(
+            self,
+            keys,
+            resolve: bool = True,
+            errors: dict = None) -> dict:
+        if not resolve:
+            return self._resource.pull_many(
+                keys, resolve=False, errors=errors)
+
+        self._subscribe()
+
+        configs = dict()
+        missing = list()
+        for key in keys:
+            if not key:
+                raise ValueError("key is empty")
+
+            config = self._lookup(("config", key))
+            if config is _MISSING:
+                missing.append(key)
+            else:
+                configs[key] = dict(config)
+
+        if missing:
+            generation = self._generation_now()
+            pulled = self._resource.pull_many(missing, errors=errors)
+            for key, config in pulled.items():
+                configs[key] = config
+                if config is not None:
+                    self._store(("config", key), dict(config), generation)
+
+        return configs
+
+    def version(self, key: str) -> str:
+        if not key:
+            raise ValueError("key is empty")
+
+        self._subscribe()
+
+        version = self._lookup(("version", key))
+        if version is not _MISSING:
+            return version
+
+        generation = self._generation_now()
+        version = self._resource.version(key)
+        self._store(("version", key), version, generation)
+
+        return version
+
+    def lock(self, key: str, timeout: float = None, blocking: bool = False):
+        try:
+            self._resource.lock(key, timeout=timeout, blocking=blocking)
+        finally:
+            if key:
+                self._invalidate(key, "lock")
+
+    def lock_any(
+            self,
+            pattern: str = "*",
+            tags: list = None,
+            timeout: float = None,
+            blocking: bool = False) -> str:
+        key = self._resource.lock_any(
+            pattern=pattern,
+            tags=tags,
+            timeout=timeout,
+            blocking=blocking)
+        self._invalidate(key, "lock")
+
+        return key
+
+    def unlock(self, key: str, force: bool = False):
+        try:
+            self._resource.unlock(key, force=force)
+        finally:
+            if key:
+                self._invalidate(key, "unlock")
+
+    def renew(self, key: str):
+        self._resource.renew(key)
+
+    def is_locked(self, key: str) -> bool:
+        if not key:
+            raise ValueError("key is empty")
+
+        status = self.status_many([key])[key]
+        if not status.exists:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        return status.locked
+
+    def status_many(self, keys) -> dict:
+        self._subscribe()
+
+        statuses = dict()
+        missing = list()
+        for key in keys:
+            if not key:
+                raise ValueError("key is empty")
+
+            status = self._lookup(("status", key))
+            if status is _MISSING:
+                missing.append(key)
+            else:
+                statuses[key] = status
+
+        if missing:
+            generation = self._generation_now()
+            for key, status in self._resource.status_many(missing).items():
+                statuses[key] = ConfigStatus(*status)
+                self._store(("status", key), statuses[key], generation)
+
+        return statuses
+
+    def locks(self) -> dict:
+        return self._resource.locks()
+
+    def break_stale(self) -> list:
+        broken = self._resource.break_stale()
+        for key in broken:
+            self._invalidate(key, "unlock")
+
+        return broken
+
+    def lock_stats(self) -> dict:
+        return self._resource.lock_stats()
+
+    def subscribe(self, callback):
+        return self._resource.subscribe(callback)
+
+    def iter_keys(self, count: int = None):
+        return self._resource.iter_keys(count=count)
+
+    def delete(self, key: str):
+        try:
+            self._resource.delete(key)
+        finally:
+            if key:
+                self._invalidate(key, "delete")
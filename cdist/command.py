@@ -5,10 +5,19 @@ cdist-cli command implementation.
 Author:
     Andrea Cervesato <andrea.cervesato@mailbox.org>
 """
+import os
 import sys
+import json
+import time
+import socket
+import getpass
+import zipfile
+import tarfile
+import itertools
 import configparser
 import click
-from cdist.redis import RedisResource
+from cdist.metrics import MetricsServer
+from cdist.registry import from_url
 from cdist.resource import ResourceError
 
 
@@ -26,6 +35,19 @@ class Arguments:
 pass_arguments = click.make_pass_decorator(Arguments, ensure=True)
 
 
+def _default_owner():
+    """
+    Return the lock owner token of the current user on this host, so locks
+    of different users are never mistaken for each other.
+    """
+    try:
+        user = getpass.getuser()
+    except (KeyError, OSError):
+        user = str(os.getuid())
+
+    return "%s@%s" % (user, socket.gethostname())
+
+
 class CatchAllExceptions(click.Group):
     """
     Class created to catch all exceptions coming from the application.
@@ -50,16 +72,134 @@ class CatchAllExceptions(click.Group):
     default="61324",
     type=click.INT,
     help="port of the resource server (default: 6379)")
+@click.option(
+    '--url',
+    '-u',
+    default=None,
+    help="resource URL, i.e. redis://localhost:6379/0. It overrides "
+         "hostname and port")
+@click.option(
+    '--namespace',
+    '-n',
+    default="cdist",
+    help="namespace of the stored configurations (default: cdist)")
+@click.option(
+    '--owner',
+    '-o',
+    default=_default_owner,
+    show_default="<user>@<hostname>",
+    help="owner token used by lock and unlock")
+@click.option(
+    '--blob-threshold',
+    default=None,
+    type=click.INT,
+    help="size in bytes of the configurations which are pushed as a "
+         "single compact blob, if supported by the resource "
+         "(default: never)")
 @pass_arguments
-def cli(args, hostname, port):
+def cli(args, hostname, port, url, namespace, owner, blob_threshold):
     """
     cdist client for pytest distributed configuration.
     """
+    if not url:
+        url = "redis://%s:%s" % (hostname, port)
+
     kwargs = dict(
-        hostname=hostname,
-        port=port
+        namespace=namespace,
+        owner=owner
     )
-    args.resource = RedisResource(**kwargs)
+    if blob_threshold is not None:
+        kwargs["blob_threshold"] = blob_threshold
+
+    args.resource = from_url(url, **kwargs)
+
+
+def _pytest_dict(config):
+    """
+    Return the pytest section of a parsed ini file as a dictionary.
+    """
+    if 'pytest' not in config.sections():
+        raise ResourceError("not a pytest configuration.")
+
+    pytest_dict = dict()
+    for option in config.options('pytest'):
+        pytest_dict[option] = config.get('pytest', option)
+
+    return pytest_dict
+
+
+def _iter_files(source):
+    """
+    Iterate over the ini files of a directory or of a tar/zip archive,
+    returning their name without extension and their content.
+    """
+    if os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            path = os.path.join(source, filename)
+            if filename.endswith(".ini") and os.path.isfile(path):
+                with open(path, "r") as data:
+                    yield filename[:-4], data.read()
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source, "r:*") as archive:
+            for member in archive:
+                filename = os.path.basename(member.name)
+                if member.isfile() and filename.endswith(".ini"):
+                    data = archive.extractfile(member).read()
+                    yield filename[:-4], data.decode()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source, "r") as archive:
+            for member in archive.infolist():
+                filename = os.path.basename(member.filename)
+                if not member.is_dir() and filename.endswith(".ini"):
+                    data = archive.read(member)
+                    yield filename[:-4], data.decode()
+    else:
+        raise ResourceError(
+            "'%s' is not a directory or an archive." % source)
+
+
+def _check_persistent_locks(resource):
+    """
+    Raise a ResourceError if locks of a resource are released as soon as
+    the command exits.
+    """
+    if resource.process_locks:
+        raise ResourceError(
+            "resource locks are released when the process holding them "
+            "exits, so they can't be held by cdist-cli.")
+
+
+def _echo_result(config_name, message, color):
+    """
+    Print the result of an operation on a configuration.
+    """
+    click.echo("- %s: " % config_name, nl=False)
+    click.secho(message, fg=color)
+
+
+def _echo_diff(config_name, stored, config):
+    """
+    Print the differences between a stored configuration and a new one.
+    """
+    if stored is None:
+        _echo_result(config_name, "new", "green")
+        return
+
+    if stored == config:
+        _echo_result(config_name, "unchanged", None)
+        return
+
+    _echo_result(config_name, "changed", "yellow")
+    for option in sorted(set(stored) | set(config)):
+        if option not in stored:
+            click.secho("    + %s = %s" % (option, config[option]),
+                        fg="green")
+        elif option not in config:
+            click.secho("    - %s = %s" % (option, stored[option]),
+                        fg="red")
+        elif stored[option] != config[option]:
+            click.secho("    ~ %s = %s -> %s" % (
+                option, stored[option], config[option]), fg="yellow")
 
 
 @cli.command()
@@ -73,30 +213,32 @@ def push(args, config_name, config_file):
     config = configparser.ConfigParser()
     config.read(config_file)
 
-    if 'pytest' not in config.sections():
-        raise ResourceError("not a pytest configuration.")
+    # pytest section to dict
+    pytest_dict = _pytest_dict(config)
 
     click.echo("pushing '%s': " % config_name, nl=False)
 
-    # pytest section to dict
-    pytest_dict = dict()
-    for option in config.options('pytest'):
-        pytest_dict[option] = config.get('pytest', option)
-
     # push pytest configuration
-    args.resource.push(config_name, pytest_dict)
-
-    click.secho("done", fg="green")
+    if args.resource.push(config_name, pytest_dict):
+        click.secho("done", fg="green")
+    else:
+        click.secho("unchanged", fg="green")
 
 
 @cli.command()
 @click.argument("config_name")
+@click.option(
+    '--raw',
+    '-r',
+    is_flag=True,
+    help="show configuration as it has been pushed, without inherited "
+         "options")
 @pass_arguments
-def show(args, config_name):
+def show(args, config_name, raw):
     """
     show a configuration.
     """
-    config = args.resource.pull(config_name)
+    config = args.resource.pull(config_name, resolve=not raw)
 
     click.echo("\n[pytest]")
     for key, value in config.items():
@@ -105,44 +247,361 @@ def show(args, config_name):
 
 @cli.command()
 @click.argument("config_name")
+@click.option(
+    '--timeout',
+    '-t',
+    default=None,
+    type=click.FLOAT,
+    help="seconds to wait if configuration is locked (default: no wait)")
 @pass_arguments
-def lock(args, config_name):
+def lock(args, config_name, timeout):
     """
     lock a configuration.
     """
-    args.resource.lock(config_name)
+    _check_persistent_locks(args.resource)
+
+    if timeout is None:
+        args.resource.lock(config_name)
+    else:
+        args.resource.lock(config_name, timeout=timeout, blocking=True)
 
 
 @cli.command()
 @click.argument("config_name")
+@click.option(
+    '--force',
+    '-f',
+    is_flag=True,
+    help="unlock configuration even if it's locked by another owner")
 @pass_arguments
-def unlock(args, config_name):
+def unlock(args, config_name, force):
     """
     unlock a configuration.
     """
-    args.resource.unlock(config_name)
+    if force:
+        args.resource.unlock(config_name, force=True)
+    else:
+        # locks of other processes can only be broken
+        _check_persistent_locks(args.resource)
+        args.resource.unlock(config_name)
 
 
 @cli.command(name="list")
+@click.option(
+    '--json',
+    'as_json',
+    is_flag=True,
+    help="print configurations as a JSON list")
+@click.option(
+    '--batch-size',
+    '-b',
+    default=500,
+    type=click.INT,
+    help="configurations status fetched at once (default: 500)")
 @pass_arguments
-def _list(args):
+def _list(args, as_json, batch_size):
     """
     list all saved configurations.
     """
-    keys = args.resource.keys()
-
-    click.echo("Available configurations:")
-    if not keys:
+    if not as_json:
+        click.echo("Available configurations:")
+
+    # keys are shown as soon as their status is received
+    keys = iter(args.resource.iter_keys())
+    count = 0
+
+    while True:
+        batch = list(itertools.islice(keys, batch_size))
+        if not batch:
+            break
+
+        statuses = args.resource.status_many(batch)
+
+        for key in batch:
+            status = statuses[key]
+            if not status.exists:
+                # deleted while listing
+                continue
+
+            if as_json:
+                click.echo("[" if count == 0 else ",", nl=False)
+                click.echo(json.dumps(dict(
+                    name=key,
+                    locked=status.locked,
+                    owner=status.owner,
+                )))
+            else:
+                click.echo("- %s: " % key, nl=False)
+
+                if status.locked:
+                    click.secho("Locked", fg="red")
+                else:
+                    click.secho("Not locked", fg="green")
+
+            count += 1
+
+    if as_json:
+        click.echo("[]" if count == 0 else "]")
+    elif count == 0:
         click.echo("- No configurations.")
+
+
+def _format_time(seconds):
+    """
+    Format seconds since the epoch as local time.
+    """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+@cli.command()
+@click.option(
+    '--json',
+    'as_json',
+    is_flag=True,
+    help="print locks as a JSON list")
+@click.option(
+    '--force-break-stale',
+    is_flag=True,
+    help="release the locks whose lease expired before they were unlocked")
+@pass_arguments
+def locks(args, as_json, force_break_stale):
+    """
+    show the held locks and their owners.
+    """
+    if force_break_stale:
+        for config_name in args.resource.break_stale():
+            if not as_json:
+                _echo_result(config_name, "stale lock broken", "yellow")
+
+    held = args.resource.locks()
+
+    if as_json:
+        click.echo(json.dumps([
+            dict(name=name, **info._asdict())
+            for name, info in sorted(held.items())]))
         return
 
-    for key in keys:
-        click.echo("- %s: " % key, nl=False)
+    click.echo("Held locks:")
+
+    for name, info in sorted(held.items()):
+        owner = info.owner
+        if info.host or info.pid:
+            owner = "%s (%s:%s)" % (owner, info.host, info.pid)
+        if info.session:
+            owner += ", session %s" % info.session
+
+        details = [owner]
+        if info.acquired:
+            details.append("since %s" % _format_time(info.acquired))
+        if info.expires:
+            details.append("%s %s" % (
+                "expired" if info.stale else "expires",
+                _format_time(info.expires)))
+
+        _echo_result(
+            name,
+            "%s by %s" % ("Stale" if info.stale else "Locked",
+                          ", ".join(details)),
+            "yellow" if info.stale else "red")
+
+    if not held:
+        click.echo("- No locks.")
+
+
+# messages and colors of the watched events
+_EVENTS = dict(
+    push=("pushed", "green"),
+    delete=("deleted", "red"),
+    lock=("locked", "red"),
+    unlock=("unlocked", "green"),
+)
+
+
+@cli.command()
+@click.argument("pattern", default="*")
+@click.option(
+    '--since',
+    '-s',
+    default=None,
+    help="resume watching after the event with this id")
+@click.option(
+    '--timeout',
+    '-t',
+    default=None,
+    type=click.FLOAT,
+    help="seconds to watch (default: forever)")
+@click.option(
+    '--json',
+    'as_json',
+    is_flag=True,
+    help="print events as JSON lines")
+@pass_arguments
+def watch(args, pattern, since, timeout, as_json):
+    """
+    watch the changes of the configurations matching a pattern.
+    """
+    events = args.resource.watch(pattern=pattern, since=since, timeout=timeout)
+
+    try:
+        for event in events:
+            if as_json:
+                click.echo(json.dumps(event._asdict()))
+                continue
+
+            if event.kind == "reset":
+                click.secho("- events could have been lost", fg="yellow")
+                continue
+
+            message, color = _EVENTS.get(event.kind, (event.kind, None))
+            if event.kind == "lock" and event.expires:
+                message += " until %s" % _format_time(event.expires)
+            if event.id:
+                message += " (%s)" % event.id
+
+            _echo_result(event.name, message, color)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        events.close()
+
+
+@cli.command(name="import")
+@click.argument("source", type=click.Path(exists=True))
+@click.option(
+    '--dry-run',
+    '-d',
+    is_flag=True,
+    help="show differences with the stored configurations, without pushing")
+@click.option(
+    '--batch-size',
+    '-b',
+    default=500,
+    type=click.INT,
+    help="configurations pushed at once (default: 500)")
+@pass_arguments
+def _import(args, source, dry_run, batch_size):
+    """
+    import the ini files of a directory or of a tar/zip archive. File names
+    without extension are used as configuration names.
+    """
+    failures = []
+
+    def _configs():
+        for config_name, data in _iter_files(source):
+            config = configparser.ConfigParser()
+            try:
+                config.read_string(data, source=config_name)
+                yield config_name, _pytest_dict(config)
+            except (configparser.Error, ResourceError) as err:
+                failures.append(config_name)
+                _echo_result(config_name, str(err), "red")
+
+    # files are read only when the next batch is pushed
+    configs = _configs()
+    count = 0
+
+    while True:
+        batch = list(itertools.islice(configs, batch_size))
+        if not batch:
+            break
+
+        count += len(batch)
+
+        if dry_run:
+            # files are compared with what has been pushed
+            errors = dict()
+            stored = args.resource.pull_many(
+                [config_name for config_name, _ in batch],
+                resolve=False,
+                errors=errors)
+
+            for config_name, config in batch:
+                if config_name in errors:
+                    failures.append(config_name)
+                    _echo_result(config_name, str(errors[config_name]), "red")
+                else:
+                    _echo_diff(config_name, stored[config_name], config)
+
+            continue
+
+        errors = args.resource.push_many(batch)
+        for config_name, _ in batch:
+            if config_name in errors:
+                failures.append(config_name)
+                _echo_result(config_name, str(errors[config_name]), "red")
+            else:
+                _echo_result(config_name, "pushed", "green")
+
+    if failures:
+        raise ResourceError(
+            "%d configurations can't be imported." % len(failures))
+
+    if count == 0:
+        click.echo("- No configurations.")
+
+
+@cli.command(name="export")
+@click.argument("destination", type=click.Path(file_okay=False))
+@click.option(
+    '--batch-size',
+    '-b',
+    default=500,
+    type=click.INT,
+    help="configurations pulled at once (default: 500)")
+@pass_arguments
+def export(args, destination, batch_size):
+    """
+    export all configurations as ini files inside a directory.
+    """
+    os.makedirs(destination, exist_ok=True)
+
+    keys = iter(args.resource.iter_keys())
+    failures = []
+
+    while True:
+        batch = list(itertools.islice(keys, batch_size))
+        if not batch:
+            break
 
-        if args.resource.is_locked(key):
-            click.secho("Locked", fg="red")
-        else:
-            click.secho("Not locked", fg="green")
+        # inherited options are not exported, so they are inherited again
+        # when configurations are imported
+        errors = dict()
+        configs = args.resource.pull_many(
+            batch, resolve=False, errors=errors)
+
+        for config_name in batch:
+            if config_name in errors:
+                failures.append(config_name)
+                _echo_result(config_name, str(errors[config_name]), "red")
+                continue
+
+            values = configs[config_name]
+            if values is None:
+                # deleted while exporting
+                continue
+
+            if os.path.basename(config_name) != config_name or \
+                    config_name.startswith("."):
+                failures.append(config_name)
+                _echo_result(config_name, "not a valid file name", "red")
+                continue
+
+            # values are written as they are read by push
+            config = configparser.ConfigParser(interpolation=None)
+            config.optionxform = str
+            config.add_section("pytest")
+            for option, value in values.items():
+                config.set("pytest", option, value.replace("%", "%%"))
+
+            path = os.path.join(destination, config_name + ".ini")
+            with open(path, "w") as data:
+                config.write(data)
+
+            _echo_result(config_name, "exported", "green")
+
+    if failures:
+        raise ResourceError(
+            "%d configurations can't be exported." % len(failures))
 
 
 @cli.command()
@@ -153,3 +612,37 @@ def delete(args, config_name):
     delete a configuration.
     """
     args.resource.delete(config_name)
+
+
+@cli.command(name="serve-metrics")
+@click.option(
+    '--listen',
+    '-l',
+    default="127.0.0.1",
+    help="address where metrics are served (default: 127.0.0.1)")
+@click.option(
+    '--listen-port',
+    '-P',
+    default=9400,
+    type=click.INT,
+    help="port where metrics are served (default: 9400)")
+@pass_arguments
+def serve_metrics(args, listen, listen_port):
+    """
+    serve the lock statistics to Prometheus, on the /metrics path.
+    """
+    try:
+        args.resource.lock_stats()
+    except NotImplementedError:
+        raise ResourceError("resource doesn't collect lock statistics.")
+
+    server = MetricsServer((listen, listen_port), args.resource)
+    click.echo("serving metrics on http://%s:%d/metrics" %
+               server.server_address[:2])
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
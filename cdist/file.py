@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""
+Local filesystem resource implementation, for pytest sessions running on the
+same host.
+
+Configurations are stored as JSON files inside the "<path>/<namespace>/config"
+directory and they are written atomically, by renaming a temporary file over
+the previous one. Readers never see a partially written configuration and they
+keep a cache of the parsed files, which is validated by the file identity and
+modification time.
+
+Locks are open file description locks on the files of the
+"<path>/<namespace>/lock" directory, so they are released by the kernel as
+soon as the process holding them dies and they don't need any TTL. Unlike
+``flock`` locks, they can be tested without acquiring them. The lock file
+contains the token of its owner. A lock can be broken by removing its file: the
+owner keeps a lock on a file which is not reachable anymore and new owners lock
+a new file.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import os
+import json
+import mmap
+import time
+import uuid
+import fcntl
+import struct
+import tempfile
+import threading
+from urllib.parse import quote
+from urllib.parse import unquote
+from urllib.parse import urlparse
+from cdist import instrument
+from cdist.resource import Resource
+from cdist.resource import config_hash
+from cdist.resource import resolve_config
+from cdist.resource import ConfigStatus
+from cdist.resource import ResourceError
+from cdist.resource import ResourceConnectionError
+from cdist.resource import ResourcePushError
+from cdist.resource import ResourcePullError
+from cdist.resource import ResourceLockError
+from cdist.resource import ResourceUnlockError
+from cdist.resource import ResourceNotExistError
+from cdist.resource import ResourceDeleteError
+
+# seconds between two lock attempts of a waiter with timeout
+WAIT_POLL_INTERVAL = 0.01
+
+# extension of the configuration files
+CONFIG_EXT = ".json"
+
+# open file description lock commands. Values are the Linux ones, which are
+# exported by the fcntl module since python 3.9
+F_OFD_GETLK = getattr(fcntl, "F_OFD_GETLK", 36)
+F_OFD_SETLK = getattr(fcntl, "F_OFD_SETLK", 37)
+F_OFD_SETLKW = getattr(fcntl, "F_OFD_SETLKW", 38)
+
+# struct flock: l_type, l_whence, l_start, l_len, l_pid
+FLOCK = struct.Struct("hhqqi")
+
+# exclusive lock of the whole file
+WHOLE_FILE_LOCK = FLOCK.pack(fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+
+
+def _file_locked(fd):
+    """
+    True if a file is locked through another open file description. The
+    lock is only tested, not acquired.
+    """
+    data = fcntl.fcntl(fd, F_OFD_GETLK, WHOLE_FILE_LOCK)
+    return FLOCK.unpack(data)[0] != fcntl.F_UNLCK
+
+
+class FileResource(Resource):
+    """
+    Filesystem resource implementation. Locks are owned by the instance which
+    acquired them and they are released when the instance process dies.
+    """
+
+    process_locks = True
+
+    def __init__(self, **kwargs: dict):
+        """
+        Args:
+            path (str): directory storing configurations.
+            namespace (str): sub directory of all the files stored by cdist
+                (default: cdist).
+            owner (str): token identifying the owner of the locks acquired
+                by this instance (default: random token).
+            lock_ttl (float): not used, since locks are released when the
+                process holding them dies.
+        """
+        path = kwargs.get("path", None)
+        if not path:
+            raise ValueError("path is empty")
+
+        self._namespace = kwargs.get("namespace", "cdist")
+        self._owner = kwargs.get("owner", None) or uuid.uuid4().hex
+        self._root = os.path.join(path, self._namespace)
+        self._config_dir = os.path.join(self._root, "config")
+        self._lock_dir = os.path.join(self._root, "lock")
+        self._locks = dict()
+        self._locks_mutex = threading.Lock()
+        self._cache = dict()
+
+        try:
+            os.makedirs(self._config_dir, exist_ok=True)
+            os.makedirs(self._lock_dir, exist_ok=True)
+        except OSError as err:
+            raise ResourceConnectionError(err)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: dict):
+        """
+        Create a resource from a "file:///path/to/directory" URL.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != "file":
+            raise ValueError("'%s' is not a file url" % url)
+
+        if parsed.netloc not in ("", "localhost"):
+            raise ValueError("'%s' is not a local path" % url)
+
+        kwargs["path"] = unquote(parsed.path)
+
+        return cls(**kwargs)
+
+    @property
+    def owner(self) -> str:
+        """
+        Token identifying the owner of the locks acquired by this instance.
+        """
+        return self._owner
+
+    @staticmethod
+    def _file_name(key):
+        """
+        Return the file name of a configuration. Names are quoted, so they
+        can contain any character. A leading dot is quoted as well, so names
+        are never hidden files, nor "." and "..".
+        """
+        name = quote(key, safe="")
+        if name.startswith("."):
+            name = "%2E" + name[1:]
+
+        return name
+
+    def _config_path(self, key):
+        """
+        Return the path of the file storing a configuration.
+        """
+        return os.path.join(
+            self._config_dir,
+            self._file_name(key) + CONFIG_EXT)
+
+    def _lock_path(self, key):
+        """
+        Return the path of the file used to lock a configuration.
+        """
+        return os.path.join(self._lock_dir, self._file_name(key))
+
+    def _read(self, key):
+        """
+        Return the stored data of a configuration, or None if configuration
+        doesn't exist. Parsed files are cached until they are replaced.
+        """
+        path = self._config_path(key)
+
+        try:
+            with open(path, "rb") as data:
+                stat = os.fstat(data.fileno())
+                identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+                cached = self._cache.get(key, None)
+                if cached and cached[0] == identity:
+                    return cached[1]
+
+                with mmap.mmap(
+                        data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    stored = json.loads(mapped[:].decode())
+        except FileNotFoundError:
+            self._cache.pop(key, None)
+            return None
+        except (OSError, ValueError) as err:
+            raise ResourcePullError(err)
+
+        self._cache[key] = (identity, stored)
+
+        return stored
+
+    def push(self, key: str, config: dict) -> bool:
+        if not key:
+            raise ValueError("key is empty")
+
+        if config is None:
+            raise ValueError("config is None")
+
+        if key.endswith(".lock"):
+            raise ValueError("key can't end with '.lock' suffix")
+
+        if not config:
+            raise ResourcePushError("'%s' config is empty" % key)
+
+        version = config_hash(config)
+        stored = self._read(key)
+        if stored and stored["version"] == version:
+            return False
+
+        data = json.dumps(dict(
+            version=version,
+            config=dict((str(option), str(value))
+                        for option, value in config.items())))
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self._config_dir,
+                prefix=".",
+                suffix=".tmp")
+            try:
+                os.fchmod(fd, 0o644)
+                with os.fdopen(fd, "w") as tmp:
+                    tmp.write(data)
+
+                os.replace(tmp_path, self._config_path(key))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as err:
+            raise ResourcePushError(err)
+
+        return True
+
+    def _read_config(self, key):
+        """
+        Return the stored version and options of a configuration, or None if
+        configuration doesn't exist.
+        """
+        stored = self._read(key)
+        if not stored:
+            return None
+
+        return stored["version"], stored["config"]
+
+    def pull(self, key: str, resolve: bool = True) -> dict:
+        if not key:
+            raise ValueError("key is empty")
+
+        if resolve:
+            # merged configuration is always a copy of the cached data
+            return resolve_config(key, self._read_config)[1]
+
+        stored = self._read(key)
+        if not stored:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        # cached data must not be changed by the caller
+        return dict(stored["config"])
+
+    def version(self, key: str) -> str:
+        if not key:
+            raise ValueError("key is empty")
+
+        return resolve_config(key, self._read_config)[0]
+
+    def _try_lock(self, key, blocking):
+        """
+        Lock the file of a configuration. Return the lock file descriptor,
+        or None if it's locked by others.
+        """
+        path = self._lock_path(key)
+
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if blocking:
+                    started = time.monotonic()
+                    fcntl.fcntl(fd, F_OFD_SETLKW, WHOLE_FILE_LOCK)
+                    instrument.count_wait(time.monotonic() - started)
+                else:
+                    fcntl.fcntl(fd, F_OFD_SETLK, WHOLE_FILE_LOCK)
+            except (BlockingIOError, PermissionError):
+                os.close(fd)
+                return None
+            except BaseException:
+                os.close(fd)
+                raise
+
+            # lock file could have been removed while waiting, in this case
+            # lock is not valid anymore
+            if self._holds_fd(key, fd):
+                break
+
+            os.close(fd)
+
+        owner = self._owner.encode()
+        os.pwrite(fd, owner, 0)
+        os.ftruncate(fd, len(owner))
+
+        return fd
+
+    def _holds(self, key):
+        """
+        True if lock of a configuration is held by this instance and it has
+        not been broken.
+        """
+        fd = self._locks.get(key, None)
+        if fd is None:
+            return False
+
+        return self._holds_fd(key, fd)
+
+    def _release(self, key):
+        """
+        Release the lock held by this instance.
+        """
+        fd = self._locks.pop(key, None)
+        if fd is None:
+            return
+
+        if self._holds_fd(key, fd):
+            os.ftruncate(fd, 0)
+
+        os.close(fd)
+
+    def _holds_fd(self, key, fd):
+        """
+        True if a file descriptor is the current lock file of a
+        configuration.
+        """
+        try:
+            return os.stat(self._lock_path(key)).st_ino == \
+                os.fstat(fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def lock(self, key: str, timeout: float = None, blocking: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        if self._read(key) is None:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        with self._locks_mutex:
+            if self._holds(key):
+                return
+
+            # broken lock
+            self._release(key)
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        try:
+            # locks can't wait with a timeout, so waiters with a deadline
+            # try again periodically
+            fd = self._try_lock(key, blocking and deadline is None)
+            while fd is None and blocking and time.monotonic() < deadline:
+                time.sleep(WAIT_POLL_INTERVAL)
+                instrument.count_wait(WAIT_POLL_INTERVAL)
+                fd = self._try_lock(key, False)
+        except OSError as err:
+            raise ResourceLockError(err)
+
+        if fd is None:
+            raise ResourceLockError("'%s' config is already locked" % key)
+
+        with self._locks_mutex:
+            self._locks[key] = fd
+
+    def unlock(self, key: str, force: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        if self._read(key) is None:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        with self._locks_mutex:
+            if self._holds(key):
+                self._release(key)
+                return
+
+            self._release(key)
+
+        owner = self._lock_owner(key)
+        if owner is None:
+            return
+
+        if not force:
+            raise ResourceUnlockError(
+                "'%s' config is locked by another owner" % key)
+
+        try:
+            os.unlink(self._lock_path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            raise ResourceUnlockError(err)
+
+    def renew(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
+
+        # locks don't expire, they are only broken
+        with self._locks_mutex:
+            if not self._holds(key):
+                raise ResourceLockError(
+                    "'%s' config lock has been lost" % key)
+
+    def _lock_owner(self, key):
+        """
+        Return the owner of a configuration lock, or None if it's not locked.
+        Owner is empty when the lock has been acquired, but its owner has not
+        been written yet.
+        """
+        if self._holds(key):
+            return self._owner
+
+        path = self._lock_path(key)
+        try:
+            with open(path, "rb") as data:
+                # owner could have died without releasing the lock
+                if not _file_locked(data.fileno()):
+                    return None
+
+                return data.read().decode()
+        except FileNotFoundError:
+            return None
+        except OSError as err:
+            raise ResourceError(err)
+
+    def is_locked(self, key: str) -> bool:
+        if not key:
+            raise ValueError("key is empty")
+
+        if self._read(key) is None:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        return self._lock_owner(key) is not None
+
+    def status_many(self, keys) -> dict:
+        statuses = dict()
+        for key in keys:
+            if not key:
+                raise ValueError("key is empty")
+
+            if self._read(key) is None:
+                statuses[key] = ConfigStatus(False, False, None)
+                continue
+
+            owner = self._lock_owner(key)
+            statuses[key] = ConfigStatus(True, owner is not None, owner)
+
+        return statuses
+
+    def iter_keys(self, count: int = None):
+        try:
+            with os.scandir(self._config_dir) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.startswith(".") or not name.endswith(CONFIG_EXT):
+                        continue
+
+                    yield unquote(name[:-len(CONFIG_EXT)])
+        except OSError as err:
+            raise ResourceConnectionError(err)
+
+    def delete(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
+
+        try:
+            os.unlink(self._config_path(key))
+        except FileNotFoundError:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+        except OSError as err:
+            raise ResourceDeleteError(err)
+
+        self._cache.pop(key, None)
+
+        # always delete the locking file
+        with self._locks_mutex:
+            self._release(key)
+
+        try:
+            os.unlink(self._lock_path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            raise ResourceDeleteError(err)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+Hooks specifications of the cdist plugin.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+
+
+def pytest_cdist_operation(config, operation):
+    """
+    Called every time an operation of a cdist resource completes, such as
+    the configuration lock or pull. It can be called by a background thread.
+
+    Args:
+        config (pytest.Config): pytest configuration.
+        operation (cdist.instrument.Operation): completed operation, with
+            its duration, round trips, transferred bytes and lock wait time.
+    """
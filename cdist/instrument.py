@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the resource operations. Every operation of a resource,
+such as push, pull or lock, is timed and it's reported to the registered
+listeners as an ``Operation``, together with the number of round trips, the
+bytes transferred and the time spent waiting for a lock.
+
+When no listeners are registered, operations are not measured at all and the
+only overhead is a check of the listeners list.
+
+    from cdist import instrument
+
+    def listener(operation):
+        print(operation.name, operation.key, operation.duration)
+
+    instrument.add_listener(listener)
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import time
+import inspect
+import functools
+import contextvars
+from collections import namedtuple
+
+# completed resource operation. ``duration`` and ``wait`` are in seconds,
+# ``sent`` and ``received`` are in bytes, ``error`` is the raised exception
+Operation = namedtuple(
+    "Operation",
+    [
+        "name",
+        "key",
+        "duration",
+        "roundtrips",
+        "sent",
+        "received",
+        "wait",
+        "error",
+    ])
+
+# operations which are measured
+OPERATIONS = (
+    "push",
+    "push_many",
+    "pull",
+    "pull_many",
+    "version",
+    "lock",
+    "lock_any",
+    "unlock",
+    "renew",
+    "is_locked",
+    "status_many",
+    "locks",
+    "break_stale",
+    "delete",
+)
+
+# registered listeners
+_LISTENERS = []
+
+# counters of the operation which is running inside the current context
+_COUNTERS = contextvars.ContextVar("cdist_counters", default=None)
+
+
+class Counters:
+    """
+    Counters of a running operation, increased by the resources
+    implementations.
+    """
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("roundtrips", "sent", "received", "wait")
+
+    def __init__(self):
+        self.roundtrips = 0
+        self.sent = 0
+        self.received = 0
+        self.wait = 0.0
+
+
+def add_listener(listener):
+    """
+    Register a listener, which is called with an ``Operation`` every time a
+    resource operation completes. Listeners are called by the thread which
+    executed the operation and they must not raise exceptions.
+
+    Args:
+        listener (callable): function receiving an ``Operation``.
+    """
+    if listener not in _LISTENERS:
+        _LISTENERS.append(listener)
+
+
+def remove_listener(listener):
+    """
+    Unregister a listener. Nothing happens if it's not registered.
+
+    Args:
+        listener (callable): registered listener.
+    """
+    if listener in _LISTENERS:
+        _LISTENERS.remove(listener)
+
+
+def current() -> Counters:
+    """
+    Return the counters of the operation running inside the current context,
+    or None if operations are not measured.
+    """
+    return _COUNTERS.get()
+
+
+def count_roundtrip():
+    """
+    Count a request sent to the resource service.
+    """
+    counters = _COUNTERS.get()
+    if counters is not None:
+        counters.roundtrips += 1
+
+
+def count_sent(sent: int):
+    """
+    Count the bytes sent to the resource service.
+
+    Args:
+        sent (int): bytes of the request.
+    """
+    counters = _COUNTERS.get()
+    if counters is not None:
+        counters.sent += sent
+
+
+def count_received(received: int):
+    """
+    Count the bytes received from the resource service.
+
+    Args:
+        received (int): bytes of the reply.
+    """
+    counters = _COUNTERS.get()
+    if counters is not None:
+        counters.received += received
+
+
+def count_wait(wait: float):
+    """
+    Count the time spent waiting for a lock held by others.
+
+    Args:
+        wait (float): seconds spent waiting.
+    """
+    counters = _COUNTERS.get()
+    if counters is not None:
+        counters.wait += wait
+
+
+def _key(args, kwargs):
+    """
+    Return the key handled by an operation, or None if operation handles
+    many keys. Key is the first argument of an operation, or its "key"
+    keyword argument.
+    """
+    key = args[0] if args else kwargs.get("key", None)
+    if isinstance(key, str):
+        return key
+
+    return None
+
+
+def _notify(name, args, kwargs, start, counters, error):
+    """
+    Send a completed operation to the listeners.
+    """
+    operation = Operation(
+        name,
+        _key(args, kwargs),
+        time.perf_counter() - start,
+        counters.roundtrips,
+        counters.sent,
+        counters.received,
+        counters.wait,
+        error)
+
+    for listener in list(_LISTENERS):
+        listener(operation)
+
+
+def instrumented(name, func):
+    """
+    Return a resource method which reports its executions to the listeners.
+    Operations called by another operation are counted inside the outer one.
+
+    Args:
+        name (str): name of the operation.
+        func (callable): resource method, or coroutine function.
+
+    Returns:
+        callable: instrumented method.
+    """
+    if getattr(func, "__cdist_instrumented__", False):
+        return func
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            if not _LISTENERS or _COUNTERS.get() is not None:
+                return await func(self, *args, **kwargs)
+
+            counters = Counters()
+            token = _COUNTERS.set(counters)
+            start = time.perf_counter()
+            error = None
+            try:
+                return await func(self, *args, **kwargs)
+            except Exception as err:
+                error = err
+                raise
+            finally:
+                _COUNTERS.reset(token)
+                _notify(name, args, kwargs, start, counters, error)
+
+        async_wrapper.__cdist_instrumented__ = True
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not _LISTENERS or _COUNTERS.get() is not None:
+            return func(self, *args, **kwargs)
+
+        counters = Counters()
+        token = _COUNTERS.set(counters)
+        start = time.perf_counter()
+        error = None
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            _COUNTERS.reset(token)
+            _notify(name, args, kwargs, start, counters, error)
+
+    wrapper.__cdist_instrumented__ = True
+    return wrapper
+
+
+def instrument_class(cls):
+    """
+    Replace the operations defined by a resource class with instrumented
+    methods.
+
+    Args:
+        cls (class): ``Resource`` or ``AsyncResource`` implementation.
+    """
+    for name in OPERATIONS:
+        func = cls.__dict__.get(name, None)
+        if callable(func):
+            setattr(cls, name, instrumented(name, func))
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+In-process memory resource implementation, for hermetic tests and for
+sessions which don't need to share configurations with other processes.
+
+Configurations are stored inside named stores, so all the resources created
+with the same store name share configurations and locks. Locks have the same
+semantics of the Redis ones: they are owned by a token, they can expire after
+a TTL and waiters are served in arrival order.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import time
+import uuid
+import threading
+from urllib.parse import urlparse
+from cdist import instrument
+from cdist.resource import Resource
+from cdist.resource import ConfigStatus
+from cdist.resource import config_hash
+from cdist.resource import resolve_config
+from cdist.resource import ResourcePushError
+from cdist.resource import ResourceLockError
+from cdist.resource import ResourceUnlockError
+from cdist.resource import ResourceNotExistError
+
+
+class MemoryStore:
+    """
+    Configurations, locks, waiters and events subscribers shared by memory
+    resources. Every access must hold the ``condition`` lock, which is
+    notified when a lock is released.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.configs = dict()
+        self.locks = dict()
+        self.queues = dict()
+        self.subscribers = list()
+
+
+class MemorySubscription:
+    """
+    Subscription to the events of a namespace inside a memory store.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, store, namespace, callback):
+        self._store = store
+        self._callback = callback
+        self.namespace = namespace
+
+    def __call__(self, event, name, expires):
+        self._callback(event, name, expires)
+
+    def close(self):
+        """
+        Stop receiving the events.
+        """
+        with self._store.condition:
+            if self in self._store.subscribers:
+                self._store.subscribers.remove(self)
+
+
+# stores by name
+_STORES = dict()
+_STORES_MUTEX = threading.Lock()
+
+
+def get_store(name: str) -> MemoryStore:
+    """
+    Return a memory store, creating it if it doesn't exist.
+
+    Args:
+        name (str): name of the store.
+
+    Returns:
+        MemoryStore: the store.
+    """
+    with _STORES_MUTEX:
+        store = _STORES.get(name, None)
+        if store is None:
+            store = MemoryStore()
+            _STORES[name] = store
+
+        return store
+
+
+def clear_store(name: str):
+    """
+    Remove all the configurations and locks of a memory store.
+
+    Args:
+        name (str): name of the store.
+    """
+    with _STORES_MUTEX:
+        store = _STORES.pop(name, None)
+
+    if store is not None:
+        with store.condition:
+            store.configs.clear()
+            store.locks.clear()
+            store.queues.clear()
+            store.condition.notify_all()
+
+            for subscriber in list(store.subscribers):
+                subscriber("reset", None, None)
+
+
+class MemoryResource(Resource):
+    """
+    Memory resource implementation. The same instance can be used by
+    multiple threads.
+    """
+
+    def __init__(self, **kwargs: dict):
+        """
+        Args:
+            store (str): name of the store shared by the resources
+                (default: default).
+            namespace (str): prefix of all the keys stored by cdist
+                (default: cdist).
+            owner (str): token identifying the owner of the locks acquired
+                by this instance (default: random token).
+            lock_ttl (float): seconds after which a lock expires if it's not
+                renewed. None or 0 for locks which never expire
+                (default: None).
+        """
+        self._store = get_store(kwargs.get("store", None) or "default")
+        self._namespace = kwargs.get("namespace", "cdist")
+        self._owner = kwargs.get("owner", None) or uuid.uuid4().hex
+        self._lock_ttl = float(kwargs.get("lock_ttl", None) or 0)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: dict):
+        """
+        Create a resource from a "memory://[store]" URL.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != "memory":
+            raise ValueError("'%s' is not a memory url" % url)
+
+        if parsed.netloc:
+            kwargs["store"] = parsed.netloc
+
+        return cls(**kwargs)
+
+    @property
+    def owner(self) -> str:
+        """
+        Token identifying the owner of the locks acquired by this instance.
+        """
+        return self._owner
+
+    def _name(self, key):
+        """
+        Return the name of a configuration inside the store.
+        """
+        return (self._namespace, key)
+
+    def _expires(self):
+        """
+        Return the expiration time of a lock acquired now.
+        """
+        if self._lock_ttl > 0:
+            return time.monotonic() + self._lock_ttl
+
+        return None
+
+    def _notify(self, event, key, locked=False):
+        """
+        Send an event to the store subscribers. Store lock must be held.
+        """
+        expires = None
+        if locked and self._lock_ttl > 0:
+            expires = time.time() + self._lock_ttl
+
+        for subscriber in list(self._store.subscribers):
+            if subscriber.namespace == self._namespace:
+                subscriber(event, key, expires)
+
+    def _lock_owner(self, name):
+        """
+        Return the owner of a lock, or None if it's not locked or if it's
+        expired. Store lock must be held.
+        """
+        lock = self._store.locks.get(name, None)
+        if lock is None:
+            return None
+
+        owner, expires = lock
+        if expires is not None and expires <= time.monotonic():
+            del self._store.locks[name]
+            return None
+
+        return owner
+
+    def _check_exists(self, key):
+        """
+        Raise ResourceNotExistError if configuration doesn't exist. Store
+        lock must be held.
+        """
+        if self._name(key) not in self._store.configs:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+    def push(self, key: str, config: dict) -> bool:
+        if not key:
+            raise ValueError("key is empty")
+
+        if config is None:
+            raise ValueError("config is None")
+
+        if key.endswith(".lock"):
+            raise ValueError("key can't end with '.lock' suffix")
+
+        if not config:
+            raise ResourcePushError("'%s' config is empty" % key)
+
+        version = config_hash(config)
+        values = dict((str(option), str(value))
+                      for option, value in config.items())
+
+        with self._store.condition:
+            stored = self._store.configs.get(self._name(key), None)
+            if stored and stored[0] == version:
+                return False
+
+            self._store.configs[self._name(key)] = (version, values)
+            self._notify("push", key)
+
+        return True
+
+    def _read(self, key):
+        """
+        Return the stored version and options of a configuration, or None if
+        configuration doesn't exist. Store lock must be held.
+        """
+        return self._store.configs.get(self._name(key), None)
+
+    def pull(self, key: str, resolve: bool = True) -> dict:
+        if not key:
+            raise ValueError("key is empty")
+
+        with self._store.condition:
+            if resolve:
+                return resolve_config(key, self._read)[1]
+
+            self._check_exists(key)
+            return dict(self._store.configs[self._name(key)][1])
+
+    def version(self, key: str) -> str:
+        if not key:
+            raise ValueError("key is empty")
+
+        with self._store.condition:
+            return resolve_config(key, self._read)[0]
+
+    def lock(self, key: str, timeout: float = None, blocking: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        name = self._name(key)
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        with self._store.condition:
+            self._check_exists(key)
+
+            # queues are created by waiters only
+            queue = self._store.queues.get(name, None)
+            owner = self._lock_owner(name)
+            if owner == self._owner or (owner is None and not queue):
+                self._store.locks[name] = (self._owner, self._expires())
+                self._notify("lock", key, locked=True)
+                return
+
+            if not blocking:
+                raise ResourceLockError("'%s' config is already locked" % key)
+
+            queue = self._store.queues.setdefault(name, [])
+            queue.append(self._owner)
+            try:
+                while True:
+                    self._check_exists(key)
+
+                    owner = self._lock_owner(name)
+                    if owner is None and queue[0] == self._owner:
+                        self._store.locks[name] = (
+                            self._owner, self._expires())
+                        self._notify("lock", key, locked=True)
+                        return
+
+                    # locks can expire without being released
+                    wait = None
+                    lock = self._store.locks.get(name, None)
+                    if lock and lock[1] is not None:
+                        wait = max(0, lock[1] - time.monotonic())
+
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise ResourceLockError(
+                                "'%s' config is already locked" % key)
+
+                        wait = remaining if wait is None \
+                            else min(wait, remaining)
+
+                    started = time.monotonic()
+                    self._store.condition.wait(wait)
+                    instrument.count_wait(time.monotonic() - started)
+            finally:
+                queue.remove(self._owner)
+                if not queue:
+                    self._store.queues.pop(name, None)
+
+                # next waiter could be the head of the queue now
+                self._store.condition.notify_all()
+
+    def unlock(self, key: str, force: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        name = self._name(key)
+
+        with self._store.condition:
+            self._check_exists(key)
+
+            owner = self._lock_owner(name)
+            if owner is not None and owner != self._owner and not force:
+                raise ResourceUnlockError(
+                    "'%s' config is locked by another owner" % key)
+
+            self._store.locks.pop(name, None)
+            self._store.condition.notify_all()
+            self._notify("unlock", key)
+
+    def renew(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
+
+        name = self._name(key)
+
+        with self._store.condition:
+            if self._lock_owner(name) != self._owner:
+                raise ResourceLockError(
+                    "'%s' config lock has been lost" % key)
+
+            self._store.locks[name] = (self._owner, self._expires())
+            self._notify("renew", key, locked=True)
+
+    def is_locked(self, key: str) -> bool:
+        if not key:
+            raise ValueError("key is empty")
+
+        with self._store.condition:
+            self._check_exists(key)
+            return self._lock_owner(self._name(key)) is not None
+
+    def status_many(self, keys) -> dict:
+        statuses = dict()
+
+        with self._store.condition:
+            for key in keys:
+                if not key:
+                    raise ValueError("key is empty")
+
+                if self._name(key) not in self._store.configs:
+                    statuses[key] = ConfigStatus(False, False, None)
+                    continue
+
+                owner = self._lock_owner(self._name(key))
+                statuses[key] = ConfigStatus(True, owner is not None, owner)
+
+        return statuses
+
+    def subscribe(self, callback):
+        subscription = MemorySubscription(
+            self._store, self._namespace, callback)
+        with self._store.condition:
+            self._store.subscribers.append(subscription)
+
+        return subscription
+
+    def iter_keys(self, count: int = None):
+        with self._store.condition:
+            keys = [key for namespace, key in self._store.configs
+                    if namespace == self._namespace]
+
+        return iter(keys)
+
+    def delete(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
+
+        name = self._name(key)
+
+        with self._store.condition:
+            self._check_exists(key)
+
+            # always delete the lock
+            del self._store.configs[name]
+            self._store.locks.pop(name, None)
+            self._store.condition.notify_all()
+            self._notify("delete", key)
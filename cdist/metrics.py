@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus exporter of the lock statistics collected by a resource. Metrics
+are exposed in the Prometheus text format, which is accepted by OpenMetrics
+scrapers as well:
+
+    cdist_lock_acquisitions_total{config="myconfig"} 12
+    cdist_lock_stale_total{config="myconfig"} 1
+    cdist_lock_hold_seconds_bucket{config="myconfig",le="60"} 10
+    cdist_lock_wait_seconds_bucket{config="myconfig",le="1"} 9
+
+Statistics are read from the resource at every scrape, with a single
+request, so the exporter doesn't keep any state.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+from http.server import ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler
+from cdist.resource import ResourceError
+
+# content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _label(value):
+    """
+    Escape a label value.
+    """
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"')
+
+
+def _number(value):
+    """
+    Format a sample value or a bucket bound.
+    """
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_metrics(stats: dict) -> str:
+    """
+    Format lock statistics in the Prometheus text format.
+
+    Args:
+        stats (dict): a ``LockStats`` for each configuration, as returned by
+            ``Resource.lock_stats``.
+
+    Returns:
+        str: metrics exposition.
+    """
+    names = sorted(stats)
+    lines = list()
+
+    lines.append(
+        "# HELP cdist_lock_acquisitions_total "
+        "Number of times a configuration has been locked.")
+    lines.append("# TYPE cdist_lock_acquisitions_total counter")
+    for name in names:
+        lines.append('cdist_lock_acquisitions_total{config="%s"} %d' % (
+            _label(name), stats[name].acquired))
+
+    lines.append(
+        "# HELP cdist_lock_stale_total "
+        "Number of locks which expired without being released or which "
+        "have been broken.")
+    lines.append("# TYPE cdist_lock_stale_total counter")
+    for name in names:
+        lines.append('cdist_lock_stale_total{config="%s"} %d' % (
+            _label(name), stats[name].stale))
+
+    histograms = (
+        ("hold", "Seconds a configuration lock has been held."),
+        ("wait", "Seconds spent waiting for a configuration lock."),
+    )
+    for metric, description in histograms:
+        family = "cdist_lock_%s_seconds" % metric
+        lines.append("# HELP %s %s" % (family, description))
+        lines.append("# TYPE %s histogram" % family)
+
+        for name in names:
+            label = _label(name)
+            histogram = getattr(stats[name], metric)
+            for bound, count in sorted(histogram.items()):
+                lines.append('%s_bucket{config="%s",le="%s"} %d' % (
+                    family, label, _number(bound), count))
+
+            lines.append('%s_sum{config="%s"} %s' % (
+                family, label,
+                _number(float(getattr(stats[name], metric + "_sum")))))
+            lines.append('%s_count{config="%s"} %d' % (
+                family, label, histogram[float("inf")]))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler exposing the lock statistics of the server resource on
+    the "/metrics" path.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serve the metrics.
+        """
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        try:
+            body = format_metrics(self.server.resource.lock_stats())
+        except ResourceError as err:
+            self.send_error(503, str(err))
+            return
+
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        # scrapes are too frequent to be logged
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    HTTP server exposing the lock statistics of a resource.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, resource):
+        """
+        Args:
+            address (tuple): (hostname, port) where server is listening.
+            resource (Resource): resource collecting lock statistics.
+        """
+        self.resource = resource
+        super().__init__(address, MetricsHandler)
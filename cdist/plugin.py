@@ -1,20 +1,25 @@
 # -*- coding: utf-8 -*-
 """
-cdist-plugin implementation.
+cdist-plugin implementation. This module is loaded by every pytest session,
+so it only defines the plugin options and hooks: the session handling is
+imported when a configuration is requested.
 
 Author:
     Andrea Cervesato <andrea.cervesato@mailbox.org>
 """
-import pytest
-from cdist import __version__
-from cdist.redis import RedisResource
-from cdist.resource import ResourceError
+from cdist import hooks
 
 
 def pytest_addoption(parser):
     """
     Plugin configurations.
     """
+    parser.addini(
+        "cdist_url",
+        "cdist resource URL, i.e. redis://localhost:6379/0. When it's not "
+        "defined, redis backend is used with cdist_hostname and cdist_port",
+        default=""
+    )
     parser.addini(
         "cdist_hostname",
         "cdist resource hostname (default: localhost)",
@@ -25,11 +30,45 @@ def pytest_addoption(parser):
         "cdist resource port (default: 6379)",
         default="6379"
     )
+    parser.addini(
+        "cdist_namespace",
+        "cdist resource keys namespace (default: cdist)",
+        default="cdist"
+    )
     parser.addini(
         "cdist_autolock",
         "Enable/Disable configuration automatic lock (default: True)",
         default="True"
     )
+    parser.addini(
+        "cdist_lock_ttl",
+        "seconds after which the lock expires if session dies (default: 60)",
+        default="60"
+    )
+    parser.addini(
+        "cdist_session",
+        "identifier of the session stored inside the lock records, i.e. the "
+        "URL of the CI job (default: none)",
+        default=""
+    )
+    parser.addini(
+        "cdist_prefetch_timeout",
+        "seconds to wait for the configuration fetched in background during "
+        "the startup, on top of --cdist-lock-timeout. 0 waits forever "
+        "(default: 30)",
+        default="30"
+    )
+    parser.addini(
+        "cdist_cache",
+        "Enable/Disable local cache of configurations (default: True)",
+        default="True"
+    )
+    parser.addini(
+        "cdist_cache_max_age",
+        "seconds during which cached configuration is used without "
+        "validating it (default: 0)",
+        default="0"
+    )
 
     group = parser.getgroup("cdist")
     group.addoption(
@@ -37,95 +76,57 @@ def pytest_addoption(parser):
         action="store",
         dest="cdist_config",
         default="",
-        help="configuration key name"
+        help="configuration key name, or glob pattern of a configurations "
+             "group"
+    )
+    group.addoption(
+        "--cdist-tags",
+        action="store",
+        dest="cdist_tags",
+        default="",
+        help="comma separated tags of a configurations group"
+    )
+    group.addoption(
+        "--cdist-lock-timeout",
+        action="store",
+        dest="cdist_lock_timeout",
+        type=float,
+        default=None,
+        help="seconds to wait for a locked configuration (default: no wait)"
+    )
+    group.addoption(
+        "--cdist-timings",
+        action="store_true",
+        dest="cdist_timings",
+        default=False,
+        help="show the timings of the cdist resource operations"
+    )
+    group.addoption(
+        "--cdist-timings-json",
+        action="store",
+        dest="cdist_timings_json",
+        default=None,
+        metavar="PATH",
+        help="save the timings of the cdist resource operations as JSON"
     )
 
 
-class Plugin:
+def pytest_addhooks(pluginmanager):
     """
-    cdist plugin definition, handling client and pytest hooks.
+    Register cdist hooks.
     """
-
-    def __init__(self):
-        self._client = None
-
-    @staticmethod
-    def _get_autolock(config):
-        """
-        Return autolock parameter.
-        """
-        autolock = config.getini("cdist_autolock").lower() == "true"
-        return autolock
-
-    def pytest_report_header(self, config):
-        """
-        Create the plugin report to be shown during the session.
-        """
-        config_name = config.option.cdist_config
-        if not config_name:
-            return None
-
-        # fetch configuration data
-        hostname = config.getini("cdist_hostname")
-        port = config.getini("cdist_port")
-        autolock = self._get_autolock(config)
-
-        # create report lines
-        lines = list()
-        lines.append("cdist %s -- resource: %s:%s, configuration: %s, autolock: %s" %
-                     (__version__, hostname, port, config_name, autolock))
-
-        return lines
-
-    def pytest_sessionstart(self, session):
-        """
-        Initialize client, fetch data and update pytest configuration.
-        """
-        config_name = session.config.option.cdist_config
-        if not config_name:
-            return None
-
-        # fetch data
-        hostname = session.config.getini("cdist_hostname")
-        port = session.config.getini("cdist_port")
-        autolock = self._get_autolock(session.config)
-
-        # create client
-        try:
-            self._client = RedisResource(hostname=hostname, port=int(port))
-            if autolock:
-                self._client.lock(config_name)
-
-            # pull configuration
-            config = self._client.pull(config_name)
-        except ResourceError as err:
-            raise pytest.UsageError(err)
-
-        # update pytest configuration
-        for key, value in config.items():
-            try:
-                # check if key is available inside pytest configuration
-                session.config.getini(key)
-            except ValueError:
-                continue
-
-            session.config._inicache[key] = value
-
-    def pytest_sessionfinish(self, session, exitstatus):
-        """
-        Unlock configuration when session finish.
-        """
-        config_name = session.config.option.cdist_config
-        if not config_name:
-            return None
-
-        autolock = self._get_autolock(session.config)
-        if autolock:
-            self._client.unlock(config_name)
+    pluginmanager.add_hookspecs(hooks)
 
 
 def pytest_configure(config):
     """
-    Print out some session informations.
+    Register the cdist session plugin when a configuration, or a
+    configurations group, has been requested. Sessions which don't use cdist
+    don't import the resources and they don't run any cdist hook.
     """
+    tags = config.option.cdist_tags.replace(",", " ").split()
+    if not config.option.cdist_config and not tags:
+        return
+
+    from cdist.session import Plugin
     config.pluginmanager.register(Plugin(), "plugin.cdist")
@@ -2,19 +2,94 @@
 """
 Redis resource implementation.
 
-The implemented lock mechanism is the historical way to use a ".lock"
-tag to the configuration key. For example, if a configuration is named
-"myconfig", its lock bit will be defined in the "myconfig.lock" key's
-variable. This is a temporary solution and please give any suggestion if you
-need something more robust.
+All the keys are stored inside a dedicated namespace, so the same server can
+be shared with other applications. For example, if a configuration is named
+"myconfig", it's stored inside the "cdist:config:myconfig" hash and its lock
+is defined in the "cdist:lock:myconfig" key's variable. The version of a
+configuration is the hash of its content and it's stored inside the
+"cdist:version:myconfig" variable, so clients can validate their local copies
+of a configuration without pulling it. Pushing a configuration with the same
+version is a no-op, otherwise only the changed options are written. Pushing
+never touches the lock. Configurations are enumerated with incremental SCAN
+commands matching the namespace only.
+
+Large configurations can be stored as a single compact blob, optionally
+compressed, inside the ":blob" field of the configuration hash, instead of
+one field per option. The format is chosen when a configuration is pushed,
+depending on its size, and readers recognize both of them, so hashes written
+by older clients are still readable. The tags option of a blob is stored as
+a plain field as well, so groups are locked without decoding blobs.
+
+Configurations can inherit the options of the configurations listed by
+their "cdist_extends" option, which is stored as a plain field as well. A
+server side script follows the inheritance chain and returns all the
+inherited configurations at once, so a configuration is resolved with a
+single round trip, and they are merged by the client, which decodes blobs.
+The version of an inherited configuration is derived from the versions of
+all the merged configurations, so local copies are invalidated when one of
+the parents is pushed again.
+
+A lock is a lease: the "cdist:lock:myconfig" hash contains the token of its
+owner, together with the owner host, PID and session, and it expires after a
+TTL, unless the owner renews it. An expired lock is free, but its record is
+kept until the lock is acquired again or it's broken, so the last owner of a
+stale lock can always be found. Locks are acquired,
+released and renewed atomically by server side scripts, so only the owner can
+release its own lock. Clients waiting for a lock are queued inside a list and
+each of them sleeps on its own wake list, with a blocking BLPOP. When a lock is
+released, it's handed over to the first waiter of the queue, which is the only
+one to be woken up.
+
+The lock scripts keep the lock statistics of all the configurations inside
+the "cdist:stats" hash, in the same round trip of the lock operation:
+acquisitions, stale locks, and histograms of the lock hold and wait times.
+Statistics are read with a single HGETALL, without scanning the keys.
+
+Every change of a configuration or of a lock is published on the
+"cdist:events" channel by the same script or transaction which changed it,
+so subscribers, such as client side caches, are notified in real time
+without requiring keyspace notifications to be enabled on the server. The
+same change is appended to the "cdist:events" stream, which keeps the most
+recent changes, so watchers read them with blocking XREAD commands and they
+resume after the last received entry when they are disconnected. Lock
+renewals are only published on the channel, since they don't change the
+lock owner and they are sent by every owner heartbeat.
+
+Every operation is executed with a single round trip, using MULTI/EXEC
+transactions or server side scripts which are registered once per connection.
 
 Author:
     Andrea Cervesato <andrea.cervesato@mailbox.org>
 """
 from __future__ import absolute_import
+import os
+import re
+import time
+import uuid
+import socket
+import fnmatch
+import itertools
+import threading
+from urllib.parse import unquote
+from urllib.parse import urlparse
 from redis import Redis
 from redis import RedisError
+from redis import Connection
+from redis import BlockingConnectionPool
+from cdist import instrument
+from cdist.blob import check_codec
+from cdist.blob import encode_config
+from cdist.blob import decode_config
 from cdist.resource import Resource
+from cdist.resource import config_hash
+from cdist.resource import ConfigStatus
+from cdist.resource import LockStats
+from cdist.resource import LockInfo
+from cdist.resource import Event
+from cdist.resource import TAGS_OPTION
+from cdist.resource import EXTENDS_OPTION
+from cdist.resource import OWN_OPTIONS
+from cdist.resource import resolve_config
 from cdist.resource import ResourceError
 from cdist.resource import ResourceConnectionError
 from cdist.resource import ResourcePushError
@@ -25,9 +100,616 @@ from cdist.resource import ResourceNotExistError
 from cdist.resource import ResourceDeleteError
 
 
-class RedisResource(Resource):
+# characters which must be escaped inside a SCAN pattern
+GLOB_CHARS = re.compile(r"[\\*?\[\]]")
+
+# approximate number of events kept inside the events stream
+EVENTS_MAXLEN = 10000
+
+# hash field storing a configuration serialized as a single blob. It can't
+# be the name of a pytest option
+BLOB_FIELD = ":blob"
+
+# write a configuration only if its version changed. Options which are not
+# defined anymore are removed and only the changed options are written.
+# KEYS: configuration, version variable.
+# ARGV: configuration version, events channel and stream, configuration
+# name, then options names and values.
+# Returns 0 if configuration didn't change.
+PUSH_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+if redis.call('GET', KEYS[2]) == ARGV[1] and
+        redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local wanted = {}
+for i = 4, #ARGV, 2 do
+    wanted[ARGV[i]] = ARGV[i + 1]
+end
+local removed = {}
+local current = redis.call('HGETALL', KEYS[1])
+for i = 1, #current, 2 do
+    local value = wanted[current[i]]
+    if value == nil then
+        table.insert(removed, current[i])
+    elseif value == current[i + 1] then
+        wanted[current[i]] = nil
+    end
+end
+-- arguments are sent in chunks, so they never exceed the Lua stack
+local chunk = {}
+for _, option in ipairs(removed) do
+    table.insert(chunk, option)
+    if #chunk == 1000 then
+        redis.call('HDEL', KEYS[1], unpack(chunk))
+        chunk = {}
+    end
+end
+if #chunk > 0 then
+    redis.call('HDEL', KEYS[1], unpack(chunk))
+end
+chunk = {}
+for option, value in pairs(wanted) do
+    table.insert(chunk, option)
+    table.insert(chunk, value)
+    if #chunk == 1000 then
+        redis.call('HSET', KEYS[1], unpack(chunk))
+        chunk = {}
+    end
+end
+if #chunk > 0 then
+    redis.call('HSET', KEYS[1], unpack(chunk))
+end
+redis.call('SET', KEYS[2], ARGV[1])
+redis.call('PUBLISH', ARGV[2], 'push:0:' .. ARGV[3])
+redis.call('XADD', ARGV[2], 'MAXLEN', '~', %d, '*',
+           'event', 'push', 'name', ARGV[3], 'expires', 0)
+return 1
+""" % EVENTS_MAXLEN
+
+# collect a configuration together with all the configurations it inherits
+# from, following the comma separated extends option of each configuration,
+# so a configuration is resolved with a single round trip. Every
+# configuration is returned once, even if it's inherited many times or if
+# inheritance is circular: inheritance is validated by the client.
+# KEYS: none, since inherited configurations are only known by the script.
+# ARGV: configuration hashes prefix, version variables prefix, extends option
+# name, configuration name, "config" to return all the options, or "version"
+# to return the extends option only.
+# Returns {name, version, options, name, version, options, ...}, where
+# options is empty if configuration doesn't exist.
+RESOLVE_SCRIPT = """
+local reply = {}
+local visited = {}
+local pending = {ARGV[4]}
+while #pending > 0 do
+    local name = table.remove(pending)
+    if not visited[name] then
+        visited[name] = true
+        local config = ARGV[1] .. name
+        local extends = redis.call('HGET', config, ARGV[3])
+        local options = {}
+        if ARGV[5] == 'config' then
+            options = redis.call('HGETALL', config)
+        elseif redis.call('EXISTS', config) == 1 then
+            options = {ARGV[3], extends or ''}
+        end
+        table.insert(reply, name)
+        table.insert(reply, redis.call('GET', ARGV[2] .. name))
+        table.insert(reply, options)
+        if extends then
+            for parent in string.gmatch(extends, '[^,%s]+') do
+                table.insert(pending, parent)
+            end
+        end
+    end
+end
+return reply
+"""
+
+# upper bounds of the lock hold time and wait time histograms, in ms
+HOLD_BUCKETS = (1000, 5000, 15000, 60000, 300000, 900000, 3600000)
+WAIT_BUCKETS = (100, 500, 1000, 5000, 15000, 60000, 300000)
+
+# functions shared by the lock scripts.
+#
+# A lock is a hash storing its owner token, host, PID and session, the time
+# when it has been acquired and the time when its lease expires, in ms since
+# the epoch. An expired lock is free, but its record is kept until the lock
+# is acquired again or it's broken, so the last owner of a stale lock can be
+# shown. Waiters are hashes storing the same information of the lock they
+# will acquire, together with its TTL.
+#
+# Lock statistics are kept inside the stats hash. Fields are named
+# "<metric>:<configuration>". Acquisition time of the held locks is kept
+# inside the held hash, which is the index of all the held locks, and the
+# time when each waiter has been queued is kept inside the queued hash of the
+# configuration.
+#
+# Every change of a lock is published on the events channel as
+# "<event>:<lease expiration>:<configuration>" and it's appended to the
+# events stream having the same name.
+LOCK_FUNCTIONS = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local function now_ms()
+    local now = redis.call('TIME')
+    return tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+end
+local function lock_owner(lock, now)
+    local record = redis.call('HMGET', lock, 'owner', 'expires')
+    local owner = record[1]
+    local expires = tonumber(record[2] or 0) or 0
+    if not owner or owner == '' or (expires > 0 and expires <= now) then
+        return false
+    end
+    return owner
+end
+local function lock_write(lock, token, ttl, host, pid, session, now)
+    local expires = 0
+    if tonumber(ttl) > 0 then
+        expires = now + tonumber(ttl)
+    end
+    redis.call('DEL', lock)
+    redis.call('HSET', lock, 'owner', token, 'host', host, 'pid', pid,
+               'session', session, 'acquired', now, 'expires', expires)
+    return expires
+end
+local function lock_refresh(lock, ttl, now)
+    local expires = 0
+    if tonumber(ttl) > 0 then
+        expires = now + tonumber(ttl)
+    end
+    redis.call('HSET', lock, 'expires', expires)
+    return expires
+end
+local function publish(events, event, name, expires)
+    redis.call('PUBLISH', events, event .. ':' .. expires .. ':' .. name)
+end
+local function notify(events, event, name, expires)
+    publish(events, event, name, expires)
+    redis.call('XADD', events, 'MAXLEN', '~', %d, '*',
+               'event', event, 'name', name, 'expires', expires)
+end
+local function observe(stats, metric, name, value, buckets)
+    local bucket = 'inf'
+    for _, le in ipairs(buckets) do
+        if value <= le then
+            bucket = le
+            break
+        end
+    end
+    redis.call('HINCRBY', stats, metric .. '_bucket_' .. bucket .. ':' .. name, 1)
+    redis.call('HINCRBY', stats, metric .. '_count:' .. name, 1)
+    redis.call('HINCRBY', stats, metric .. '_sum:' .. name, value)
+end
+local function lock_acquired(stats, held, queued, name, token, now)
+    local wait = 0
+    if queued then
+        local since = redis.call('HGET', queued, token)
+        if since then
+            wait = math.max(0, now - tonumber(since))
+            redis.call('HDEL', queued, token)
+        end
+    end
+    -- previous lock expired without being released
+    if redis.call('HEXISTS', held, name) == 1 then
+        redis.call('HINCRBY', stats, 'stale:' .. name, 1)
+    end
+    redis.call('HSET', held, name, now)
+    redis.call('HINCRBY', stats, 'acquired:' .. name, 1)
+    observe(stats, 'wait', name, wait, {%s})
+end
+local function lock_released(stats, held, name, forced, now)
+    local since = redis.call('HGET', held, name)
+    if since then
+        local hold = math.max(0, now - tonumber(since))
+        observe(stats, 'hold', name, hold, {%s})
+        redis.call('HDEL', held, name)
+    end
+    if forced then
+        redis.call('HINCRBY', stats, 'stale:' .. name, 1)
+    end
+end
+""" % (
+    EVENTS_MAXLEN,
+    ", ".join(str(le) for le in WAIT_BUCKETS),
+    ", ".join(str(le) for le in HOLD_BUCKETS))
+
+# acquire the lock if configuration exists, it's not owned by others and
+# there are no waiters before the token. A lock owned by the same token is
+# acquired again, refreshing its TTL. If wait flag is set and lock can't be
+# acquired, token is queued inside the waiters list and its waiter hash is
+# refreshed, so it's kept alive while the client is waiting. The wake list of
+# the token is cleared when the lock is acquired, so a hand over which has not
+# been consumed can't wake up the next wait of the same token.
+# KEYS: configuration, lock hash, waiters list, stats hash, held hash,
+# queued hash, wake list.
+# ARGV: owner token, TTL in ms, wait flag, waiter hashes prefix, waiter
+# lifetime in ms, configuration name, owner host, owner PID, owner session,
+# events channel and stream.
+# Returns -1 if configuration doesn't exist, 0 if it's locked by others.
+LOCK_SCRIPT = LOCK_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local now = now_ms()
+local token = ARGV[1]
+local waiter = ARGV[4] .. token
+local owner = lock_owner(KEYS[2], now)
+if not owner or owner == token then
+    -- waiters which are not alive anymore lose their turn
+    local head = redis.call('LINDEX', KEYS[3], 0)
+    while head and head ~= token and
+            redis.call('EXISTS', ARGV[4] .. head) == 0 do
+        redis.call('LPOP', KEYS[3])
+        redis.call('HDEL', KEYS[6], head)
+        head = redis.call('LINDEX', KEYS[3], 0)
+    end
+    if owner == token then
+        local expires = lock_refresh(KEYS[2], ARGV[2], now)
+        redis.call('DEL', KEYS[7])
+        notify(ARGV[10], 'lock', ARGV[6], expires)
+        return 1
+    end
+    if not head or head == token then
+        if head == token then
+            redis.call('LPOP', KEYS[3])
+            redis.call('DEL', waiter)
+        end
+        redis.call('DEL', KEYS[7])
+        local expires = lock_write(KEYS[2], token, ARGV[2], ARGV[7],
+                                   ARGV[8], ARGV[9], now)
+        lock_acquired(KEYS[4], KEYS[5], KEYS[6], ARGV[6], token, now)
+        notify(ARGV[10], 'lock', ARGV[6], expires)
+        return 1
+    end
+end
+if ARGV[3] == '1' then
+    if redis.call('EXISTS', waiter) == 0 then
+        redis.call('LREM', KEYS[3], 0, token)
+        redis.call('RPUSH', KEYS[3], token)
+        redis.call('HSETNX', KEYS[6], token, now)
+    end
+    redis.call('HSET', waiter, 'ttl', ARGV[2], 'host', ARGV[7],
+               'pid', ARGV[8], 'session', ARGV[9])
+    redis.call('PEXPIRE', waiter, ARGV[5])
+end
+return 0
+"""
+
+# release the lock only if it's owned by the token, or if forced. If stale
+# flag is set, lock is released only if its lease expired. Then lock is
+# handed over to the first waiter which is still alive and the waiter is
+# woken up by pushing into its wake list.
+# KEYS: configuration, lock hash, waiters list, stats hash, held hash,
+# queued hash.
+# ARGV: owner token, force flag, waiter hashes prefix, wake lists prefix,
+# wake list lifetime in ms, configuration name, stale flag, events channel
+# and stream.
+# Returns -1 if configuration doesn't exist, 0 if it's locked by others.
+UNLOCK_SCRIPT = LOCK_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local now = now_ms()
+local owner = lock_owner(KEYS[2], now)
+if owner and (ARGV[7] == '1' or (owner ~= ARGV[1] and ARGV[2] ~= '1')) then
+    return 0
+end
+if owner then
+    lock_released(KEYS[4], KEYS[5], ARGV[6], owner ~= ARGV[1], now)
+elseif redis.call('HDEL', KEYS[5], ARGV[6]) == 1 then
+    -- lock expired without being released
+    redis.call('HINCRBY', KEYS[4], 'stale:' .. ARGV[6], 1)
+end
+redis.call('DEL', KEYS[2])
+notify(ARGV[8], 'unlock', ARGV[6], 0)
+local head = redis.call('LPOP', KEYS[3])
+while head do
+    local waiter = ARGV[3] .. head
+    local record = redis.call('HMGET', waiter, 'ttl', 'host', 'pid', 'session')
+    if record[1] then
+        redis.call('DEL', waiter)
+        local expires = lock_write(KEYS[2], head, record[1], record[2] or '',
+                                   record[3] or '', record[4] or '', now)
+        redis.call('RPUSH', ARGV[4] .. head, '1')
+        redis.call('PEXPIRE', ARGV[4] .. head, ARGV[5])
+        lock_acquired(KEYS[4], KEYS[5], KEYS[6], ARGV[6], head, now)
+        notify(ARGV[8], 'lock', ARGV[6], expires)
+        break
+    end
+    redis.call('HDEL', KEYS[6], head)
+    head = redis.call('LPOP', KEYS[3])
+end
+return 1
+"""
+
+# stop waiting for a lock. Lock could have been handed over in the meantime.
+# KEYS: lock hash, waiters list, waiter hash, wake list, queued hash.
+# ARGV: owner token.
+# Returns 1 if lock is owned by the token.
+CANCEL_SCRIPT = LOCK_FUNCTIONS + """
+redis.call('LREM', KEYS[2], 0, ARGV[1])
+redis.call('DEL', KEYS[3], KEYS[4])
+redis.call('HDEL', KEYS[5], ARGV[1])
+if lock_owner(KEYS[1], now_ms()) == ARGV[1] then
+    return 1
+end
+return 0
+"""
+
+# extend the lock lease only if it's owned by the token. Renewals are only
+# published for the subscribers tracking the leases, so the heartbeats of the
+# owners don't fill the events stream.
+# KEYS: lock hash.
+# ARGV: owner token, TTL in ms, events channel and stream, configuration
+# name.
+# Returns 0 if lock is not owned anymore.
+RENEW_SCRIPT = LOCK_FUNCTIONS + """
+local now = now_ms()
+if lock_owner(KEYS[1], now) ~= ARGV[1] then
+    return 0
+end
+local expires = lock_refresh(KEYS[1], ARGV[2], now)
+publish(ARGV[3], 'renew', ARGV[4], expires)
+return 1
+"""
+
+# lock the first free configuration of a group having all the requested
+# tags. Configurations of the group are scanned by the client, which sends
+# them in batches sorted by name, so the same group is always locked in the
+# same order and the script never walks the keyspace.
+# KEYS: stats hash, held hash, then configuration, lock hash and waiters list
+# of each configuration of the batch.
+# ARGV: owner token, TTL in ms, tags separated by commas, tags option name,
+# owner host, owner PID, owner session, events channel and stream, then the
+# names of the configurations of the batch.
+# Returns {1, name} on success, {0} if all configurations are locked and {-1}
+# if no configurations are matching.
+LOCK_ANY_SCRIPT = LOCK_FUNCTIONS + """
+local wanted = {}
+for tag in string.gmatch(ARGV[3], '[^,%s]+') do
+    table.insert(wanted, tag)
+end
+local now = now_ms()
+local matched = false
+for index = 9, #ARGV do
+    local name = ARGV[index]
+    local config = KEYS[3 * (index - 9) + 3]
+    local lock = KEYS[3 * (index - 9) + 4]
+    local waiters = KEYS[3 * (index - 9) + 5]
+    local selected = redis.call('EXISTS', config) == 1
+    if selected and #wanted > 0 then
+        local tags = {}
+        local value = redis.call('HGET', config, ARGV[4]) or ''
+        for tag in string.gmatch(value, '[^,%s]+') do
+            tags[tag] = true
+        end
+        for _, tag in ipairs(wanted) do
+            if not tags[tag] then
+                selected = false
+                break
+            end
+        end
+    end
+    if selected then
+        matched = true
+        local owner = lock_owner(lock, now)
+        if (not owner or owner == ARGV[1]) and
+                redis.call('LLEN', waiters) == 0 then
+            local expires
+            if owner == ARGV[1] then
+                expires = lock_refresh(lock, ARGV[2], now)
+            else
+                expires = lock_write(lock, ARGV[1], ARGV[2], ARGV[5],
+                                     ARGV[6], ARGV[7], now)
+                lock_acquired(KEYS[1], KEYS[2], nil, name, ARGV[1], now)
+            end
+            notify(ARGV[8], 'lock', name, expires)
+            return {1, name}
+        end
+    end
+end
+if matched then
+    return {0}
+end
+return {-1}
+"""
+
+# return the records of all the held locks, including the stale ones,
+# together with the server time in ms.
+# KEYS: held hash. ARGV: lock hashes prefix.
+# Returns {time, name, record, name, record, ...}.
+LOCKS_SCRIPT = LOCK_FUNCTIONS + """
+local reply = {now_ms()}
+for _, name in ipairs(redis.call('HKEYS', KEYS[1])) do
+    local record = redis.call('HGETALL', ARGV[1] .. name)
+    if #record > 0 then
+        table.insert(reply, name)
+        table.insert(reply, record)
+    end
+end
+return reply
+"""
+
+# delete a configuration together with its lock, its waiters and its version.
+# Deletion is notified only if configuration existed.
+# KEYS: configuration, lock hash, waiters list, queued hash, version, held
+# hash.
+# ARGV: configuration name, events channel and stream.
+# Returns 0 if configuration doesn't exist.
+DELETE_SCRIPT = LOCK_FUNCTIONS + """
+local deleted = redis.call('DEL', KEYS[1])
+redis.call('DEL', KEYS[2], KEYS[3], KEYS[4], KEYS[5])
+redis.call('HDEL', KEYS[6], ARGV[1])
+if deleted == 0 then
+    return 0
+end
+notify(ARGV[2], 'delete', ARGV[1], 0)
+return 1
+"""
+
+# scripts loaded on the server when a new connection is opened
+SCRIPTS = dict(
+    push=PUSH_SCRIPT,
+    resolve=RESOLVE_SCRIPT,
+    lock=LOCK_SCRIPT,
+    unlock=UNLOCK_SCRIPT,
+    renew=RENEW_SCRIPT,
+    cancel=CANCEL_SCRIPT,
+    lock_any=LOCK_ANY_SCRIPT,
+    locks=LOCKS_SCRIPT,
+    delete=DELETE_SCRIPT,
+)
+
+# seconds between two lock attempts of a waiter, when it's not woken up
+WAIT_POLL_INTERVAL = 1.0
+
+
+def register_scripts(connection):
     """
-    Redis recourse implementation.
+    Connection callback which registers the cdist scripts as soon as a new
+    connection is opened, so they can always be executed by SHA in a single
+    round trip.
+    """
+    connection.on_connect()
+
+    # all the scripts are loaded with a single round trip
+    connection.send_packed_command(
+        connection.pack_commands(
+            [("SCRIPT", "LOAD", src) for src in SCRIPTS.values()]))
+
+    for _ in SCRIPTS:
+        connection.read_response()
+
+
+class CountingSocket:
+    """
+    Socket wrapper counting the bytes transferred by the instrumented
+    operations.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def sendall(self, data, *args):
+        """
+        See ``socket.sendall``.
+        """
+        self._sock.sendall(data, *args)
+        instrument.count_sent(len(data))
+
+    def recv(self, size, *args):
+        """
+        See ``socket.recv``.
+        """
+        data = self._sock.recv(size, *args)
+        if not args:
+            instrument.count_received(len(data))
+
+        return data
+
+    def recv_into(self, buffer, *args):
+        """
+        See ``socket.recv_into``.
+        """
+        size = self._sock.recv_into(buffer, *args)
+        if len(args) < 2:
+            instrument.count_received(size)
+
+        return size
+
+
+class RedisConnection(Connection):
+    """
+    Redis connection reporting round trips and transferred bytes to the
+    instrumented operations.
+    """
+
+    def _connect(self):
+        return CountingSocket(super()._connect())
+
+    def send_packed_command(self, command, check_health=True):
+        # commands of a pipeline are sent together with a single round trip
+        instrument.count_roundtrip()
+        super().send_packed_command(command, check_health=check_health)
+
+
+class RedisConnectionPool(BlockingConnectionPool):
+    """
+    Bounded and thread safe connection pool. When all connections are in use,
+    a client waits for a free one instead of opening a new socket. Connections
+    which have been idle for more than ``idle_timeout`` seconds are closed
+    before the next checkout, so a socket dropped by the network is never used
+    to send a command. After a fork, the pool is reset by redis-py and the
+    child process opens its own connections.
+    """
+
+    def __init__(self, idle_timeout=None, **kwargs):
+        """
+        Args:
+            idle_timeout (float): seconds after which an unused connection is
+                closed. None or 0 to keep connections forever.
+            kwargs: ``BlockingConnectionPool`` arguments.
+        """
+        self.idle_timeout = idle_timeout
+        super().__init__(**kwargs)
+
+    def _close_idle(self):
+        """
+        Close the free connections which have been idle for too long. They
+        will be connected again when they are used.
+        """
+        if not self.idle_timeout:
+            return
+
+        now = time.monotonic()
+        with self.pool.mutex:
+            for connection in self.pool.queue:
+                last_used = getattr(connection, "cdist_last_used", None)
+                if last_used is None:
+                    continue
+
+                if now - last_used > self.idle_timeout:
+                    connection.disconnect()
+                    connection.cdist_last_used = None
+
+    def get_connection(self, *args, **kwargs):
+        self._close_idle()
+        return super().get_connection(*args, **kwargs)
+
+    def release(self, connection):
+        connection.cdist_last_used = time.monotonic()
+        super().release(connection)
+
+
+class RedisSubscription:
+    """
+    Subscription to the events channel, listened by a background thread.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, thread):
+        self._thread = thread
+
+    def close(self):
+        """
+        Stop listening the events and release the connection.
+        """
+        self._thread.stop()
+
+
+class RedisNamespace:
+    """
+    Layout of the cdist keys inside a Redis server and parameters shared by
+    the Redis resources implementations.
     """
 
     def __init__(self, **kwargs: dict):
@@ -35,54 +717,171 @@ class RedisResource(Resource):
         Args:
             hostname (str): Redis server hostname (default: localhost).
             port (int): Redis server port (default: 6379).
+            db (int): Redis database number (default: 0).
+            username (str): Redis server username (default: None).
+            password (str): Redis server password (default: None).
+            max_connections (int): maximum number of connections inside the
+                pool (default: 8).
+            pool_timeout (float): seconds to wait for a free connection when
+                the pool is exhausted (default: 10).
+            idle_timeout (float): seconds after which an unused connection is
+                closed (default: 60).
+            health_check_interval (int): seconds after which an idle
+                connection is checked with a PING before using it
+                (default: 30).
+            namespace (str): prefix of all the keys stored by cdist
+                (default: cdist).
+            scan_count (int): number of keys requested by every SCAN
+                iteration (default: 1000).
+            batch_size (int): number of configurations handled by every
+                pipeline in bulk operations (default: 500).
+            owner (str): token identifying the owner of the locks acquired
+                by this instance (default: random token).
+            session (str): identifier of the session owning the locks, which
+                is stored inside the lock records (default: empty).
+            lock_ttl (float): seconds after which a lock expires if it's not
+                renewed. None or 0 for locks which never expire
+                (default: None).
+            blob_threshold (int): size in bytes of the pushed configurations
+                which are stored as a single compact blob, instead of one
+                hash field per option. None to never use blobs, 0 to always
+                use them (default: None).
+            compression (str): codec compressing the blobs: none, zlib or
+                zstd (default: zlib).
+            compress_threshold (int): size in bytes after which blobs are
+                compressed (default: 1024).
         """
         self._hostname = kwargs.get("hostname", "localhost")
         self._port = int(kwargs.get("port", 6379))
+        self._db = int(kwargs.get("db", 0))
+        self._username = kwargs.get("username", None)
+        self._password = kwargs.get("password", None)
+        self._max_connections = int(kwargs.get("max_connections", 8))
+        self._pool_timeout = kwargs.get("pool_timeout", 10)
+        self._idle_timeout = kwargs.get("idle_timeout", 60)
+        self._health_check_interval = int(
+            kwargs.get("health_check_interval", 30))
+        self._namespace = kwargs.get("namespace", "cdist")
+        self._scan_count = int(kwargs.get("scan_count", 1000))
+        self._batch_size = int(kwargs.get("batch_size", 500))
+        self._owner = kwargs.get("owner", None) or uuid.uuid4().hex
+        self._session = kwargs.get("session", None) or ""
+        self._host = socket.gethostname()
+        self._lock_ttl = float(kwargs.get("lock_ttl", None) or 0)
+
+        self._blob_threshold = kwargs.get("blob_threshold", None)
+        if self._blob_threshold is not None:
+            self._blob_threshold = int(self._blob_threshold)
+
+        self._compression = kwargs.get("compression", None) or "zlib"
+        self._compress_threshold = int(
+            kwargs.get("compress_threshold", 1024))
+        check_codec(self._compression)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: dict):
+        """
+        Create a resource from a "redis://[[username]:password@]host:port/db"
+        URL. Arguments defined by the URL override ``kwargs``.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError("'%s' is not a redis url" % url)
+
+        if parsed.hostname:
+            kwargs["hostname"] = parsed.hostname
+
+        if parsed.port:
+            kwargs["port"] = parsed.port
+
+        if parsed.path.strip("/"):
+            try:
+                kwargs["db"] = int(parsed.path.strip("/"))
+            except ValueError:
+                raise ValueError("'%s' is not a valid redis database" %
+                                 parsed.path.strip("/"))
+
+        if parsed.username:
+            kwargs["username"] = unquote(parsed.username)
+
+        if parsed.password:
+            kwargs["password"] = unquote(parsed.password)
+
+        return cls(**kwargs)
 
     @staticmethod
-    def _lock_name(name):
+    def _escape_glob(name):
+        """
+        Escape a name, so it can be used inside a SCAN pattern.
+        """
+        return GLOB_CHARS.sub(r"\\\g<0>", name)
+
+    def _config_name(self, name):
+        """
+        Return the name of the hash storing a configuration.
+        """
+        return "%s:config:%s" % (self._namespace, name)
+
+    def _lock_name(self, name):
         """
         Return the name used to recognize if a configuration is locked.
         """
-        return "%s.lock" % name
+        return "%s:lock:%s" % (self._namespace, name)
 
-    def _connect(self):
+    def _version_name(self, name):
         """
-        Connect to the Redis server.
+        Return the name of the variable storing the configuration version.
         """
-        client = None
-        try:
-            client = Redis(
-                host=self._hostname,
-                port=self._port,
-                decode_responses=True
-            )
-        except RedisError as err:
-            raise ResourceConnectionError(err)
+        return "%s:version:%s" % (self._namespace, name)
 
-        return client
+    def _queue_name(self, name):
+        """
+        Return the name of the list of clients waiting for a lock.
+        """
+        return "%s:queue:%s" % (self._namespace, name)
 
-    def _set_status(self, key: str, locked: bool):
+    def _queued_name(self, name):
         """
-        Set config locking status.
+        Return the name of the hash storing when lock waiters were queued.
         """
-        if not key:
-            raise ValueError("key is empty")
+        return "%s:queued:%s" % (self._namespace, name)
 
-        client = self._connect()
-        try:
-            if not client.exists(key):
-                raise ResourceNotExistError("'%s' config is not defined" % key)
+    def _stats_name(self):
+        """
+        Return the name of the hash storing the lock statistics.
+        """
+        return "%s:stats" % self._namespace
 
-            value = "1" if locked else ""
-            client.set(self._lock_name(key), value)
-        except RedisError as err:
-            if locked:
-                raise ResourceLockError(err)
-            else:
-                raise ResourceUnlockError(err)
+    def _held_name(self):
+        """
+        Return the name of the hash storing when held locks were acquired.
+        """
+        return "%s:held" % self._namespace
+
+    def _events_name(self):
+        """
+        Return the name of the channel where changes are published, which
+        is the name of the stream keeping the recent changes as well.
+        """
+        return "%s:events" % self._namespace
+
+    def _waiter_prefix(self, name):
+        """
+        Return the prefix of the variables keeping lock waiters alive.
+        """
+        return "%s:waiter:%s:" % (self._namespace, name)
+
+    def _wake_prefix(self, name):
+        """
+        Return the prefix of the lists used to wake up lock waiters.
+        """
+        return "%s:wake:%s:" % (self._namespace, name)
 
-    def push(self, key: str, config: dict):
+    @staticmethod
+    def _check_push_args(key, config):
+        """
+        Raise a ValueError if a configuration can't be pushed.
+        """
         if not key:
             raise ValueError("key is empty")
 
@@ -92,82 +891,947 @@ class RedisResource(Resource):
         if key.endswith(".lock"):
             raise ValueError("key can't end with '.lock' suffix")
 
+    def _push_script_args(self, key, config):
+        """
+        Return keys and arguments of the push script.
+        """
+        keys = [self._config_name(key), self._version_name(key)]
+        args = [config_hash(config), self._events_name(), key]
+
+        if self._blob_threshold is not None:
+            values = dict((str(option), str(value))
+                          for option, value in config.items())
+            size = sum(len(option) + len(value)
+                       for option, value in values.items())
+
+            if size >= self._blob_threshold:
+                args.extend([BLOB_FIELD, encode_config(
+                    values,
+                    codec=self._compression,
+                    threshold=self._compress_threshold)])
+
+                # tags and parents are read by the scripts
+                for option in OWN_OPTIONS:
+                    if option in values:
+                        args.extend([option, values[option]])
+
+                return keys, args
+
+        for option, value in config.items():
+            args.extend([option, value])
+
+        return keys, args
+
+    @staticmethod
+    def _decode_config(reply):
+        """
+        Return a configuration from a HGETALL reply which has not been
+        decoded, or None if configuration doesn't exist. Configurations are
+        stored as a blob, or as one hash field per option.
+        """
+        if not reply:
+            return None
+
+        try:
+            blob = reply.get(BLOB_FIELD.encode(), None)
+            if blob is not None:
+                return decode_config(blob)
+
+            return dict((option.decode(), value.decode())
+                        for option, value in reply.items())
+        except ValueError as err:
+            raise ResourcePullError(err)
+
+    def _resolve_script_args(self, key, mode):
+        """
+        Return the arguments of the resolve script.
+        """
+        return [
+            self._config_name(""),
+            self._version_name(""),
+            EXTENDS_OPTION,
+            key,
+            mode,
+        ]
+
+    def _resolve(self, key, reply):
+        """
+        Return version and options of a configuration merged with its
+        parents, from a reply of the resolve script which has not been
+        decoded, or None if configuration doesn't exist.
+        """
+        stored = dict()
+        for index in range(0, len(reply), 3):
+            name, version, options = reply[index:index + 3]
+            if not options:
+                continue
+
+            if version is not None:
+                version = version.decode()
+
+            stored[name.decode()] = (version, self._decode_config(
+                dict(zip(options[::2], options[1::2]))))
+
+        if key not in stored:
+            return None
+
+        return resolve_config(key, stored.get)
+
+    @property
+    def owner(self) -> str:
+        """
+        Token identifying the owner of the locks acquired by this instance.
+        """
+        return self._owner
+
+    def _lock_ttl_ms(self):
+        """
+        Return the locks TTL in milliseconds.
+        """
+        return int(self._lock_ttl * 1000)
+
+    def _lock_script_args(self, key, blocking):
+        """
+        Return keys and arguments of the lock script.
+        """
+        keys = [
+            self._config_name(key),
+            self._lock_name(key),
+            self._queue_name(key),
+            self._stats_name(),
+            self._held_name(),
+            self._queued_name(key),
+            self._wake_prefix(key) + self._owner,
+        ]
+        args = [
+            self._owner,
+            self._lock_ttl_ms(),
+            "1" if blocking else "0",
+            self._waiter_prefix(key),
+            int(WAIT_POLL_INTERVAL * 3000),
+            key,
+            self._host,
+            os.getpid(),
+            self._session,
+            self._events_name(),
+        ]
+        return keys, args
+
+    def _cancel_script_args(self, key):
+        """
+        Return keys and arguments of the cancel script.
+        """
+        keys = [
+            self._lock_name(key),
+            self._queue_name(key),
+            self._waiter_prefix(key) + self._owner,
+            self._wake_prefix(key) + self._owner,
+            self._queued_name(key),
+        ]
+        args = [self._owner]
+        return keys, args
+
+    def _group_match(self, pattern):
+        """
+        Return the SCAN pattern matching the configurations of a group.
+        """
+        return self._escape_glob(self._config_name("")) + pattern
+
+    def _lock_any_script_args(self, names, tags):
+        """
+        Return keys and arguments of the lock_any script, for a batch of
+        configurations names.
+        """
+        keys = [self._stats_name(), self._held_name()]
+        for name in names:
+            keys.extend([
+                self._config_name(name),
+                self._lock_name(name),
+                self._queue_name(name),
+            ])
+
+        args = [
+            self._owner,
+            self._lock_ttl_ms(),
+            ",".join(tags or []),
+            TAGS_OPTION,
+            self._host,
+            os.getpid(),
+            self._session,
+            self._events_name(),
+        ] + list(names)
+
+        return keys, args
+
+    def _unlock_script_args(self, key, force, stale=False):
+        """
+        Return keys and arguments of the unlock script.
+        """
+        keys = [
+            self._config_name(key),
+            self._lock_name(key),
+            self._queue_name(key),
+            self._stats_name(),
+            self._held_name(),
+            self._queued_name(key),
+        ]
+        args = [
+            self._owner,
+            "1" if force else "0",
+            self._waiter_prefix(key),
+            self._wake_prefix(key),
+            int(WAIT_POLL_INTERVAL * 3000),
+            key,
+            "1" if stale else "0",
+            self._events_name(),
+        ]
+        return keys, args
+
+    def _batches(self, keys):
+        """
+        Split keys in lists of ``batch_size`` items.
+        """
+        keys = iter(keys)
+        while True:
+            batch = list(itertools.islice(keys, self._batch_size))
+            if not batch:
+                break
+
+            yield batch
+
+    def _renew_script_args(self, key):
+        """
+        Return keys and arguments of the renew script.
+        """
+        keys = [self._lock_name(key)]
+        args = [self._owner, self._lock_ttl_ms(), self._events_name(), key]
+        return keys, args
+
+    def _delete_script_args(self, key):
+        """
+        Return keys and arguments of the delete script.
+        """
+        keys = [
+            self._config_name(key),
+            self._lock_name(key),
+            self._queue_name(key),
+            self._queued_name(key),
+            self._version_name(key),
+            self._held_name(),
+        ]
+        args = [key, self._events_name()]
+        return keys, args
+
+    @staticmethod
+    def _event(message):
+        """
+        Return event name, configuration name and lease expiration in
+        seconds of a message published on the events channel.
+        """
+        event, expires, name = message.split(":", 2)
+        expires = int(expires)
+        return event, name, expires / 1000 if expires else None
+
+    @staticmethod
+    def _stream_id(value):
+        """
+        Return a stream entry id as a tuple, so ids can be compared.
+        """
+        milliseconds, _, sequence = value.partition("-")
+        return int(milliseconds), int(sequence or 0)
+
+    @staticmethod
+    def _stream_event(entry):
+        """
+        Return the event of an events stream entry.
+        """
+        event_id, fields = entry
+        expires = int(fields.get("expires", None) or 0)
+        return Event(
+            event_id,
+            fields.get("event", None),
+            fields.get("name", None),
+            expires / 1000 if expires else None)
+
+    @staticmethod
+    def _time_ms(reply):
+        """
+        Return the server time of a TIME reply, in ms.
+        """
+        seconds, microseconds = reply
+        return int(seconds) * 1000 + int(microseconds) // 1000
+
+    @staticmethod
+    def _record_owner(record, now):
+        """
+        Return the owner of a lock from its owner and expires fields, or
+        None if it's not locked or if its lease expired.
+        """
+        owner, expires = record
+        expires = int(expires or 0)
+        if not owner or 0 < expires <= now:
+            return None
+
+        return owner
+
+    def _statuses(self, batch, replies):
+        """
+        Return the configurations status from the replies of a status
+        pipeline, which contains an EXISTS for each key, then an HMGET of
+        the owner and expires fields of each lock and a final TIME.
+        """
+        now = self._time_ms(replies[-1])
+        records = replies[len(batch):-1]
+
+        statuses = dict()
+        for key, exists, record in zip(batch, replies, records):
+            owner = self._record_owner(record, now) if exists else None
+            statuses[key] = ConfigStatus(
+                bool(exists),
+                owner is not None,
+                owner)
+
+        return statuses
+
+    @staticmethod
+    def _locks(reply):
+        """
+        Return the held locks from the reply of the locks script.
+        """
+        now = int(reply[0])
+
+        locks = dict()
+        for name, values in zip(reply[1::2], reply[2::2]):
+            record = dict(zip(values[::2], values[1::2]))
+            acquired = int(record.get("acquired", None) or 0)
+            expires = int(record.get("expires", None) or 0)
+            pid = record.get("pid", None)
+
+            locks[name] = LockInfo(
+                record.get("owner", None),
+                record.get("host", None) or None,
+                int(pid) if pid else None,
+                record.get("session", None) or None,
+                acquired / 1000 if acquired else None,
+                expires / 1000 if expires else None,
+                0 < expires <= now)
+
+        return locks
+
+    @staticmethod
+    def _lock_stats(reply):
+        """
+        Return the lock statistics from the content of the stats hash.
+        """
+        fields = dict()
+        for field, value in reply.items():
+            metric, name = field.split(":", 1)
+            fields.setdefault(name, dict())[metric] = int(value)
+
+        def _histogram(values, metric, buckets):
+            histogram = dict()
+            count = 0
+            for le in buckets:
+                count += values.get("%s_bucket_%d" % (metric, le), 0)
+                histogram[le / 1000] = count
+
+            histogram[float("inf")] = values.get("%s_count" % metric, 0)
+            return histogram
+
+        stats = dict()
+        for name, values in fields.items():
+            stats[name] = LockStats(
+                values.get("acquired", 0),
+                values.get("stale", 0),
+                _histogram(values, "hold", HOLD_BUCKETS),
+                values.get("hold_sum", 0) / 1000,
+                _histogram(values, "wait", WAIT_BUCKETS),
+                values.get("wait_sum", 0) / 1000)
+
+        return stats
+
+
+class RedisResource(RedisNamespace, Resource):
+    """
+    Redis recourse implementation. All the operations share a single
+    connection pool, so the same instance can be used by multiple threads.
+    """
+
+    def __init__(self, **kwargs: dict):
+        """
+        Args:
+            kwargs: ``RedisNamespace`` arguments.
+        """
+        super().__init__(**kwargs)
+        self._pool = None
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._scripts = dict()
+
+    def _connect(self):
+        """
+        Return the Redis client bound to the shared connection pool. The
+        client is created once and sockets are opened on demand.
+        """
+        with self._client_lock:
+            if self._client is not None:
+                return self._client
+
+            try:
+                if self._pool is None:
+                    self._pool = RedisConnectionPool(
+                        host=self._hostname,
+                        port=self._port,
+                        db=self._db,
+                        username=self._username,
+                        password=self._password,
+                        decode_responses=True,
+                        redis_connect_func=register_scripts,
+                        connection_class=RedisConnection,
+                        max_connections=self._max_connections,
+                        timeout=self._pool_timeout,
+                        idle_timeout=self._idle_timeout,
+                        health_check_interval=self._health_check_interval,
+                    )
+
+                self._client = Redis(connection_pool=self._pool)
+
+                # scripts are executed by SHA and loaded by register_scripts
+                for name, src in SCRIPTS.items():
+                    self._scripts[name] = self._client.register_script(src)
+            except RedisError as err:
+                raise ResourceConnectionError(err)
+
+        return self._client
+
+    def close(self):
+        """
+        Close all the connections inside the pool.
+        """
+        with self._client_lock:
+            if self._pool is not None:
+                self._pool.disconnect()
+
+    def push(self, key: str, config: dict) -> bool:
+        self._check_push_args(key, config)
+
+        if not config:
+            raise ResourcePushError("'%s' config is empty" % key)
+
         client = self._connect()
         try:
-            client.hmset(key, config)
-            client.set(
-                self._lock_name(key),
-                ""
-            )
+            keys, args = self._push_script_args(key, config)
+            ret = self._scripts["push"](keys=keys, args=args, client=client)
         except RedisError as err:
             raise ResourcePushError(err)
 
-    def pull(self, key: str) -> dict:
+        return bool(ret)
+
+    def pull(self, key: str, resolve: bool = True) -> dict:
         if not key:
             raise ValueError("key is empty")
 
         client = self._connect()
         config = None
         try:
-            if not client.exists(key):
-                raise ResourceNotExistError("'%s' config is not defined" % key)
-
-            config = client.hgetall(key)
+            # blobs are binary, so replies are decoded by _decode_config
+            if resolve:
+                config = self._resolve(key, client.execute_command(
+                    "EVALSHA",
+                    self._scripts["resolve"].sha,
+                    0,
+                    *self._resolve_script_args(key, "config"),
+                    NEVER_DECODE=True))
+            else:
+                config = self._decode_config(client.execute_command(
+                    "HGETALL", self._config_name(key), NEVER_DECODE=True))
         except RedisError as err:
             raise ResourcePullError(err)
 
+        # an empty hash can't exist inside Redis
+        if not config:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        if resolve:
+            return config[1]
+
         return config
 
-    def lock(self, key: str):
-        self._set_status(key, True)
+    def push_many(self, items) -> dict:
+        client = self._connect()
+        errors = dict()
+        items = iter(items)
 
-    def unlock(self, key: str):
-        self._set_status(key, False)
+        while True:
+            batch = list(itertools.islice(items, self._batch_size))
+            if not batch:
+                break
 
-    def is_locked(self, key: str) -> bool:
+            pushed = []
+            pipe = client.pipeline(transaction=False)
+            for key, config in batch:
+                try:
+                    self._check_push_args(key, config)
+                except ValueError as err:
+                    errors[key] = err
+                    continue
+
+                if not config:
+                    errors[key] = ResourcePushError(
+                        "'%s' config is empty" % key)
+                    continue
+
+                # scripts are already loaded by the connection, so they are
+                # not checked by the pipeline with another round trip
+                keys, args = self._push_script_args(key, config)
+                pipe.evalsha(
+                    self._scripts["push"].sha,
+                    len(keys),
+                    *(keys + args))
+                pushed.append(key)
+
+            if not pushed:
+                continue
+
+            try:
+                replies = pipe.execute(raise_on_error=False)
+            except RedisError as err:
+                # connection has been lost, the whole batch failed
+                for key in pushed:
+                    errors[key] = ResourcePushError(err)
+                continue
+
+            for key, reply in zip(pushed, replies):
+                if isinstance(reply, Exception):
+                    errors[key] = ResourcePushError(reply)
+
+        return errors
+
+    def pull_many(
+            self,
+            keys,
+            resolve: bool = True,
+            errors: dict = None) -> dict:
+        client = self._connect()
+        configs = dict()
+
+        for batch in self._batches(keys):
+            if not all(batch):
+                raise ValueError("key is empty")
+
+            try:
+                pipe = client.pipeline(transaction=False)
+                for key in batch:
+                    if resolve:
+                        pipe.execute_command(
+                            "EVALSHA",
+                            self._scripts["resolve"].sha,
+                            0,
+                            *self._resolve_script_args(key, "config"),
+                            NEVER_DECODE=True)
+                    else:
+                        pipe.execute_command(
+                            "HGETALL",
+                            self._config_name(key),
+                            NEVER_DECODE=True)
+                replies = pipe.execute()
+            except RedisError as err:
+                raise ResourcePullError(err)
+
+            # a configuration which can't be decoded or resolved doesn't
+            # stop the others from being pulled
+            for key, reply in zip(batch, replies):
+                try:
+                    if resolve:
+                        resolved = self._resolve(key, reply)
+                        configs[key] = resolved[1] if resolved else None
+                    else:
+                        configs[key] = self._decode_config(reply)
+                except ResourcePullError as err:
+                    if errors is None:
+                        raise
+
+                    errors[key] = err
+                    configs[key] = None
+
+        return configs
+
+    def version(self, key: str) -> str:
         if not key:
             raise ValueError("key is empty")
 
         client = self._connect()
-        locked = False
         try:
-            if not client.exists(key):
-                raise ResourceNotExistError("'%s' config is not defined" % key)
+            resolved = self._resolve(key, client.execute_command(
+                "EVALSHA",
+                self._scripts["resolve"].sha,
+                0,
+                *self._resolve_script_args(key, "version"),
+                NEVER_DECODE=True))
+        except RedisError as err:
+            raise ResourceConnectionError(err)
 
-            locked = client.get(self._lock_name(key))
+        if not resolved:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        # configurations pushed by older clients don't have any version
+        return resolved[0]
+
+    def _acquire(self, client, key, blocking):
+        """
+        Try to acquire a lock, eventually queueing the owner as a waiter.
+        """
+        keys, args = self._lock_script_args(key, blocking)
+        return self._scripts["lock"](keys=keys, args=args, client=client)
+
+    def _cancel(self, client, key):
+        """
+        Stop waiting for a lock. Return True if lock has been acquired.
+        """
+        keys, args = self._cancel_script_args(key)
+        return self._scripts["cancel"](keys=keys, args=args, client=client)
+
+    def lock(self, key: str, timeout: float = None, blocking: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        try:
+            ret = self._acquire(client, key, blocking)
+
+            while ret == 0 and blocking:
+                wait = WAIT_POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+
+                if wait <= 0:
+                    ret = self._cancel(client, key)
+                    break
+
+                # unlock() hands the lock over to the first waiter and wakes
+                # it up, so waiters don't need to poll the lock variable
+                started = time.monotonic()
+                woken = client.blpop(
+                    [self._wake_prefix(key) + self._owner],
+                    timeout=wait)
+                instrument.count_wait(time.monotonic() - started)
+
+                if woken:
+                    ret = 1
+                    break
+
+                # lock could have expired without being released
+                ret = self._acquire(client, key, blocking)
         except RedisError as err:
-            raise ResourceError(err)
+            raise ResourceLockError(err)
+
+        if ret < 0:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
 
-        return locked
+        if not ret:
+            raise ResourceLockError("'%s' config is already locked" % key)
+
+    def _lock_group(self, client, pattern, tags):
+        """
+        Scan the configurations of a group and lock the first free one.
+        Return the reply of the lock_any script.
+        """
+        prefix = self._config_name("")
+        names = sorted(set(
+            item[len(prefix):] for item in client.scan_iter(
+                match=self._group_match(pattern),
+                count=self._scan_count)))
+
+        matched = False
+        for batch in self._batches(names):
+            keys, args = self._lock_any_script_args(batch, tags)
+            ret = self._scripts["lock_any"](
+                keys=keys,
+                args=args,
+                client=client)
+
+            if ret[0] > 0:
+                return ret
+
+            matched = matched or ret[0] == 0
+
+        return [0] if matched else [-1]
+
+    def lock_any(
+            self,
+            pattern: str = "*",
+            tags: list = None,
+            timeout: float = None,
+            blocking: bool = False) -> str:
+        if not pattern:
+            raise ValueError("pattern is empty")
+
+        client = self._connect()
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        try:
+            while True:
+                ret = self._lock_group(client, pattern, tags)
+                if ret[0] != 0 or not blocking:
+                    break
+
+                # group members can be released by many owners, so waiters
+                # try again periodically
+                wait = WAIT_POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+
+                if wait <= 0:
+                    break
+
+                time.sleep(wait)
+                instrument.count_wait(wait)
+        except RedisError as err:
+            raise ResourceLockError(err)
+
+        if ret[0] < 0:
+            raise ResourceNotExistError(
+                "no configurations are matching '%s'" % pattern)
+
+        if not ret[0]:
+            raise ResourceLockError(
+                "all configurations matching '%s' are locked" % pattern)
+
+        return ret[1]
+
+    def unlock(self, key: str, force: bool = False):
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        try:
+            keys, args = self._unlock_script_args(key, force)
+            ret = self._scripts["unlock"](
+                keys=keys,
+                args=args,
+                client=client)
+        except RedisError as err:
+            raise ResourceUnlockError(err)
+
+        if ret < 0:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        if not ret:
+            raise ResourceUnlockError(
+                "'%s' config is locked by another owner" % key)
+
+    def renew(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
 
-    def keys(self) -> list:
         client = self._connect()
-        data = list()
         try:
-            data = client.keys()
+            keys, args = self._renew_script_args(key)
+            ret = self._scripts["renew"](keys=keys, args=args, client=client)
         except RedisError as err:
             raise ResourceConnectionError(err)
 
-        filtered = [item for item in data if not item.endswith(".lock")]
-        return filtered
+        if not ret:
+            raise ResourceLockError("'%s' config lock has been lost" % key)
 
-    def delete(self, key: str):
+    def is_locked(self, key: str) -> bool:
         if not key:
             raise ValueError("key is empty")
 
         client = self._connect()
         try:
-            if not client.exists(key):
-                raise ResourceNotExistError("'%s' config is not defined" % key)
+            pipe = client.pipeline(transaction=True)
+            pipe.exists(self._config_name(key))
+            pipe.hmget(self._lock_name(key), "owner", "expires")
+            pipe.time()
+            exists, record, now = pipe.execute()
+        except RedisError as err:
+            raise ResourceError(err)
 
-            client.delete(key)
+        if not exists:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
+
+        return self._record_owner(record, self._time_ms(now)) is not None
+
+    def status_many(self, keys) -> dict:
+        client = self._connect()
+        statuses = dict()
+
+        for batch in self._batches(keys):
+            if not all(batch):
+                raise ValueError("key is empty")
+
+            try:
+                pipe = client.pipeline(transaction=False)
+                for key in batch:
+                    pipe.exists(self._config_name(key))
+                for key in batch:
+                    pipe.hmget(self._lock_name(key), "owner", "expires")
+                pipe.time()
+                replies = pipe.execute()
+            except RedisError as err:
+                raise ResourceConnectionError(err)
+
+            statuses.update(self._statuses(batch, replies))
+
+        return statuses
+
+    def locks(self) -> dict:
+        client = self._connect()
+        try:
+            reply = self._scripts["locks"](
+                keys=[self._held_name()],
+                args=[self._lock_name("")],
+                client=client)
         except RedisError as err:
-            raise ResourceDeleteError(err)
-        finally:
-            # always try to delete the locking variable
+            raise ResourceConnectionError(err)
+
+        return self._locks(reply)
+
+    def break_stale(self) -> list:
+        stale = [name for name, info in self.locks().items()
+                 if info.stale]
+        if not stale:
+            return []
+
+        client = self._connect()
+        sha = self._scripts["unlock"].sha
+        try:
+            # locks are released only if they are still stale
+            pipe = client.pipeline(transaction=False)
+            for name in stale:
+                keys, args = self._unlock_script_args(name, True, stale=True)
+                pipe.evalsha(sha, len(keys), *(keys + args))
+            replies = pipe.execute()
+        except RedisError as err:
+            raise ResourceUnlockError(err)
+
+        return [name for name, ret in zip(stale, replies) if ret == 1]
+
+    def lock_stats(self) -> dict:
+        client = self._connect()
+        try:
+            reply = client.hgetall(self._stats_name())
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+        return self._lock_stats(reply)
+
+    def subscribe(self, callback):
+        client = self._connect()
+
+        def _handler(message):
+            callback(*self._event(message["data"]))
+
+        def _error(err, pubsub, thread):
+            # pylint: disable=unused-argument
+            # subscription is restored by the next read, but messages
+            # published in the meantime are lost
+            callback("reset", None, None)
+            time.sleep(WAIT_POLL_INTERVAL)
+
+        pubsub = client.pubsub()
+        try:
+            pubsub.subscribe(**{self._events_name(): _handler})
+
+            # events are not lost after returning, since subscription is
+            # confirmed before starting the listener thread
+            message = pubsub.get_message(timeout=self._pool_timeout)
+            if not message or message["type"] != "subscribe":
+                raise ResourceConnectionError("subscription not confirmed")
+
+            thread = pubsub.run_in_thread(
+                sleep_time=WAIT_POLL_INTERVAL,
+                daemon=True,
+                exception_handler=_error)
+        except RedisError as err:
+            pubsub.close()
+            raise ResourceConnectionError(err)
+
+        return RedisSubscription(thread)
+
+    def watch(
+            self,
+            pattern: str = "*",
+            since: str = None,
+            timeout: float = None):
+        client = self._connect()
+        stream = self._events_name()
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        try:
+            if since is None:
+                last = client.xrevrange(stream, count=1)
+                since = last[0][0] if last else "0-0"
+            else:
+                # events following the last received one could have been
+                # trimmed from the stream
+                first = client.xrange(stream, count=1)
+                if first and self._stream_id(since) < \
+                        self._stream_id(first[0][0]):
+                    yield Event(None, "reset", None, None)
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+        while True:
+            block = WAIT_POLL_INTERVAL
+            if deadline is not None:
+                block = min(block, deadline - time.monotonic())
+                if block <= 0:
+                    break
+
+            # a blocking read returns as soon as new events are added
             try:
-                lock_name = self._lock_name(key)
-                if client.exists(lock_name):
-                    client.delete(lock_name)
+                reply = client.xread(
+                    {stream: since},
+                    count=self._scan_count,
+                    block=max(1, int(block * 1000)))
             except RedisError as err:
-                raise ResourceDeleteError(err)
+                raise ResourceConnectionError(err)
+
+            for _, entries in reply or []:
+                for entry in entries:
+                    event = self._stream_event(entry)
+                    since = event.id
+
+                    if event.name and fnmatch.fnmatchcase(event.name, pattern):
+                        yield event
+
+    def iter_keys(self, count: int = None):
+        client = self._connect()
+        prefix = self._config_name("")
+        match = self._escape_glob(prefix) + "*"
+
+        try:
+            for item in client.scan_iter(
+                    match=match,
+                    count=count or self._scan_count):
+                yield item[len(prefix):]
+        except RedisError as err:
+            raise ResourceConnectionError(err)
+
+    def delete(self, key: str):
+        if not key:
+            raise ValueError("key is empty")
+
+        client = self._connect()
+        try:
+            # always delete the locking variable
+            keys, args = self._delete_script_args(key)
+            deleted = self._scripts["delete"](
+                keys=keys,
+                args=args,
+                client=client)
+        except RedisError as err:
+            raise ResourceDeleteError(err)
+
+        if not deleted:
+            raise ResourceNotExistError("'%s' config is not defined" % key)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the resource backends. A backend is selected by the scheme of an
+URL, such as "redis://localhost:6379/0", and it's imported only when it's
+used, so unused backends don't slow down the startup.
+
+External packages can provide their own backends by registering a
+``Resource`` implementation inside the ``cdist.backends`` entry points group,
+using the URL scheme as entry point name:
+
+    entry_points={
+        'cdist.backends': [
+            'myscheme = mypackage.module:MyResource',
+        ]
+    }
+
+Builtin backends are not registered as entry points and they always take
+precedence, so an external package can't replace the "redis", "file" and
+"memory" schemes.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import importlib
+from urllib.parse import urlparse
+from cdist.resource import ResourceError
+
+# entry points group of the resource backends
+ENTRY_POINTS_GROUP = "cdist.backends"
+
+# backends shipped with cdist, by URL scheme
+BUILTIN_BACKENDS = dict(
+    redis="cdist.redis:RedisResource",
+    file="cdist.file:FileResource",
+    memory="cdist.memory:MemoryResource",
+)
+
+
+def _entry_points():
+    """
+    Return the entry points of the resource backends, by name.
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return dict(
+            (point.name, point)
+            for point in pkg_resources.iter_entry_points(ENTRY_POINTS_GROUP))
+
+    points = entry_points()
+    if hasattr(points, "select"):
+        points = points.select(group=ENTRY_POINTS_GROUP)
+    else:
+        points = points.get(ENTRY_POINTS_GROUP, [])
+
+    return dict((point.name, point) for point in points)
+
+
+def get_backend(scheme: str):
+    """
+    Return the resource class handling an URL scheme. Builtin backends are
+    looked up first, then the installed entry points.
+
+    Args:
+        scheme (str): URL scheme of the backend.
+
+    Returns:
+        class: ``Resource`` implementation.
+
+    Raises:
+        ResourceError: if backend is not available.
+    """
+    target = BUILTIN_BACKENDS.get(scheme, None)
+    if target is not None:
+        module, name = target.split(":")
+        return getattr(importlib.import_module(module), name)
+
+    point = _entry_points().get(scheme, None)
+    if point is None:
+        raise ResourceError("'%s' backend is not available" % scheme)
+
+    return point.load()
+
+
+def redact_url(url: str) -> str:
+    """
+    Return an URL without its password, so it can be shown to the user.
+    """
+    parsed = urlparse(url)
+    if not parsed.password:
+        return url
+
+    netloc = parsed.netloc.rsplit("@", 1)
+    credentials = netloc[0].split(":", 1)[0]
+    return parsed._replace(
+        netloc="%s:***@%s" % (credentials, netloc[1])).geturl()
+
+
+def from_url(url: str, **kwargs: dict):
+    """
+    Create a resource from an URL.
+
+    Args:
+        url (str): URL of the resource, i.e. "redis://localhost:6379/0".
+        kwargs: arguments of the resource which are not defined by the URL.
+
+    Returns:
+        Resource: resource handling the URL.
+
+    Raises:
+        ValueError: if URL is empty or it doesn't have a scheme.
+        ResourceError: if backend is not available.
+    """
+    if not url:
+        raise ValueError("url is empty")
+
+    scheme = urlparse(url).scheme
+    if not scheme:
+        raise ValueError("'%s' url doesn't have a scheme" % url)
+
+    return get_backend(scheme).from_url(url, **kwargs)
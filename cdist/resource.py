@@ -6,6 +6,160 @@ configurations for the pytest framework. I.e. a database.
 Author:
     Andrea Cervesato <andrea.cervesato@mailbox.org>
 """
+import json
+import time
+import queue
+import fnmatch
+import hashlib
+from collections import namedtuple
+from cdist.instrument import instrument_class
+
+# configuration option listing the tags of a configuration
+TAGS_OPTION = "cdist_tags"
+
+# configuration option listing the configurations inherited by a
+# configuration
+EXTENDS_OPTION = "cdist_extends"
+
+# options describing a configuration itself, which are never inherited
+OWN_OPTIONS = (TAGS_OPTION, EXTENDS_OPTION)
+
+# status of a pytest configuration stored inside a resource
+ConfigStatus = namedtuple("ConfigStatus", ["exists", "locked", "owner"])
+
+# record of a held lock. ``host``, ``pid`` and ``session`` describe the
+# owner, when they are known by the resource. ``acquired`` and ``expires`` are
+# seconds since the epoch, ``expires`` is None if lock never expires. A stale
+# lock is a lock whose lease expired before it has been released
+LockInfo = namedtuple(
+    "LockInfo",
+    ["owner", "host", "pid", "session", "acquired", "expires", "stale"])
+
+# lock statistics of a pytest configuration. ``hold`` and ``wait`` are
+# histograms of the lock hold and wait times: dictionaries of cumulative
+# counts by upper bound in seconds, including ``float("inf")``. Their sums
+# are in seconds as well
+LockStats = namedtuple(
+    "LockStats",
+    ["acquired", "stale", "hold", "hold_sum", "wait", "wait_sum"])
+
+# change of a configuration or of its lock, as notified by ``subscribe``.
+# ``id`` identifies the event inside the resource history and it's None if
+# resource doesn't keep any history. ``expires`` is the lock lease
+# expiration in seconds since the epoch
+Event = namedtuple("Event", ["id", "kind", "name", "expires"])
+
+
+def config_hash(config: dict) -> str:
+    """
+    Return the hash of a pytest configuration content, used as configuration
+    version. Options order doesn't change the hash.
+
+    Args:
+        config (dict): dictionary representing a pytest configuration.
+
+    Returns:
+        str: hexadecimal hash of the configuration.
+    """
+    options = dict(
+        (str(option), str(value)) for option, value in config.items())
+    data = json.dumps(
+        options,
+        sort_keys=True,
+        separators=(",", ":"))
+
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def config_parents(config: dict) -> list:
+    """
+    Return the names of the configurations inherited by a pytest
+    configuration, which are listed by its comma separated ``cdist_extends``
+    option.
+
+    Args:
+        config (dict): dictionary representing a pytest configuration.
+
+    Returns:
+        list: names of the inherited configurations, in merge order.
+    """
+    return str(config.get(EXTENDS_OPTION, "")).replace(",", " ").split()
+
+
+def resolve_config(key: str, read) -> tuple:
+    """
+    Merge a pytest configuration with the configurations it inherits from.
+    Parents are merged in the order they are listed, so the last parent wins,
+    and the configuration options override the inherited ones. Parents can
+    inherit from other configurations as well, but tags and parents are never
+    inherited.
+
+    The version of a configuration without parents is its stored version.
+    Otherwise it's the hash of the versions of all the merged configurations,
+    so it changes as soon as one of them is pushed again.
+
+    Args:
+        key (str): tag associated to a pytest configuration.
+        read (callable): return the ``(version, config)`` tuple stored for a
+            configuration name, or None if configuration doesn't exist.
+
+    Returns:
+        tuple: ``(version, config)`` of the merged configuration. Version is
+            None if the version of one of the merged configurations is not
+            known.
+
+    Raises:
+        ResourceNotExistError: if configuration doesn't exist.
+        ResourceInheritanceError: if an inherited configuration doesn't
+            exist, or if a configuration inherits from itself.
+    """
+    resolved = dict()
+
+    def _resolve(name, path):
+        if name in path:
+            raise ResourceInheritanceError(
+                "'%s' config inherits from itself" % name)
+
+        if name in resolved:
+            return resolved[name]
+
+        stored = read(name)
+        if stored is None:
+            if not path:
+                raise ResourceNotExistError(
+                    "'%s' config is not defined" % name)
+
+            raise ResourceInheritanceError(
+                "'%s' config extends '%s', which is not defined" %
+                (path[-1], name))
+
+        version, config = stored
+        parents = config_parents(config)
+        if not parents:
+            resolved[name] = (version, dict(config))
+            return resolved[name]
+
+        versions = [version]
+        merged = dict()
+        for parent in parents:
+            parent_version, parent_config = _resolve(parent, path + [name])
+            versions.append(parent_version)
+            merged.update((option, value)
+                          for option, value in parent_config.items()
+                          if option not in OWN_OPTIONS)
+
+        merged.update(config)
+
+        if None in versions:
+            version = None
+        else:
+            version = hashlib.sha256(
+                ":".join(versions).encode()).hexdigest()
+
+        resolved[name] = (version, merged)
+        return resolved[name]
+
+    return _resolve(key, [])
 
 
 class ResourceError(Exception):
@@ -44,6 +198,13 @@ class ResourceUnlockError(ResourceError):
     """
 
 
+class ResourceInheritanceError(ResourcePullError):
+    """
+    Raised when the configurations inherited by a configuration can't be
+    resolved.
+    """
+
+
 class ResourceNotExistError(ResourceError):
     """
     Raised when an external resource doesn't have a requested configuration.
@@ -61,16 +222,50 @@ class Resource:
     A generic class to handle multiple pytest configurations via external
     resource. This is the case of a server which stores various pytest
     configurations.
+
+    Operations of the implementations are reported to the listeners of
+    ``cdist.instrument``.
     """
 
-    def push(self, key: str, config: dict):
+    # True if locks are released as soon as the process which acquired them
+    # exits, so they can't be held by short lived processes
+    process_locks = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument_class(cls)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: dict):
         """
-        Push a pytest configuration tagging it with a specific key.
+        Create a resource from an URL. See ``cdist.registry.from_url``.
+
+        Args:
+            url (str): URL of the resource.
+            kwargs: arguments of the resource which are not defined by the
+                URL.
+
+        Returns:
+            Resource: resource handling the URL.
+
+        Raises:
+            ValueError: if URL is not valid.
+        """
+        return cls(**kwargs)
+
+    def push(self, key: str, config: dict) -> bool:
+        """
+        Push a pytest configuration tagging it with a specific key. Options
+        which are not defined inside ``config`` are removed from the stored
+        configuration. Configuration lock is not changed.
 
         Args:
             key (str): tag associated to ``config``.
             config (dict): dictionary representing a pytest configuration.
 
+        Returns:
+            bool: False if the stored configuration was already the same.
+
         Raises:
             ValueError: if one of the parameters is None or empty.
             ResourceConnectionError: if connection failed.
@@ -78,12 +273,16 @@ class Resource:
         """
         raise NotImplementedError()
 
-    def pull(self, key: str) -> dict:
+    def pull(self, key: str, resolve: bool = True) -> dict:
         """
-        Pull a pytest configuration tagged with a specific key.
+        Pull a pytest configuration tagged with a specific key. The
+        configurations listed by its ``cdist_extends`` option are merged
+        inside it. See ``resolve_config``.
 
         Args:
             key (str): tag associated to a pytest configuration.
+            resolve (bool): merge the inherited configurations. If False,
+                the configuration is returned as it has been pushed.
 
         Returns:
             dict: dictionary representing a pytest configuration.
@@ -91,40 +290,218 @@ class Resource:
         Raises:
             ValueError: if one of the parameters is None or empty.
             ResourceConnectionError: if connection failed.
+            ResourceNotExistError: if configuration doesn't exist.
             ResourcePullError: if pull failed.
+            ResourceInheritanceError: if an inherited configuration can't
+                be resolved.
         """
         raise NotImplementedError()
 
-    def lock(self, key: str):
+    def push_many(self, items) -> dict:
+        """
+        Push many pytest configurations. A failing configuration doesn't stop
+        the others from being pushed.
+
+        Args:
+            items (iterable): ``(key, config)`` tuples, where ``config`` is a
+                dictionary representing a pytest configuration.
+
+        Returns:
+            dict: errors of the configurations which have not been pushed,
+                by key. Empty if all configurations have been pushed.
+        """
+        errors = dict()
+        for key, config in items:
+            try:
+                self.push(key, config)
+            except (ValueError, ResourceError) as err:
+                errors[key] = err
+
+        return errors
+
+    def pull_many(
+            self,
+            keys,
+            resolve: bool = True,
+            errors: dict = None) -> dict:
+        """
+        Pull many pytest configurations. See ``pull``.
+
+        Args:
+            keys (iterable): tags associated to pytest configurations.
+            resolve (bool): merge the inherited configurations.
+            errors (dict): if given, errors of the configurations which
+                can't be pulled are stored inside it by key, instead of
+                being raised, and the other configurations are returned.
+
+        Returns:
+            dict: dictionaries representing pytest configurations, by key.
+                Configurations which don't exist, or which are stored inside
+                ``errors``, are None.
+
+        Raises:
+            ValueError: if one of the keys is None or empty.
+            ResourceConnectionError: if connection failed.
+            ResourcePullError: if pull failed, or if a configuration can't
+                be pulled and ``errors`` is not given.
+        """
+        configs = dict()
+        for key in keys:
+            try:
+                configs[key] = self.pull(key, resolve=resolve)
+            except ResourceNotExistError:
+                configs[key] = None
+            except ResourcePullError as err:
+                if errors is None:
+                    raise
+
+                errors[key] = err
+                configs[key] = None
+
+        return configs
+
+    def version(self, key: str) -> str:
+        """
+        Return the version of a pytest configuration. Version changes every
+        time configuration, or one of the configurations it inherits from, is
+        pushed, so it can be used to validate local copies of the
+        configuration without pulling it.
+
+        Args:
+            key (str): tag associated to a pytest configuration.
+
+        Returns:
+            str: configuration version, or None if resource doesn't keep
+                track of versions.
+
+        Raises:
+            ValueError: if one of the parameters is None or empty.
+            ResourceConnectionError: if connection failed.
+            ResourceNotExistError: if configuration doesn't exist.
+            ResourceInheritanceError: if an inherited configuration can't
+                be resolved.
+        """
+        if not key:
+            raise ValueError("key is empty")
+
+        return None
+
+    def lock(self, key: str, timeout: float = None, blocking: bool = False):
         """
-        Lock a pytest configuration tagged with a specific key.
+        Lock a pytest configuration tagged with a specific key. Lock is
+        acquired atomically and it's owned by the resource instance which
+        acquired it. Locking again an owned configuration renews the lock.
+        When ``blocking`` is True, waiters are served in arrival order.
 
         Args:
             key (str): tag associated to a pytest configuration.
+            timeout (float): when blocking, maximum seconds to wait for the
+                lock. None to wait forever.
+            blocking (bool): wait until configuration is unlocked.
 
         Raises:
             ValueError: if one of the parameters is None or empty.
             ResourceConnectionError: if connection failed.
-            ResourceLockError: if lock failed.
+            ResourceLockError: if lock failed or configuration is locked.
             ResourceNotExistError: if configuration doesn't exist.
         """
         raise NotImplementedError()
 
-    def unlock(self, key: str):
+    def lock_any(
+            self,
+            pattern: str = "*",
+            tags: list = None,
+            timeout: float = None,
+            blocking: bool = False) -> str:
         """
-        Unlock a pytest configuration tagged with a specific key.
+        Lock the first free pytest configuration of a group. A group is
+        defined by a glob pattern matching configurations names and by a list
+        of tags, which must be all defined inside the comma separated
+        ``cdist_tags`` option of the configuration.
+
+        Args:
+            pattern (str): glob pattern matching configurations names.
+            tags (list): tags which must be defined by the configuration.
+            timeout (float): when blocking, maximum seconds to wait for a
+                free configuration. None to wait forever.
+            blocking (bool): wait until a configuration is unlocked.
+
+        Returns:
+            str: the name of the locked configuration.
+
+        Raises:
+            ValueError: if one of the parameters is None or empty.
+            ResourceConnectionError: if connection failed.
+            ResourceLockError: if lock failed or all configurations are
+                locked.
+            ResourceNotExistError: if no configurations are matching.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        while True:
+            matched = False
+            for key in sorted(self.iter_keys()):
+                if not fnmatch.fnmatchcase(key, pattern):
+                    continue
+
+                if tags:
+                    value = self.pull(key).get(TAGS_OPTION, "")
+                    if not set(tags).issubset(value.replace(",", " ").split()):
+                        continue
+
+                matched = True
+                try:
+                    self.lock(key)
+                    return key
+                except (ResourceLockError, ResourceNotExistError):
+                    continue
+
+            if not matched:
+                raise ResourceNotExistError(
+                    "no configurations are matching '%s'" % pattern)
+
+            if not blocking or \
+                    (deadline is not None and time.monotonic() >= deadline):
+                raise ResourceLockError(
+                    "all configurations matching '%s' are locked" % pattern)
+
+            time.sleep(1)
+
+    def unlock(self, key: str, force: bool = False):
+        """
+        Unlock a pytest configuration tagged with a specific key. Only the
+        lock owner can unlock a configuration, unless ``force`` is True.
 
         Args:
             key (str): tag associated to a pytest configuration.
+            force (bool): unlock configuration even if it's locked by others.
 
         Raises:
             ValueError: if one of the parameters is None or empty.
             ResourceConnectionError: if connection failed.
-            ResourceUnlockError: if unlock failed.
+            ResourceUnlockError: if unlock failed or configuration is locked
+                by others.
             ResourceNotExistError: if configuration doesn't exist.
         """
         raise NotImplementedError()
 
+    def renew(self, key: str):
+        """
+        Extend the lease of a lock owned by the resource instance, so it
+        doesn't expire.
+
+        Args:
+            key (str): tag associated to a pytest configuration.
+
+        Raises:
+            ValueError: if one of the parameters is None or empty.
+            ResourceConnectionError: if connection failed.
+            ResourceLockError: if lock is not owned anymore.
+        """
+        raise NotImplementedError()
+
     def is_locked(self, key: str) -> bool:
         """
         Check if a pytest configuration is locked.
@@ -142,6 +519,187 @@ class Resource:
         """
         raise NotImplementedError()
 
+    def status_many(self, keys) -> dict:
+        """
+        Fetch the status of many pytest configurations at once.
+
+        Args:
+            keys (iterable): tags associated to pytest configurations.
+
+        Returns:
+            dict: a ``ConfigStatus`` for each key, telling if configuration
+                exists, if it's locked and who is the lock owner.
+
+        Raises:
+            ResourceConnectionError: if connection failed.
+        """
+        statuses = dict()
+        for key in keys:
+            try:
+                locked = self.is_locked(key)
+                statuses[key] = ConfigStatus(True, locked, None)
+            except ResourceNotExistError:
+                statuses[key] = ConfigStatus(False, False, None)
+
+        return statuses
+
+    def locks(self) -> dict:
+        """
+        Return the records of the held locks, including the stale ones.
+
+        Returns:
+            dict: a ``LockInfo`` for each locked configuration.
+
+        Raises:
+            ResourceConnectionError: if connection failed.
+        """
+        locks = dict()
+        for key, status in self.status_many(self.keys()).items():
+            if status.locked:
+                locks[key] = LockInfo(
+                    status.owner, None, None, None, None, None, False)
+
+        return locks
+
+    def break_stale(self) -> list:
+        """
+        Release the stale locks, whose lease expired before their owner
+        released them. Resources which release stale locks by themselves
+        don't have anything to break.
+
+        Returns:
+            list: names of the configurations which have been released.
+
+        Raises:
+            ResourceConnectionError: if connection failed.
+            ResourceUnlockError: if unlock failed.
+        """
+        return []
+
+    def lock_stats(self) -> dict:
+        """
+        Return the lock statistics collected by the resource, such as the
+        number of acquisitions and the lock hold and wait times.
+
+        Returns:
+            dict: a ``LockStats`` for each configuration which has been
+                locked at least once.
+
+        Raises:
+            NotImplementedError: if resource doesn't collect statistics.
+            ResourceConnectionError: if connection failed.
+        """
+        raise NotImplementedError()
+
+    def subscribe(self, callback):
+        """
+        Subscribe to the changes of configurations and locks, including the
+        ones done by other clients. ``callback`` is called with the event
+        name, the configuration name and the lock lease expiration, as soon
+        as a change happens. It can be called by a background thread and it
+        must not raise exceptions. Events are:
+
+        - "push": configuration has been pushed with a new content
+        - "lock": configuration has been locked. Lease expiration is in
+          seconds since the epoch, or None if lock never expires
+        - "renew": lease of a configuration lock has been extended by its
+          owner, with the new lease expiration
+        - "unlock": configuration lock has been released
+        - "delete": configuration has been deleted
+        - "reset": events could have been lost, configuration name is None
+          and cached states must be read again
+
+        Args:
+            callback (callable): function receiving the events.
+
+        Returns:
+            object: subscription, which is cancelled by its ``close`` method.
+
+        Raises:
+            NotImplementedError: if resource doesn't notify its changes.
+            ResourceConnectionError: if connection failed.
+        """
+        raise NotImplementedError()
+
+    def watch(
+            self,
+            pattern: str = "*",
+            since: str = None,
+            timeout: float = None):
+        """
+        Iterate over the changes of the configurations matching a pattern,
+        as soon as they happen. Changes are the ones notified by
+        ``subscribe``, except the lock renewals, starting from the first
+        iteration. Resources keeping
+        the events history can resume watching after the last received
+        event, so nothing is lost across disconnections.
+
+        Args:
+            pattern (str): glob pattern of the configuration names.
+            since (str): id of the last received event. Watching is resumed
+                after it. None to receive new events only.
+            timeout (float): seconds after which watching stops. None to
+                watch forever.
+
+        Returns:
+            generator(Event): the changes.
+
+        Raises:
+            NotImplementedError: if resource doesn't notify its changes, or
+                if ``since`` is given and resource doesn't keep any history.
+            ResourceConnectionError: if connection failed.
+        """
+        if since is not None:
+            raise NotImplementedError(
+                "resource doesn't keep the events history")
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        events = queue.Queue()
+        subscription = self.subscribe(
+            lambda kind, name, expires: events.put(
+                Event(None, kind, name, expires)))
+        try:
+            while True:
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        break
+
+                try:
+                    event = events.get(timeout=wait)
+                except queue.Empty:
+                    break
+
+                if event.kind == "renew":
+                    continue
+
+                if event.name is None or \
+                        fnmatch.fnmatchcase(event.name, pattern):
+                    yield event
+        finally:
+            subscription.close()
+
+    def iter_keys(self, count: int = None):
+        """
+        Iterate over the available configurations. Keys are fetched
+        incrementally from the resource, so they can be processed as soon as
+        they arrive.
+
+        Args:
+            count (int): hint on the number of keys fetched at each step.
+
+        Returns:
+            generator(str): strings rapresenting available configurations.
+
+        Raises:
+            ResourceConnectionError: if connection failed.
+        """
+        raise NotImplementedError()
+
     def keys(self) -> list:
         """
         Fetch the list of available configurations.
@@ -152,7 +710,7 @@ class Resource:
         Raises:
             ResourceConnectionError: if connection failed.
         """
-        raise NotImplementedError()
+        return list(self.iter_keys())
 
     def delete(self, key: str):
         """
@@ -167,3 +725,148 @@ class Resource:
             ResourceDeleteError: if configuration can't be deleted.
         """
         raise NotImplementedError()
+
+
+class AsyncResource:
+    """
+    Asynchronous counterpart of ``Resource``, to handle pytest configurations
+    from an asyncio event loop. Methods have the same arguments, return values
+    and errors of the ``Resource`` ones, but they are coroutines.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument_class(cls)
+
+    async def push(self, key: str, config: dict) -> bool:
+        """
+        Push a pytest configuration. See ``Resource.push``.
+        """
+        raise NotImplementedError()
+
+    async def pull(self, key: str, resolve: bool = True) -> dict:
+        """
+        Pull a pytest configuration. See ``Resource.pull``.
+        """
+        raise NotImplementedError()
+
+    async def version(self, key: str) -> str:
+        """
+        Return the version of a pytest configuration. See
+        ``Resource.version``.
+        """
+        if not key:
+            raise ValueError("key is empty")
+
+        return None
+
+    async def lock(
+            self,
+            key: str,
+            timeout: float = None,
+            blocking: bool = False):
+        """
+        Lock a pytest configuration. Waiting for a locked configuration
+        suspends the coroutine only. See ``Resource.lock``.
+        """
+        raise NotImplementedError()
+
+    async def lock_any(
+            self,
+            pattern: str = "*",
+            tags: list = None,
+            timeout: float = None,
+            blocking: bool = False) -> str:
+        """
+        Lock the first free pytest configuration of a group. See
+        ``Resource.lock_any``.
+        """
+        raise NotImplementedError()
+
+    async def unlock(self, key: str, force: bool = False):
+        """
+        Unlock a pytest configuration. See ``Resource.unlock``.
+        """
+        raise NotImplementedError()
+
+    async def renew(self, key: str):
+        """
+        Extend the lease of an owned lock. See ``Resource.renew``.
+        """
+        raise NotImplementedError()
+
+    async def is_locked(self, key: str) -> bool:
+        """
+        Check if a pytest configuration is locked. See
+        ``Resource.is_locked``.
+        """
+        raise NotImplementedError()
+
+    async def status_many(self, keys) -> dict:
+        """
+        Fetch the status of many pytest configurations at once. See
+        ``Resource.status_many``.
+        """
+        statuses = dict()
+        for key in keys:
+            try:
+                locked = await self.is_locked(key)
+                statuses[key] = ConfigStatus(True, locked, None)
+            except ResourceNotExistError:
+                statuses[key] = ConfigStatus(False, False, None)
+
+        return statuses
+
+    async def locks(self) -> dict:
+        """
+        Return the records of the held locks. See ``Resource.locks``.
+        """
+        locks = dict()
+        statuses = await self.status_many(await self.keys())
+        for key, status in statuses.items():
+            if status.locked:
+                locks[key] = LockInfo(
+                    status.owner, None, None, None, None, None, False)
+
+        return locks
+
+    async def break_stale(self) -> list:
+        """
+        Release the stale locks. See ``Resource.break_stale``.
+        """
+        return []
+
+    async def lock_stats(self) -> dict:
+        """
+        Return the lock statistics collected by the resource. See
+        ``Resource.lock_stats``.
+        """
+        raise NotImplementedError()
+
+    def iter_keys(self, count: int = None):
+        """
+        Iterate over the available configurations with ``async for``. See
+        ``Resource.iter_keys``.
+
+        Returns:
+            async generator(str): strings rapresenting available
+                configurations.
+        """
+        raise NotImplementedError()
+
+    async def keys(self) -> list:
+        """
+        Fetch the list of available configurations. See ``Resource.keys``.
+        """
+        return [key async for key in self.iter_keys()]
+
+    async def delete(self, key: str):
+        """
+        Delete a pytest configuration. See ``Resource.delete``.
+        """
+        raise NotImplementedError()
+
+
+# default implementations are reported to the listeners as well
+instrument_class(Resource)
+instrument_class(AsyncResource)
@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""
+cdist session handling: the plugin object locking and fetching the requested
+configuration, renewing its lock and releasing it when the session finishes.
+It's imported by the cdist plugin only when a configuration has been
+requested.
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import json
+import warnings
+import threading
+from collections import namedtuple
+import pytest
+from cdist import __version__
+from cdist import instrument
+from cdist.cache import ConfigCache
+from cdist.registry import from_url
+from cdist.registry import redact_url
+from cdist.resource import ResourceError
+from cdist.resource import ResourceLockError
+
+
+class Heartbeat(threading.Thread):
+    """
+    Background thread renewing the configuration lock lease while the
+    session is alive.
+    """
+
+    def __init__(self, client, key, interval):
+        super().__init__(name="cdist-heartbeat", daemon=True)
+        self._client = client
+        self._key = key
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self.error = None
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                self._client.renew(self._key)
+            except ResourceLockError as err:
+                # lock is lost, there's nothing to renew anymore
+                self.error = err
+                break
+            except ResourceError as err:
+                # temporary failure, retry at the next beat
+                self.error = err
+            else:
+                self.error = None
+
+    def stop(self):
+        """
+        Stop renewing the lock lease.
+        """
+        self._stop_event.set()
+        self.join()
+
+
+# resources acquired by the prefetch and the fetched configuration
+Prefetched = namedtuple(
+    "Prefetched",
+    ["client", "config_name", "locked", "heartbeat", "config", "warning"])
+
+
+class Prefetch(threading.Thread):
+    """
+    Background thread connecting to the resource, locking and fetching the
+    configuration while pytest is still starting up. If nobody waits for its
+    result anymore, acquired resources are released as soon as the fetch
+    completes.
+    """
+
+    def __init__(self, fetch, release):
+        super().__init__(name="cdist-prefetch", daemon=True)
+        self._fetch = fetch
+        self._release = release
+        self._mutex = threading.Lock()
+        self._done = False
+        self._abandoned = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        result = None
+        error = None
+        try:
+            result = self._fetch()
+        except Exception as err:  # pylint: disable=broad-except
+            error = err
+
+        with self._mutex:
+            self._done = True
+            if not self._abandoned:
+                self.result = result
+                self.error = error
+                return
+
+        if result is not None:
+            self._release(result)
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait for the fetch to complete. If it doesn't complete in time, the
+        prefetch is abandoned and its resources will be released.
+
+        Args:
+            timeout (float): seconds to wait. None waits forever.
+
+        Returns:
+            bool: True if fetch completed, False if it's been abandoned.
+        """
+        self.join(timeout)
+
+        with self._mutex:
+            if not self._done:
+                self._abandoned = True
+
+            return self._done
+
+
+class Plugin:
+    """
+    cdist plugin definition, handling client and pytest hooks.
+    """
+
+    def __init__(self):
+        self._prefetch = None
+        self._fetched = None
+        self._config_name = None
+        self._config = None
+        self._listener = None
+        self._operations = list()
+
+    @staticmethod
+    def _get_autolock(config):
+        """
+        Return autolock parameter.
+        """
+        autolock = config.getini("cdist_autolock").lower() == "true"
+        return autolock
+
+    @staticmethod
+    def _get_url(config):
+        """
+        Return the URL of the resource.
+        """
+        url = config.getini("cdist_url")
+        if not url:
+            url = "redis://%s:%s" % (
+                config.getini("cdist_hostname"),
+                config.getini("cdist_port"))
+
+        return url
+
+    @staticmethod
+    def _get_tags(config):
+        """
+        Return the list of tags defining a configurations group.
+        """
+        tags = config.option.cdist_tags.replace(",", " ").split()
+        return tags
+
+    @staticmethod
+    def _get_cache(config, prefix):
+        """
+        Return the local cache of configurations, or None if it's disabled.
+        """
+        if config.getini("cdist_cache").lower() != "true":
+            return None
+
+        if getattr(config, "cache", None) is None:
+            return None
+
+        max_age = float(config.getini("cdist_cache_max_age"))
+        return ConfigCache(config.cache, prefix, max_age=max_age)
+
+    @staticmethod
+    def _is_worker(config):
+        """
+        True if session is running inside a pytest-xdist worker.
+        """
+        return hasattr(config, "workerinput")
+
+    def _is_active(self, config):
+        """
+        True if a configuration or a configurations group has been requested.
+        """
+        return bool(config.option.cdist_config or self._get_tags(config))
+
+    def _is_group(self, config):
+        """
+        True if a configurations group has been requested.
+        """
+        config_name = config.option.cdist_config
+        if any(char in config_name for char in "*?["):
+            return True
+
+        return bool(self._get_tags(config))
+
+    def pytest_report_header(self, config):
+        """
+        Create the plugin report to be shown during the session.
+        """
+        if not self._is_active(config):
+            return None
+
+        # configuration of a group is known after it has been locked
+        config_name = self._config_name or config.option.cdist_config
+
+        # fetch configuration data
+        url = self._get_url(config)
+        autolock = self._get_autolock(config)
+
+        # create report lines
+        lines = list()
+        lines.append(
+            "cdist %s -- resource: %s, configuration: %s, autolock: %s" %
+            (__version__, redact_url(url), config_name, autolock))
+
+        if self._is_group(config):
+            lines.append("cdist group -- pattern: %s, tags: %s" % (
+                config.option.cdist_config or "*",
+                ",".join(self._get_tags(config)) or "none"))
+
+        return lines
+
+    @staticmethod
+    def _update_config(config, values):
+        """
+        Update pytest configuration with the values of a cdist configuration.
+        """
+        for key, value in values.items():
+            try:
+                # check if key is available inside pytest configuration
+                config.getini(key)
+            except ValueError:
+                continue
+
+            config._inicache[key] = value
+
+    def _fetch(self, config):
+        """
+        Connect to the resource, lock the configuration and fetch its data.
+        It runs inside the prefetch thread, so it doesn't change the plugin
+        state: acquired resources are returned, or they are released if an
+        error occurs.
+        """
+        config_name = config.option.cdist_config
+        group = self._is_group(config)
+        url = self._get_url(config)
+        namespace = config.getini("cdist_namespace")
+        autolock = self._get_autolock(config)
+        lock_ttl = float(config.getini("cdist_lock_ttl"))
+
+        # create client
+        kwargs = dict(namespace=namespace, lock_ttl=lock_ttl)
+        session_id = config.getini("cdist_session")
+        if session_id:
+            kwargs["session"] = session_id
+
+        client = from_url(url, **kwargs)
+
+        locked = False
+        heartbeat = None
+        try:
+            # lock configuration, or the first free configuration of a group
+            lock_timeout = config.option.cdist_lock_timeout
+            lock_kwargs = dict()
+            if lock_timeout is not None:
+                lock_kwargs = dict(timeout=lock_timeout, blocking=True)
+
+            if group:
+                config_name = client.lock_any(
+                    config_name or "*",
+                    self._get_tags(config),
+                    **lock_kwargs)
+                locked = True
+            elif autolock:
+                client.lock(config_name, **lock_kwargs)
+                locked = True
+
+            if locked and lock_ttl > 0:
+                heartbeat = Heartbeat(
+                    client,
+                    config_name,
+                    lock_ttl / 3)
+                heartbeat.start()
+
+            # pull configuration, or validate the cached one
+            warning = None
+            cache = self._get_cache(config, "%s/%s" % (url, namespace))
+            if cache:
+                values = cache.get(client, config_name)
+                warning = cache.warning
+            else:
+                values = client.pull(config_name)
+        except BaseException:
+            self._release(Prefetched(
+                client, config_name, locked, heartbeat, None, None))
+            raise
+
+        return Prefetched(
+            client, config_name, locked, heartbeat, values, warning)
+
+    @staticmethod
+    def _release(fetched):
+        """
+        Stop renewing the lock lease and unlock the configuration. Return
+        the list of problems which occurred.
+        """
+        problems = list()
+
+        if fetched.heartbeat:
+            fetched.heartbeat.stop()
+            if fetched.heartbeat.error:
+                problems.append(
+                    "cdist lock lease was not renewed: %s" %
+                    fetched.heartbeat.error)
+
+        if fetched.locked:
+            try:
+                fetched.client.unlock(fetched.config_name)
+            except ResourceError as err:
+                problems.append(
+                    "cdist can't unlock '%s': %s" %
+                    (fetched.config_name, err))
+
+        return problems
+
+    def _start_prefetch(self, config):
+        """
+        Start fetching the configuration in background.
+        """
+        self._prefetch = Prefetch(
+            lambda: self._fetch(config),
+            self._release)
+        self._prefetch.start()
+
+        return self._prefetch
+
+    def _start_instrumentation(self, config):
+        """
+        Collect the resource operations, if they are reported or if
+        someone implements the pytest_cdist_operation hook. Otherwise
+        operations are not measured.
+        """
+        hook = config.hook.pytest_cdist_operation
+        if not config.option.cdist_timings and \
+                not config.option.cdist_timings_json and \
+                not hook.get_hookimpls():
+            return
+
+        def listener(operation):
+            self._operations.append(operation)
+            hook(config=config, operation=operation)
+
+        self._listener = listener
+        instrument.add_listener(listener)
+
+    def _stop_instrumentation(self, config):
+        """
+        Stop collecting the resource operations and save them as JSON.
+        """
+        if self._listener is None:
+            return
+
+        instrument.remove_listener(self._listener)
+        self._listener = None
+
+        path = config.option.cdist_timings_json
+        if not path:
+            return
+
+        operations = list()
+        for operation in self._operations:
+            data = operation._asdict()
+            if data["error"] is not None:
+                data["error"] = str(data["error"])
+
+            operations.append(data)
+
+        with open(path, "w") as output:
+            json.dump(operations, output, indent=4)
+
+    def pytest_configure(self, config):
+        """
+        Start connecting, locking and fetching the configuration as soon as
+        the options are parsed, so it overlaps with the pytest startup.
+        """
+        if not self._is_active(config) or self._is_worker(config):
+            return None
+
+        self._start_instrumentation(config)
+
+        if getattr(config.option, "help", False):
+            return None
+
+        # wrong usage is reported by pytest_sessionstart
+        if self._is_group(config) and not self._get_autolock(config):
+            return None
+
+        self._start_prefetch(config)
+
+    def pytest_sessionstart(self, session):
+        """
+        Wait for the fetched configuration and update pytest configuration.
+        """
+        if not self._is_active(session.config):
+            return None
+
+        # xdist workers receive the configuration fetched by the controller
+        if self._is_worker(session.config):
+            values = session.config.workerinput.get("cdist_config", None)
+            if values:
+                self._update_config(session.config, values)
+            return None
+
+        group = self._is_group(session.config)
+        if group and not self._get_autolock(session.config):
+            raise pytest.UsageError(
+                "cdist configurations group requires cdist_autolock")
+
+        prefetch = self._prefetch or self._start_prefetch(session.config)
+        self._prefetch = None
+
+        timeout = float(session.config.getini("cdist_prefetch_timeout"))
+        if timeout > 0:
+            timeout += session.config.option.cdist_lock_timeout or 0
+        else:
+            timeout = None
+
+        if not prefetch.wait(timeout):
+            raise pytest.UsageError(
+                "cdist configuration has not been fetched within %s "
+                "seconds" % timeout)
+
+        if isinstance(prefetch.error, (ValueError, ResourceError)):
+            raise pytest.UsageError(prefetch.error)
+
+        if prefetch.error:
+            raise prefetch.error
+
+        fetched = prefetch.result
+        if fetched.warning:
+            warnings.warn(pytest.PytestWarning(fetched.warning))
+
+        self._fetched = fetched
+        self._config_name = fetched.config_name
+        self._config = fetched.config
+        self._update_config(session.config, fetched.config)
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_configure_node(self, node):
+        """
+        Share the configuration with the pytest-xdist workers, so they don't
+        connect to the resource.
+        """
+        if self._config is None:
+            return None
+
+        node.workerinput["cdist_config_name"] = self._config_name
+        node.workerinput["cdist_config"] = self._config
+
+    def pytest_sessionfinish(self, session, exitstatus):
+        """
+        Unlock configuration when session finish.
+        """
+        fetched, self._fetched = self._fetched, None
+        if fetched is None:
+            return None
+
+        for problem in self._release(fetched):
+            warnings.warn(pytest.PytestWarning(problem))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        """
+        Show the timings of the resource operations.
+        """
+        if not terminalreporter.config.option.cdist_timings:
+            return None
+
+        # operations are summarized by name, in the order they happened
+        summary = dict()
+        for operation in list(self._operations):
+            item = summary.setdefault(
+                operation.name,
+                dict(calls=0, total=0.0, max=0.0, roundtrips=0, sent=0,
+                     received=0, wait=0.0, errors=0))
+
+            item["calls"] += 1
+            item["total"] += operation.duration
+            item["max"] = max(item["max"], operation.duration)
+            item["roundtrips"] += operation.roundtrips
+            item["sent"] += operation.sent
+            item["received"] += operation.received
+            item["wait"] += operation.wait
+            item["errors"] += operation.error is not None
+
+        terminalreporter.section("cdist operations")
+        terminalreporter.write_line(
+            "%-12s %6s %10s %10s %6s %9s %9s %10s %6s" % (
+                "operation", "calls", "total(ms)", "max(ms)", "trips",
+                "sent(B)", "recv(B)", "wait(ms)", "errors"))
+
+        for name, item in summary.items():
+            terminalreporter.write_line(
+                "%-12s %6d %10.2f %10.2f %6d %9d %9d %10.2f %6d" % (
+                    name,
+                    item["calls"],
+                    item["total"] * 1000,
+                    item["max"] * 1000,
+                    item["roundtrips"],
+                    item["sent"],
+                    item["received"],
+                    item["wait"] * 1000,
+                    item["errors"]))
+
+    def pytest_unconfigure(self, config):
+        """
+        Release the configuration fetched for a session which never started
+        and save the timings of the resource operations.
+        """
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            if prefetch.wait(0) and prefetch.result is not None:
+                self._release(prefetch.result)
+
+        self._stop_instrumentation(config)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+pytest fixtures to test cdist and the projects using it, without any
+external service. Fixtures are enabled by adding this module to the
+``pytest_plugins`` of the root conftest file:
+
+    pytest_plugins = ["cdist.testing"]
+
+The Redis fixtures require the ``fakeredis[lua]`` package, which is installed
+by the "testing" extra of cdist:
+
+    pip install pytest-cdist[testing]
+
+Author:
+    Andrea Cervesato <andrea.cervesato@mailbox.org>
+"""
+import uuid
+import threading
+import pytest
+from cdist.memory import MemoryResource
+from cdist.memory import clear_store
+
+
+@pytest.fixture(scope="session")
+def cdist_redis_server():
+    """
+    Local stand-in of a Redis server, speaking the Redis protocol over TCP.
+    It requires the ``fakeredis[lua]`` package. Returns the (hostname, port)
+    tuple where the server is listening.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server.server_address
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cdist_redis_url(cdist_redis_server):
+    """
+    URL of the local stand-in of a Redis server.
+    """
+    return "redis://%s:%s" % cdist_redis_server
+
+
+@pytest.fixture
+def cdist_memory_url():
+    """
+    URL of an empty memory store, which is removed after the test.
+    """
+    store = "test-%s" % uuid.uuid4().hex
+    yield "memory://%s" % store
+    clear_store(store)
+
+
+@pytest.fixture
+def cdist_memory(cdist_memory_url):
+    """
+    Memory resource bound to an empty store, which is removed after the
+    test. Other resources can share the same store using
+    ``cdist_memory_url``.
+    """
+    return MemoryResource.from_url(cdist_memory_url)
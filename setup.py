@@ -23,8 +23,6 @@ setup(
         'Operating System :: Microsoft :: Windows',
         'Operating System :: POSIX',
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Topic :: Software Development :: Libraries',
@@ -32,18 +30,22 @@ setup(
         'Topic :: Utilities',
     ],
     packages=["cdist"],
-    python_version=">3.4,<3.9",
+    python_requires='>=3.7',
     install_requires=[
         'click<=7.0',
         'colorama<=0.4.3',
-        'redis<=3.4.1',
+        'redis>=4.2.0',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'testing': ['fakeredis[lua]'],
+    },
     entry_points={
         'console_scripts': [
             'cdist-cli=cdist.command:cli',
         ],
         'pytest11': [
             'cdist = cdist.plugin',
-        ]
+        ],
     },
 )
@@ -0,0 +1,29 @@
+"""
+Common test fixtures.
+"""
+import os
+import pytest
+
+pytest_plugins = ["cdist.testing"]
+
+
+@pytest.fixture
+def address(request):
+    """
+    Address of the Redis server used for testing. When CDIST_MOCKED is
+    defined, the local stand-in server is used.
+    """
+    if os.environ.get("CDIST_MOCKED", None):
+        return request.getfixturevalue("cdist_redis_server")
+
+    return ("localhost", 61324)
+
+
+@pytest.fixture
+def roundtrips(mocker):
+    """
+    Count the network round trips done by redis clients. Every command and
+    every pipeline is sent to the server with a single packed write.
+    """
+    import redis.connection
+    return mocker.spy(redis.connection.Connection, "send_packed_command")
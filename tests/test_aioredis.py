@@ -0,0 +1,396 @@
+"""
+asyncio redis module tests.
+"""
+import time
+import asyncio
+import redis
+import pytest
+from cdist.aioredis import AsyncRedisResource
+from cdist import ConfigStatus
+from cdist import ResourceConnectionError
+from cdist import ResourcePushError
+from cdist import ResourceLockError
+from cdist import ResourceUnlockError
+from cdist import ResourceNotExistError
+
+
+def run(coro):
+    """
+    Run a coroutine inside a new event loop.
+    """
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def make_resource(address):
+    """
+    Factory of resources to test. Resources must be created inside the event
+    loop using them.
+    """
+    def _make(**kwargs):
+        kwargs.setdefault("hostname", address[0])
+        kwargs.setdefault("port", address[1])
+        return AsyncRedisResource(**kwargs)
+
+    return _make
+
+
+def test_connection_error():
+    """
+    Test if connection raises an error when server is not available.
+    """
+    async def _test():
+        resource = AsyncRedisResource(hostname="localhost", port=1)
+        with pytest.raises(ResourcePushError):
+            await resource.push("test", dict(test0="data0"))
+
+        with pytest.raises(ResourceConnectionError):
+            await resource.keys()
+
+        await resource.close()
+
+    run(_test())
+
+
+def test_args_error(make_resource):
+    """
+    Test methods with wrong arguments.
+    """
+    async def _test():
+        resource = make_resource()
+        for method in ["pull", "version", "lock", "unlock", "renew",
+                       "is_locked", "delete"]:
+            with pytest.raises(ValueError):
+                await getattr(resource, method)("")
+
+        with pytest.raises(ValueError):
+            await resource.push("test", None)
+
+    run(_test())
+
+
+def test_push_and_pull(request, make_resource):
+    """
+    Push a configuration, pull it and delete it.
+    """
+    key = request.node.name
+
+    async def _test():
+        resource = make_resource()
+        data = dict(test0="data0", test1="data1")
+
+        await resource.push(key, data)
+        assert await resource.pull(key) == data
+        assert await resource.version(key)
+        assert key in await resource.keys()
+
+        await resource.delete(key)
+        assert key not in await resource.keys()
+
+        with pytest.raises(ResourceNotExistError):
+            await resource.pull(key)
+
+        with pytest.raises(ResourceNotExistError):
+            await resource.delete(key)
+
+        await resource.close()
+
+    run(_test())
+
+
+def test_iter_keys(request, make_resource):
+    """
+    Test if keys are iterated asynchronously inside the namespace.
+    """
+    async def _test():
+        resource = make_resource(namespace=request.node.name, scan_count=2)
+        keys = ["key%d" % i for i in range(7)]
+        for key in keys:
+            await resource.push(key, dict(test0="data0"))
+
+        found = [key async for key in resource.iter_keys()]
+        assert sorted(found) == keys
+
+        other = make_resource(namespace=request.node.name + "_other")
+        assert await other.keys() == []
+
+        await resource.close()
+        await other.close()
+
+    run(_test())
+
+
+def test_lock_and_unlock(request, make_resource):
+    """
+    Test locks ownership and status.
+    """
+    key = request.node.name
+
+    async def _test():
+        resource = make_resource()
+        other = make_resource(owner="other")
+
+        await resource.push(key, dict(test0="data0"))
+        assert not await resource.is_locked(key)
+
+        await resource.lock(key)
+        assert await resource.is_locked(key)
+        assert await other.status_many([key, key + "_missing"]) == {
+            key: ConfigStatus(True, True, resource.owner),
+            key + "_missing": ConfigStatus(False, False, None),
+        }
+
+        with pytest.raises(ResourceLockError):
+            await other.lock(key)
+
+        with pytest.raises(ResourceUnlockError):
+            await other.unlock(key)
+
+        with pytest.raises(ResourceLockError):
+            await other.renew(key)
+
+        await resource.renew(key)
+        await resource.unlock(key)
+        assert not await resource.is_locked(key)
+
+        await resource.close()
+        await other.close()
+
+    run(_test())
+
+
+def test_lock_blocking(request, make_resource):
+    """
+    Test if concurrent waiters are coroutines served in arrival order.
+    """
+    key = request.node.name
+
+    async def _test():
+        owner = make_resource(owner="owner")
+        await owner.push(key, dict(test0="data0"))
+        await owner.lock(key)
+
+        order = []
+
+        async def _wait(name):
+            waiter = make_resource(owner=name)
+            await waiter.lock(key, timeout=10, blocking=True)
+            order.append(name)
+            await waiter.unlock(key)
+            await waiter.close()
+
+        tasks = []
+        for i in range(3):
+            tasks.append(asyncio.ensure_future(_wait("waiter%d" % i)))
+            # let the waiter queue itself
+            await asyncio.sleep(0.2)
+
+        await owner.unlock(key)
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=10)
+
+        assert order == ["waiter0", "waiter1", "waiter2"]
+        await owner.close()
+
+    run(_test())
+
+
+def test_lock_blocking_many(request, make_resource):
+    """
+    Test if waiters don't hold any connection of the pool, so there can be
+    many more waiters than connections.
+    """
+    keys = ["%s%d" % (request.node.name, i) for i in range(50)]
+
+    async def _test():
+        owner = make_resource(owner="owner")
+        waiter = make_resource(max_connections=2, pool_timeout=0.5)
+
+        for key in keys:
+            await owner.push(key, dict(test0="data0"))
+            await owner.lock(key)
+
+        tasks = asyncio.gather(*[
+            waiter.lock(key, timeout=10, blocking=True) for key in keys])
+
+        # waiters keep waiting after the pool timeout
+        await asyncio.sleep(1)
+
+        start = time.monotonic()
+        for key in keys:
+            await owner.unlock(key)
+
+        await asyncio.wait_for(tasks, timeout=10)
+        assert time.monotonic() - start < 5
+
+        for key in keys:
+            assert await owner.is_locked(key)
+            await waiter.unlock(key)
+            await owner.delete(key)
+
+        await owner.close()
+        await waiter.close()
+
+    run(_test())
+
+
+def test_lock_blocking_timeout(request, make_resource):
+    """
+    Test if waiting for a locked configuration times out.
+    """
+    key = request.node.name
+
+    async def _test():
+        resource = make_resource()
+        other = make_resource(owner="other")
+
+        await resource.push(key, dict(test0="data0"))
+        await resource.lock(key)
+
+        start = time.monotonic()
+        with pytest.raises(ResourceLockError):
+            await other.lock(key, timeout=0.3, blocking=True)
+        assert time.monotonic() - start < 2
+
+        # waiter doesn't get the lock after timeout
+        await resource.unlock(key)
+        assert not await resource.is_locked(key)
+
+        await resource.close()
+        await other.close()
+
+    run(_test())
+
+
+def test_lock_any(request, make_resource):
+    """
+    Test if the first free configuration of a group is locked.
+    """
+    prefix = request.node.name
+
+    async def _test():
+        resource = make_resource()
+        other = make_resource(owner="other")
+
+        await resource.push(prefix + "-0", dict(cdist_tags="arm"))
+        await resource.push(prefix + "-1", dict(cdist_tags="arm"))
+
+        name = await resource.lock_any(prefix + "-*", ["arm"])
+        assert name == prefix + "-0"
+        assert await other.lock_any(prefix + "-*") == prefix + "-1"
+
+        with pytest.raises(ResourceNotExistError):
+            await other.lock_any(prefix + "-*", ["x86"])
+
+        await resource.close()
+        await other.close()
+
+    run(_test())
+
+
+def test_lock_error(request, mocker, make_resource):
+    """
+    Test if server errors are reported while locking.
+    """
+    key = request.node.name
+
+    async def _test():
+        resource = make_resource()
+        await resource.push(key, dict(test0="data0"))
+
+        mocker.patch(
+            "redis.commands.core.AsyncScript.__call__",
+            side_effect=redis.RedisError("error"))
+
+        with pytest.raises(ResourceLockError):
+            await resource.lock(key)
+
+        await resource.close()
+
+    run(_test())
+
+
+def test_locks(request, make_resource):
+    """
+    Test if held and stale locks are listed and if stale locks are broken.
+    """
+    key = request.node.name
+
+    async def _test():
+        resource = make_resource(session="job-1")
+        expiring = make_resource(owner="expiring", lock_ttl=0.1)
+
+        await resource.push(key, dict(test0="data0"))
+        await resource.push(key + "-stale", dict(test0="data0"))
+
+        await resource.lock(key)
+        await expiring.lock(key + "-stale")
+        await asyncio.sleep(0.2)
+
+        locks = await resource.locks()
+        assert locks[key].owner == resource.owner
+        assert locks[key].session == "job-1"
+        assert locks[key].expires is None
+        assert not locks[key].stale
+        assert locks[key + "-stale"].stale
+
+        broken = await resource.break_stale()
+        assert key + "-stale" in broken
+        assert key not in broken
+
+        await resource.unlock(key)
+        locks = await resource.locks()
+        assert key not in locks
+        assert key + "-stale" not in locks
+
+        await resource.close()
+        await expiring.close()
+
+    run(_test())
+
+
+def test_push_blob(request, make_resource):
+    """
+    Test if configurations stored as a blob are pulled.
+    """
+    key = request.node.name
+    config = dict(addopts="-v " * 1000, testpaths="tests")
+
+    async def _test():
+        resource = make_resource(blob_threshold=0, compression="none")
+
+        assert await resource.push(key, config)
+        assert await resource.pull(key) == config
+
+        await resource.delete(key)
+        await resource.close()
+
+    run(_test())
+
+
+def test_extends(request, make_resource):
+    """
+    Test if inherited configurations are merged by pull.
+    """
+    key = request.node.name
+
+    async def _test():
+        resource = make_resource()
+
+        await resource.push(key + "-base", dict(test0="base", test1="base"))
+        await resource.push(key, dict(
+            test1="rig", cdist_extends=key + "-base"))
+
+        assert await resource.pull(key) == dict(
+            test0="base", test1="rig", cdist_extends=key + "-base")
+        assert await resource.pull(key, resolve=False) == dict(
+            test1="rig", cdist_extends=key + "-base")
+
+        version = await resource.version(key)
+        await resource.push(key + "-base", dict(test0="changed"))
+        assert await resource.version(key) != version
+
+        await resource.delete(key)
+        await resource.delete(key + "-base")
+        await resource.close()
+
+    run(_test())
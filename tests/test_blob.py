@@ -0,0 +1,97 @@
+"""
+Unittests for the compact serialization of configurations.
+"""
+import zlib
+import pytest
+from cdist.blob import encode_config
+from cdist.blob import decode_config
+
+
+def test_encode_and_decode():
+    """
+    Test if configurations are decoded as they have been encoded.
+    """
+    config = dict(addopts="-v " * 1000, testpaths="tests", unicode="è")
+
+    blob = encode_config(config)
+    assert blob[:4] == b"cd\x01\x01"
+    assert len(blob) < len(config["addopts"])
+    assert decode_config(blob) == config
+
+
+def test_compress_threshold():
+    """
+    Test if small configurations are not compressed.
+    """
+    blob = encode_config(dict(option="value"), threshold=1024)
+    assert blob[:4] == b"cd\x01\x00"
+    assert decode_config(blob) == dict(option="value")
+
+    blob = encode_config(dict(option="value"), codec="none", threshold=0)
+    assert blob[3] == 0
+
+
+def test_zstd():
+    """
+    Test if configurations are compressed with zstd.
+    """
+    try:
+        blob = encode_config(dict(option="value" * 1000), codec="zstd")
+    except ValueError:
+        pytest.skip("zstd is not available")
+
+    assert blob[3] == 2
+    assert decode_config(blob) == dict(option="value" * 1000)
+
+
+def test_errors():
+    """
+    Test if unsupported codecs and corrupted blobs are rejected.
+    """
+    with pytest.raises(ValueError):
+        encode_config(dict(option="value"), codec="lzma", threshold=0)
+
+    with pytest.raises(ValueError):
+        decode_config(b"option")
+
+    with pytest.raises(ValueError):
+        decode_config(b"cd\x02\x00{}")
+
+    with pytest.raises(ValueError):
+        decode_config(b"cd\x01\x01" + zlib.compress(b"[]"))
+
+    with pytest.raises(ValueError):
+        decode_config(b"cd\x01\x01corrupted")
+
+    with pytest.raises(ValueError, match="corrupted"):
+        decode_config(b"cd\x01\x00{option")
+
+
+class _FakeZstd:
+    """
+    zstd module which can't decompress anything.
+    """
+
+    class ZstdError(Exception):
+        pass
+
+    @classmethod
+    def decompress(cls, data):
+        raise cls.ZstdError("unknown frame descriptor")
+
+
+@pytest.mark.parametrize("fake", [True, False])
+def test_zstd_corrupted(mocker, fake):
+    """
+    Test if corrupted zstd blobs are rejected.
+    """
+    if fake:
+        mocker.patch("cdist.blob._zstd", return_value=_FakeZstd)
+    else:
+        try:
+            encode_config(dict(), codec="zstd", threshold=0)
+        except ValueError:
+            pytest.skip("zstd is not available")
+
+    with pytest.raises(ValueError, match="corrupted"):
+        decode_config(b"cd\x01\x02corrupted")
@@ -0,0 +1,147 @@
+"""
+Local configurations cache tests.
+"""
+import pytest
+import cdist
+from cdist.cache import ConfigCache
+
+
+class Storage(dict):
+    """
+    In-memory storage behaving like pytest ``config.cache``.
+    """
+
+    def set(self, key, value):
+        self[key] = value
+
+
+@pytest.fixture
+def resource(mocker):
+    """
+    Resource storing a single configuration.
+    """
+    resource = mocker.Mock()
+    resource.version.return_value = "v1"
+    resource.pull.return_value = dict(test_param="value")
+    return resource
+
+
+def test_get_args_error(resource):
+    """
+    Test get method with wrong arguments.
+    """
+    cache = ConfigCache(Storage(), "localhost")
+    with pytest.raises(ValueError):
+        cache.get(resource, None)
+
+    with pytest.raises(ValueError):
+        cache.get(resource, "")
+
+
+def test_get_validates_version(resource):
+    """
+    Test if configuration is pulled only when its version changes.
+    """
+    cache = ConfigCache(Storage(), "localhost")
+
+    for _ in range(3):
+        assert cache.get(resource, "test") == dict(test_param="value")
+
+    assert resource.version.call_count == 3
+    assert resource.pull.call_count == 1
+
+    resource.version.return_value = "v2"
+    resource.pull.return_value = dict(test_param="changed")
+
+    assert cache.get(resource, "test") == dict(test_param="changed")
+    assert resource.pull.call_count == 2
+
+
+def test_get_unversioned(resource):
+    """
+    Test if configurations without version are always pulled.
+    """
+    resource.version.return_value = None
+
+    cache = ConfigCache(Storage(), "localhost")
+    cache.get(resource, "test")
+    cache.get(resource, "test")
+
+    assert resource.pull.call_count == 2
+
+
+def test_get_max_age(mocker, resource):
+    """
+    Test if configuration isn't validated within its maximum age.
+    """
+    now = mocker.patch("cdist.cache.time.time", return_value=1000.0)
+
+    cache = ConfigCache(Storage(), "localhost", max_age=10)
+    cache.get(resource, "test")
+
+    now.return_value = 1009.0
+    cache.get(resource, "test")
+    assert resource.version.call_count == 1
+
+    now.return_value = 1011.0
+    cache.get(resource, "test")
+    assert resource.version.call_count == 2
+    assert resource.pull.call_count == 1
+
+
+def test_get_prefix(resource):
+    """
+    Test if configurations of different resources are cached separately.
+    """
+    storage = Storage()
+    ConfigCache(storage, "host0").get(resource, "test")
+    ConfigCache(storage, "host1").get(resource, "test")
+
+    assert resource.pull.call_count == 2
+    assert len(storage) == 2
+
+
+def test_get_connection_error(resource):
+    """
+    Test if cached configuration is used when resource is not reachable.
+    """
+    cache = ConfigCache(Storage(), "localhost")
+    cache.get(resource, "test")
+    assert cache.warning is None
+
+    resource.version.side_effect = cdist.ResourceConnectionError("down")
+    assert cache.get(resource, "test") == dict(test_param="value")
+    assert "down" in cache.warning
+
+    # nothing cached yet
+    with pytest.raises(cdist.ResourceConnectionError):
+        cache.get(resource, "other")
+
+
+def test_get_not_exist_error(resource):
+    """
+    Test if deleted configurations are not returned from cache.
+    """
+    cache = ConfigCache(Storage(), "localhost")
+    cache.get(resource, "test")
+
+    resource.version.side_effect = cdist.ResourceNotExistError()
+    with pytest.raises(cdist.ResourceNotExistError):
+        cache.get(resource, "test")
+
+
+def test_get_inheritance_error(cdist_memory):
+    """
+    Test if cached configuration is not returned when its inheritance is
+    broken.
+    """
+    cache = ConfigCache(Storage(), "localhost")
+    cdist_memory.push("base", dict(test_param="value"))
+    cdist_memory.push("test", dict(cdist_extends="base"))
+    assert cache.get(cdist_memory, "test")["test_param"] == "value"
+
+    cdist_memory.push("test", dict(cdist_extends="missing"))
+    with pytest.raises(cdist.ResourceInheritanceError):
+        cache.get(cdist_memory, "test")
+
+    assert cache.warning is None
@@ -0,0 +1,254 @@
+"""
+Unittests for the client side cache of a resource.
+"""
+import time
+import pytest
+from cdist.cached import CachedResource
+from cdist.file import FileResource
+from cdist.memory import MemoryResource
+from cdist.redis import RedisResource
+from cdist.resource import ResourceNotExistError
+
+
+@pytest.fixture
+def cached(cdist_memory):
+    """
+    Cache of a memory resource.
+    """
+    resource = CachedResource(resource=cdist_memory)
+    yield resource
+    resource.close()
+
+
+def test_pull(cached):
+    """
+    Test if configurations are pulled once.
+    """
+    cached.push("test", dict(option="value"))
+
+    assert cached.pull("test") == dict(option="value")
+    assert cached.pull("test") == dict(option="value")
+    assert cached.version("test") == cached.version("test")
+
+    assert cached.hits == 2
+    assert cached.misses == 2
+
+
+def test_pull_not_exist(cached):
+    """
+    Test if missing configurations are not cached.
+    """
+    with pytest.raises(ResourceNotExistError):
+        cached.pull("test")
+
+    cached.resource.push("test", dict(option="value"))
+
+    assert cached.pull("test") == dict(option="value")
+
+
+def test_pull_many(cached):
+    """
+    Test if only the configurations which are not cached are pulled.
+    """
+    cached.push("test0", dict(option="value0"))
+    cached.push("test1", dict(option="value1"))
+    cached.pull("test0")
+
+    configs = cached.pull_many(["test0", "test1", "test2"])
+
+    assert configs == dict(
+        test0=dict(option="value0"),
+        test1=dict(option="value1"),
+        test2=None)
+    assert cached.hits == 1
+    assert cached.misses == 3
+
+
+def test_invalidate_config(cdist_memory_url, cached):
+    """
+    Test if configurations changed by other clients are invalidated.
+    """
+    other = MemoryResource.from_url(cdist_memory_url)
+    cached.push("test", dict(option="value"))
+    cached.pull("test")
+
+    other.push("test", dict(option="changed"))
+
+    assert cached.pull("test") == dict(option="changed")
+
+    other.delete("test")
+
+    with pytest.raises(ResourceNotExistError):
+        cached.pull("test")
+
+
+def test_invalidate_lock(cdist_memory_url, cached):
+    """
+    Test if lock status changed by other clients is invalidated.
+    """
+    other = MemoryResource.from_url(cdist_memory_url)
+    cached.push("test", dict(option="value"))
+
+    assert not cached.is_locked("test")
+    assert not cached.is_locked("test")
+    assert cached.hits == 1
+
+    other.lock("test")
+    assert cached.is_locked("test")
+    assert cached.is_locked("test")
+    assert cached.hits == 2
+
+    other.unlock("test")
+    assert not cached.is_locked("test")
+
+
+def test_lock_expired(cdist_memory_url, cached):
+    """
+    Test if lock status is not cached after its lease expired.
+    """
+    other = MemoryResource.from_url(cdist_memory_url, lock_ttl=0.3)
+    cached.push("test", dict(option="value"))
+
+    other.lock("test")
+    assert cached.is_locked("test")
+    assert cached.is_locked("test")
+
+    time.sleep(0.4)
+
+    assert not cached.is_locked("test")
+
+
+def test_lock_renewed(cdist_memory_url, cached):
+    """
+    Test if lock status is cached until the renewed lease expires.
+    """
+    other = MemoryResource.from_url(cdist_memory_url, lock_ttl=0.3)
+    cached.push("test", dict(option="value"))
+
+    other.lock("test")
+    assert cached.is_locked("test")
+
+    time.sleep(0.2)
+    other.renew("test")
+    time.sleep(0.2)
+
+    assert cached.is_locked("test")
+    hits = cached.hits
+    assert cached.is_locked("test")
+    assert cached.hits == hits + 1
+
+    time.sleep(0.3)
+
+    assert not cached.is_locked("test")
+
+
+def test_invalidate_inherited(cdist_memory_url, cached):
+    """
+    Test if configurations are invalidated when their parents change.
+    """
+    other = MemoryResource.from_url(cdist_memory_url)
+    cached.push("base", dict(option="value"))
+    cached.push("test", dict(cdist_extends="base"))
+
+    assert cached.pull("test")["option"] == "value"
+    version = cached.version("test")
+
+    other.push("base", dict(option="changed"))
+
+    assert cached.pull("test")["option"] == "changed"
+    assert cached.version("test") != version
+
+
+def test_max_size(cached):
+    """
+    Test if least recently used entries are evicted.
+    """
+    cached = CachedResource(resource=cached.resource, max_size=2)
+    for index in range(3):
+        cached.push("test%d" % index, dict(option="value"))
+        cached.pull("test%d" % index)
+
+    assert cached.size == 2
+
+    cached.pull("test0")
+    assert cached.hits == 0
+
+    cached.pull("test0")
+    assert cached.hits == 1
+
+    cached.close()
+
+
+def test_ttl(cached):
+    """
+    Test if entries expire after the TTL.
+    """
+    cached = CachedResource(resource=cached.resource, ttl=0.1)
+    cached.push("test", dict(option="value"))
+    cached.pull("test")
+
+    time.sleep(0.2)
+
+    cached.pull("test")
+    assert cached.hits == 0
+    assert cached.misses == 2
+
+    cached.close()
+
+
+def test_no_subscription(tmpdir):
+    """
+    Test if lock status is not cached when resource doesn't publish its
+    changes.
+    """
+    resource = FileResource(path=str(tmpdir))
+    cached = CachedResource(resource=resource)
+    cached.push("test", dict(option="value"))
+
+    assert not cached.is_locked("test")
+    resource.lock("test")
+    assert cached.is_locked("test")
+    assert cached.hits == 0
+
+    resource.unlock("test")
+
+
+def test_redis(request, address):
+    """
+    Test if Redis resource invalidates the cached entries.
+    """
+    key = request.node.name
+    resource = RedisResource(hostname=address[0], port=address[1])
+    other = RedisResource(hostname=address[0], port=address[1], lock_ttl=60)
+    cached = CachedResource(resource=resource)
+
+    try:
+        cached.push(key, dict(option="value"))
+        assert cached.pull(key) == dict(option="value")
+        assert not cached.is_locked(key)
+
+        other.push(key, dict(option="changed"))
+        other.lock(key)
+
+        # lock status is cached once the lock event is received
+        deadline = time.monotonic() + 5
+        while True:
+            hits = cached.hits
+            if cached.pull(key) == dict(option="changed") and \
+                    cached.is_locked(key) and cached.hits == hits + 2:
+                break
+
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        other.unlock(key)
+
+        deadline = time.monotonic() + 5
+        while cached.is_locked(key):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        cached.close()
+        resource.delete(key)
+        resource.close()
+        other.close()
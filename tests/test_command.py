@@ -2,9 +2,12 @@
 command module tests.
 """
 import os
+import json
+import threading
 import pytest
 from click.testing import CliRunner
 import cdist.redis
+import cdist.registry
 import cdist.command
 import redis
 
@@ -101,6 +104,27 @@ def test_push_error(request, mocker, runner):
         cdist.redis.RedisResource.push.assert_called_with(key, config_dict)
 
 
+def test_show_raw(request, mocker, runner):
+    """
+    Show a configuration without the inherited options.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    key = request.node.name
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.pull",
+                     return_value=dict(cdist_extends="base"))
+
+    ret = runner(['show', '--raw', key])
+    assert not ret.exception
+    assert "cdist_extends = base" in ret.output
+
+    if MOCKED:
+        cdist.redis.RedisResource.pull.assert_called_with(key, resolve=False)
+
+
 def test_show_config_not_exist_error(request, runner):
     """
     This test check if showing non existing configuration will raise
@@ -136,7 +160,7 @@ def test_show_error(request, mocker, runner):
     assert ret.exit_code == 1
 
     if MOCKED:
-        cdist.redis.RedisResource.pull.assert_called_with(key)
+        cdist.redis.RedisResource.pull.assert_called_with(key, resolve=True)
 
 
 def test_push_and_show(request, mocker, runner):
@@ -166,7 +190,7 @@ def test_push_and_show(request, mocker, runner):
 
     if MOCKED:
         cdist.redis.RedisResource.push.assert_called_with(key, config_dict)
-        cdist.redis.RedisResource.pull.assert_called_with(key)
+        cdist.redis.RedisResource.pull.assert_called_with(key, resolve=True)
 
 
 def test_lock_config_not_exist_error(request, runner):
@@ -282,6 +306,64 @@ def test_lock_and_unlock(request, mocker, runner):
         cdist.redis.RedisResource.unlock.assert_called_with(key)
 
 
+def test_lock_timeout(request, mocker, runner):
+    """
+    Lock a configuration waiting until it's unlocked.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    key = request.node.name
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.lock")
+
+    ret = runner(['lock', '--timeout', '2.5', key])
+    assert not ret.exception
+    assert ret.exit_code == 0
+
+    if MOCKED:
+        cdist.redis.RedisResource.lock.assert_called_with(
+            key, timeout=2.5, blocking=True)
+
+
+def test_unlock_force(request, mocker, runner):
+    """
+    Force unlock of a configuration locked by another owner.
+    """
+    key = request.node.name
+
+    with open("pytest.ini", "w") as config:
+        config.write("[pytest]\naddopts = --setup-only")
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.push")
+        mocker.patch("cdist.redis.RedisResource.lock")
+        mocker.patch("cdist.redis.RedisResource.unlock")
+
+    # push configuration file
+    ret = runner(['push', key, 'pytest.ini'])
+    assert not ret.exception
+    assert ret.exit_code == 0
+
+    # lock configuration file with another owner
+    ret = runner(['-o', 'other', 'lock', key])
+    assert not ret.exception
+    assert ret.exit_code == 0
+
+    # force unlock configuration file
+    ret = runner(['unlock', '--force', key])
+    assert not ret.exception
+    assert ret.exit_code == 0
+
+    if MOCKED:
+        cdist.redis.RedisResource.lock.assert_called_with(key)
+        cdist.redis.RedisResource.unlock.assert_called_with(key, force=True)
+
+    # cleanup
+    runner(['delete', key])
+
+
 def test_list_error(request, mocker, runner):
     """
     List configurations and check for exceptions when redis fails.
@@ -295,7 +377,7 @@ def test_list_error(request, mocker, runner):
         config.write("[pytest]\naddopts = --setup-only")
 
     if MOCKED:
-        mocker.patch("cdist.redis.RedisResource.keys",
+        mocker.patch("cdist.redis.RedisResource.iter_keys",
                      side_effect=cdist.ResourceError())
 
     # list configurations
@@ -304,7 +386,7 @@ def test_list_error(request, mocker, runner):
     assert ret.exit_code == 1
 
     if MOCKED:
-        cdist.redis.RedisResource.keys.assert_called_with()
+        cdist.redis.RedisResource.iter_keys.assert_called_with()
 
 
 def test_list_locked_check_error(request, mocker, runner):
@@ -324,8 +406,8 @@ def test_list_locked_check_error(request, mocker, runner):
 
     if MOCKED:
         mocker.patch("cdist.redis.RedisResource.push")
-        mocker.patch("cdist.redis.RedisResource.keys", return_value=[key])
-        mocker.patch("cdist.redis.RedisResource.is_locked",
+        mocker.patch("cdist.redis.RedisResource.iter_keys", return_value=[key])
+        mocker.patch("cdist.redis.RedisResource.status_many",
                      side_effect=cdist.ResourceError())
 
     # push configuration file
@@ -340,8 +422,8 @@ def test_list_locked_check_error(request, mocker, runner):
 
     if MOCKED:
         cdist.redis.RedisResource.push.assert_called_with(key, config_dict)
-        cdist.redis.RedisResource.is_locked.assert_called_with(key)
-        cdist.redis.RedisResource.keys.assert_called()
+        cdist.redis.RedisResource.status_many.assert_called_with([key])
+        cdist.redis.RedisResource.iter_keys.assert_called()
 
 
 def test_push_and_list(request, mocker, runner):
@@ -360,8 +442,9 @@ def test_push_and_list(request, mocker, runner):
 
     if MOCKED:
         mocker.patch("cdist.redis.RedisResource.push")
-        mocker.patch("cdist.redis.RedisResource.keys", return_value=[key])
-        mocker.patch("cdist.redis.RedisResource.is_locked", return_value=False)
+        mocker.patch("cdist.redis.RedisResource.iter_keys", return_value=[key])
+        mocker.patch("cdist.redis.RedisResource.status_many",
+                     return_value={key: cdist.ConfigStatus(True, False, None)})
 
     # push configuration file
     ret = runner(['push', key, 'pytest.ini'])
@@ -376,8 +459,44 @@ def test_push_and_list(request, mocker, runner):
 
     if MOCKED:
         cdist.redis.RedisResource.push.assert_called_with(key, config_dict)
-        cdist.redis.RedisResource.keys.assert_called()
-        cdist.redis.RedisResource.is_locked.assert_called_with(key)
+        cdist.redis.RedisResource.iter_keys.assert_called()
+        cdist.redis.RedisResource.status_many.assert_called_with([key])
+
+
+def test_push_and_list_json(request, mocker, runner):
+    """
+    List configurations in JSON format.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    key = request.node.name
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.iter_keys",
+                     return_value=[key, "missing", "other"])
+        mocker.patch("cdist.redis.RedisResource.status_many", return_value={
+            key: cdist.ConfigStatus(True, False, None),
+            "missing": cdist.ConfigStatus(False, False, None),
+            "other": cdist.ConfigStatus(True, True, "1"),
+        })
+
+    # list configurations
+    ret = runner(['list', '--json'])
+    assert not ret.exception
+    assert ret.exit_code == 0
+    assert json.loads(ret.output) == [
+        dict(name=key, locked=False, owner=None),
+        dict(name="other", locked=True, owner="1"),
+    ]
+
+    # list without configurations
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.iter_keys", return_value=[])
+
+    ret = runner(['list', '--json'])
+    assert not ret.exception
+    assert json.loads(ret.output) == []
 
 
 def test_delete_config_not_exist_error(request, runner):
@@ -446,3 +565,370 @@ def test_push_and_delete(request, mocker, runner):
     if MOCKED:
         cdist.redis.RedisResource.push.assert_called_with(key, config_dict)
         cdist.redis.RedisResource.delete.assert_called_with(key)
+
+
+def test_import_directory(mocker, runner):
+    """
+    Import all the ini files of a directory, reporting the failing ones.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    os.mkdir("configs")
+    with open(os.path.join("configs", "rig0.ini"), "w") as config:
+        config.write("[pytest]\naddopts = -x")
+    with open(os.path.join("configs", "rig1.ini"), "w") as config:
+        config.write("[pytest]\naddopts = -v")
+    with open(os.path.join("configs", "other.ini"), "w") as config:
+        config.write("[other]\naddopts = -v")
+    with open(os.path.join("configs", "README"), "w") as config:
+        config.write("not a configuration")
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.push_many", return_value={
+            "rig1": cdist.ResourcePushError("error")})
+
+    ret = runner(['import', '--batch-size', '1', 'configs'])
+    assert ret.exception
+    assert "- other: not a pytest configuration." in ret.output
+    assert "- rig0: pushed" in ret.output
+    assert "- rig1: error" in ret.output
+
+    if MOCKED:
+        assert cdist.redis.RedisResource.push_many.call_args_list == [
+            mocker.call([("rig0", dict(addopts="-x"))]),
+            mocker.call([("rig1", dict(addopts="-v"))]),
+        ]
+
+
+@pytest.mark.parametrize("archive", ["tar", "zip"])
+def test_import_archive(mocker, runner, archive):
+    """
+    Import all the ini files of an archive.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    import tarfile
+    import zipfile
+
+    os.mkdir("configs")
+    with open(os.path.join("configs", "rig0.ini"), "w") as config:
+        config.write("[pytest]\naddopts = -x")
+
+    if archive == "tar":
+        with tarfile.open("configs.archive", "w:gz") as data:
+            data.add("configs")
+    else:
+        with zipfile.ZipFile("configs.archive", "w") as data:
+            data.write(os.path.join("configs", "rig0.ini"))
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.push_many", return_value={})
+
+    ret = runner(['import', 'configs.archive'])
+    assert not ret.exception
+    assert "- rig0: pushed" in ret.output
+
+    if MOCKED:
+        cdist.redis.RedisResource.push_many.assert_called_with(
+            [("rig0", dict(addopts="-x"))])
+
+
+def test_import_dry_run(mocker, runner):
+    """
+    Show differences with stored configurations without pushing them.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    os.mkdir("configs")
+    for name in ["new", "same", "changed"]:
+        with open(os.path.join("configs", name + ".ini"), "w") as config:
+            config.write("[pytest]\naddopts = -x\nmarkers = slow")
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.push_many")
+        mocker.patch("cdist.redis.RedisResource.pull_many", return_value={
+            "new": None,
+            "same": dict(addopts="-x", markers="slow"),
+            "changed": dict(addopts="-v", timeout="10"),
+        })
+
+    ret = runner(['import', '--dry-run', 'configs'])
+    assert not ret.exception
+    assert "- new: new" in ret.output
+    assert "- same: unchanged" in ret.output
+    assert "- changed: changed" in ret.output
+    assert "~ addopts = -v -> -x" in ret.output
+    assert "+ markers = slow" in ret.output
+    assert "- timeout = 10" in ret.output
+
+    if MOCKED:
+        cdist.redis.RedisResource.push_many.assert_not_called()
+
+
+def test_export(mocker, runner):
+    """
+    Export configurations as ini files which can be imported back.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    configs = dict(
+        rig0=dict(addopts="-k 'not slow'", log_format="%(message)s"),
+        rig1=None,
+    )
+    configs["bad/name"] = dict(addopts="-x")
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.iter_keys",
+                     return_value=list(configs))
+        mocker.patch("cdist.redis.RedisResource.pull_many",
+                     return_value=configs)
+        mocker.patch("cdist.redis.RedisResource.push_many", return_value={})
+
+    ret = runner(['export', 'configs'])
+    assert ret.exception
+    assert "- rig0: exported" in ret.output
+    assert "- bad/name: not a valid file name" in ret.output
+    assert os.listdir("configs") == ["rig0.ini"]
+
+    ret = runner(['import', 'configs'])
+    assert not ret.exception
+
+    if MOCKED:
+        # inherited options are not exported
+        cdist.redis.RedisResource.pull_many.assert_called_with(
+            list(configs), resolve=False, errors=dict())
+        cdist.redis.RedisResource.push_many.assert_called_with(
+            [("rig0", configs["rig0"])])
+
+
+def _pull_corrupt(keys, resolve=True, errors=None):
+    """
+    Pull configurations where "corrupt" can't be decoded.
+    """
+    configs = dict()
+    for key in keys:
+        configs[key] = dict(addopts="-x")
+        if key == "corrupt":
+            errors[key] = cdist.ResourcePullError("can't decode 'corrupt'")
+            configs[key] = None
+
+    return configs
+
+
+def test_export_corrupt(mocker, runner):
+    """
+    Export configurations reporting the ones which can't be pulled.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.iter_keys",
+                     return_value=["rig0", "corrupt"])
+        mocker.patch("cdist.redis.RedisResource.pull_many",
+                     side_effect=_pull_corrupt)
+
+    ret = runner(['export', 'configs'])
+    assert isinstance(ret.exception, cdist.ResourceError)
+    assert "1 configurations can't be exported" in str(ret.exception)
+    assert "- rig0: exported" in ret.output
+    assert "- corrupt: can't decode 'corrupt'" in ret.output
+    assert os.listdir("configs") == ["rig0.ini"]
+
+
+def test_import_dry_run_corrupt(mocker, runner):
+    """
+    Show differences reporting the stored configurations which can't be
+    pulled.
+    """
+    if not MOCKED:
+        pytest.xfail("need mocking")
+
+    os.mkdir("configs")
+    for name in ["rig0", "corrupt"]:
+        with open(os.path.join("configs", name + ".ini"), "w") as config:
+            config.write("[pytest]\naddopts = -x")
+
+    if MOCKED:
+        mocker.patch("cdist.redis.RedisResource.pull_many",
+                     side_effect=_pull_corrupt)
+
+    ret = runner(['import', '--dry-run', 'configs'])
+    assert isinstance(ret.exception, cdist.ResourceError)
+    assert "1 configurations can't be imported" in str(ret.exception)
+    assert "- rig0: unchanged" in ret.output
+    assert "- corrupt: can't decode 'corrupt'" in ret.output
+
+
+def test_url(mocker, runner):
+    """
+    Test if resource is created from the URL.
+    """
+    init = mocker.patch('cdist.redis.RedisResource.__init__',
+                        return_value=None)
+    mocker.patch("cdist.redis.RedisResource.lock")
+
+    ret = runner(['-u', 'redis://myhost:2244/1', 'lock', 'test'])
+    assert not ret.exception
+
+    init.assert_called_with(
+        hostname="myhost",
+        port=2244,
+        db=1,
+        namespace="cdist",
+        owner=cdist.command._default_owner())
+
+
+def test_owners(request, mocker, runner, cdist_memory, cdist_memory_url):
+    """
+    Test if CLI users on the same resource don't share their locks.
+    """
+    key = request.node.name
+    cdist_memory.push(key, dict(option="value"))
+
+    getuser = mocker.patch("cdist.command.getpass.getuser")
+
+    getuser.return_value = "alice"
+    ret = runner(['-u', cdist_memory_url, 'lock', key])
+    assert not ret.exception
+
+    getuser.return_value = "bob"
+    ret = runner(['-u', cdist_memory_url, 'lock', key])
+    assert isinstance(ret.exception, cdist.ResourceLockError)
+
+    ret = runner(['-u', cdist_memory_url, 'unlock', key])
+    assert isinstance(ret.exception, cdist.ResourceUnlockError)
+
+    # explicit owners compete in the same way
+    ret = runner(['-u', cdist_memory_url, '-o', 'carol', 'lock', key])
+    assert isinstance(ret.exception, cdist.ResourceLockError)
+
+    getuser.return_value = "alice"
+    ret = runner(['-u', cdist_memory_url, 'unlock', key])
+    assert not ret.exception
+    assert not cdist_memory.is_locked(key)
+
+
+def test_lock_process_locks(tmp_path, runner):
+    """
+    Test if locks which are released when the command exits can't be
+    acquired or released by the command, but they can be broken.
+    """
+    url = "file://%s" % tmp_path
+    resource = cdist.registry.from_url(url)
+    resource.push("test", dict(option="value"))
+    resource.lock("test")
+
+    ret = runner(['-u', url, 'lock', 'test'])
+    assert isinstance(ret.exception, cdist.ResourceError)
+    assert "can't be held by cdist-cli" in str(ret.exception)
+
+    ret = runner(['-u', url, 'unlock', 'test'])
+    assert isinstance(ret.exception, cdist.ResourceError)
+    assert resource.is_locked("test")
+
+    ret = runner(['-u', url, 'unlock', '--force', 'test'])
+    assert not ret.exception
+    assert not resource.is_locked("test")
+
+
+def test_serve_metrics_not_supported(runner):
+    """
+    Test if metrics can't be served by a resource without lock statistics.
+    """
+    ret = runner(['-u', 'memory://', 'serve-metrics'])
+    assert isinstance(ret.exception, cdist.ResourceError)
+    assert "doesn't collect lock statistics" in str(ret.exception)
+
+
+def test_serve_metrics(mocker, runner):
+    """
+    Test if metrics server is started on the requested address.
+    """
+    mocker.patch("cdist.redis.RedisResource.lock_stats", return_value={})
+    server = mocker.patch("cdist.command.MetricsServer")
+    server.return_value.server_address = ("0.0.0.0", 9999)
+
+    ret = runner(['serve-metrics', '-l', '0.0.0.0', '-P', '9999'])
+    assert not ret.exception
+
+    server.assert_called_once()
+    assert server.call_args[0][0] == ("0.0.0.0", 9999)
+    server.return_value.serve_forever.assert_called_once()
+    assert "http://0.0.0.0:9999/metrics" in ret.output
+
+
+def test_locks(runner, cdist_memory, cdist_memory_url):
+    """
+    Test if held locks are shown with their owner.
+    """
+    cdist_memory.push("test0", dict(option="value"))
+    cdist_memory.push("test1", dict(option="value"))
+    cdist_memory.lock("test0")
+
+    ret = runner(['-u', cdist_memory_url, 'locks'])
+    assert not ret.exception
+    assert "- test0: Locked by %s" % cdist_memory.owner in ret.output
+    assert "test1" not in ret.output
+
+    ret = runner(['-u', cdist_memory_url, 'locks', '--json'])
+    assert not ret.exception
+    assert json.loads(ret.output) == [dict(
+        name="test0",
+        owner=cdist_memory.owner,
+        host=None,
+        pid=None,
+        session=None,
+        acquired=None,
+        expires=None,
+        stale=False,
+    )]
+
+
+def test_locks_force_break_stale(mocker, runner):
+    """
+    Test if stale locks are broken before showing the held locks.
+    """
+    mocker.patch(
+        "cdist.redis.RedisResource.break_stale",
+        return_value=["test0"])
+    mocker.patch(
+        "cdist.redis.RedisResource.locks",
+        return_value=dict(test1=cdist.LockInfo(
+            "owner", "myhost", 1234, "job-1", 1.0, 61.0, True)))
+
+    ret = runner(['locks', '--force-break-stale'])
+    assert not ret.exception
+    assert "- test0: stale lock broken" in ret.output
+    assert "- test1: Stale by owner (myhost:1234), session job-1" \
+        in ret.output
+    assert "expired" in ret.output
+
+
+def test_watch(runner, cdist_memory, cdist_memory_url):
+    """
+    Test if changes of the configurations are shown as they happen.
+    """
+    timer = threading.Timer(
+        0.2, cdist_memory.push, args=("test0", dict(option="value")))
+    timer.start()
+
+    ret = runner(['-u', cdist_memory_url, 'watch', 'test*', '-t', '1'])
+    timer.join()
+
+    assert not ret.exception
+    assert "- test0: pushed" in ret.output
+
+    timer = threading.Timer(0.2, cdist_memory.lock, args=("test0",))
+    timer.start()
+
+    ret = runner(['-u', cdist_memory_url, 'watch', '--json', '-t', '1'])
+    timer.join()
+
+    assert not ret.exception
+    assert json.loads(ret.output) == dict(
+        id=None, kind="lock", name="test0", expires=None)
@@ -0,0 +1,348 @@
+"""
+file module tests.
+"""
+import os
+import sys
+import fcntl
+import time
+import threading
+import subprocess
+import pytest
+from cdist.file import FileResource
+from cdist.file import F_OFD_SETLK
+from cdist.file import WHOLE_FILE_LOCK
+from cdist.registry import from_url
+from cdist import ConfigStatus
+from cdist import ResourcePushError
+from cdist import ResourcePullError
+from cdist import ResourceLockError
+from cdist import ResourceUnlockError
+from cdist import ResourceNotExistError
+
+
+@pytest.fixture
+def resource(tmp_path):
+    """
+    Resource to test.
+    """
+    return FileResource(path=str(tmp_path))
+
+
+@pytest.fixture
+def other(tmp_path):
+    """
+    Another resource sharing the same directory.
+    """
+    return FileResource(path=str(tmp_path), owner="other")
+
+
+def test_from_url(tmp_path):
+    """
+    Test if resource is created from a file URL.
+    """
+    resource = from_url("file://" + str(tmp_path), namespace="test")
+    assert isinstance(resource, FileResource)
+    assert os.path.isdir(os.path.join(str(tmp_path), "test", "config"))
+
+    with pytest.raises(ValueError):
+        FileResource.from_url("file://remote/path")
+
+    with pytest.raises(ValueError):
+        FileResource()
+
+
+def test_args_error(resource):
+    """
+    Test methods with wrong arguments.
+    """
+    for method in ["pull", "version", "lock", "unlock", "renew",
+                   "is_locked", "delete"]:
+        with pytest.raises(ValueError):
+            getattr(resource, method)("")
+
+    with pytest.raises(ValueError):
+        resource.push("test", None)
+
+    with pytest.raises(ResourcePushError):
+        resource.push("test", dict())
+
+
+def test_push_and_pull(resource, other):
+    """
+    Push configurations and read them back from another instance.
+    """
+    config = dict(test0="data0", test1="data1")
+
+    assert resource.push("rig/0", config)
+    assert not resource.push("rig/0", dict(reversed(list(config.items()))))
+    assert other.pull("rig/0") == config
+    assert other.version("rig/0") == resource.version("rig/0")
+
+    # cached copy is invalidated when file is replaced
+    assert resource.push("rig/0", dict(test0="data1"))
+    assert other.pull("rig/0") == dict(test0="data1")
+
+    # cached copy can't be changed by the caller
+    other.pull("rig/0")["test0"] = "changed"
+    assert other.pull("rig/0") == dict(test0="data1")
+
+    assert sorted(other.keys()) == ["rig/0"]
+
+    resource.delete("rig/0")
+    assert other.keys() == []
+
+    with pytest.raises(ResourceNotExistError):
+        other.pull("rig/0")
+
+    with pytest.raises(ResourceNotExistError):
+        other.version("rig/0")
+
+    with pytest.raises(ResourceNotExistError):
+        resource.delete("rig/0")
+
+
+def test_extends(resource, other):
+    """
+    Test if configurations inherit the options of their parents, which are
+    read from the cached files.
+    """
+    resource.push("base", dict(test0="base", test1="base"))
+    resource.push("rig/0", dict(test1="rig", cdist_extends="base"))
+
+    assert other.pull("rig/0") == dict(
+        test0="base", test1="rig", cdist_extends="base")
+    assert other.pull("rig/0", resolve=False) == dict(
+        test1="rig", cdist_extends="base")
+
+    version = other.version("rig/0")
+    resource.push("base", dict(test0="changed"))
+    assert other.pull("rig/0")["test0"] == "changed"
+    assert other.version("rig/0") != version
+
+    # merged copy can't change the cached files
+    other.pull("rig/0")["test0"] = "rig"
+    assert other.pull("base") == dict(test0="changed")
+
+    resource.delete("base")
+    with pytest.raises(ResourcePullError):
+        other.pull("rig/0")
+
+
+def test_dot_keys(resource, other):
+    """
+    Test if keys starting with a dot are listed and locked like the others.
+    """
+    keys = [".hidden", ".", ".."]
+    for key in keys:
+        assert resource.push(key, dict(test0="data0"))
+
+    assert sorted(other.keys()) == sorted(keys)
+
+    for key in keys:
+        resource.lock(key)
+        assert other.is_locked(key)
+        resource.unlock(key)
+        assert other.pull(key) == dict(test0="data0")
+
+        resource.delete(key)
+
+    assert other.keys() == []
+
+
+def test_push_atomic(resource, other):
+    """
+    Test if readers never see partially written configurations.
+    """
+    configs = [dict(("option%d" % i, str(value) * 1000) for i in range(50))
+               for value in range(2)]
+    resource.push("test", configs[0])
+
+    stop = threading.Event()
+    errors = []
+
+    def _read():
+        while not stop.is_set():
+            if other.pull("test") not in configs:
+                errors.append("partial configuration")
+
+    thread = threading.Thread(target=_read)
+    thread.start()
+
+    for index in range(200):
+        resource.push("test", configs[index % 2])
+
+    stop.set()
+    thread.join()
+
+    assert not errors
+    assert os.listdir(resource._config_dir) == ["test.json"]
+
+
+def test_lock_and_unlock(resource, other):
+    """
+    Test locks ownership and status.
+    """
+    with pytest.raises(ResourceNotExistError):
+        resource.lock("test")
+
+    resource.push("test", dict(test0="data0"))
+    assert not other.is_locked("test")
+
+    resource.lock("test")
+    resource.lock("test")
+    resource.renew("test")
+    assert other.is_locked("test")
+    assert other.status_many(["test", "missing"]) == dict(
+        test=ConfigStatus(True, True, resource.owner),
+        missing=ConfigStatus(False, False, None),
+    )
+
+    # push doesn't touch the lock
+    resource.push("test", dict(test0="data1"))
+    assert other.is_locked("test")
+
+    with pytest.raises(ResourceLockError):
+        other.lock("test")
+
+    with pytest.raises(ResourceUnlockError):
+        other.unlock("test")
+
+    with pytest.raises(ResourceLockError):
+        other.renew("test")
+
+    resource.unlock("test")
+    assert not other.is_locked("test")
+
+    other.lock("test")
+    other.unlock("test")
+
+
+def test_unlock_force(resource, other):
+    """
+    Test if a lock can be broken by another owner.
+    """
+    resource.push("test", dict(test0="data0"))
+    resource.lock("test")
+
+    other.unlock("test", force=True)
+    assert not other.is_locked("test")
+
+    with pytest.raises(ResourceLockError):
+        resource.renew("test")
+
+    other.lock("test")
+    assert resource.is_locked("test")
+
+    # the previous owner doesn't release the new lock
+    resource.unlock("test", force=True)
+    resource.lock("test")
+    resource.unlock("test")
+
+
+def test_lock_blocking(resource, other):
+    """
+    Test if a waiter gets the lock as soon as it's released.
+    """
+    resource.push("test", dict(test0="data0"))
+    resource.lock("test")
+
+    with pytest.raises(ResourceLockError):
+        other.lock("test", timeout=0.1, blocking=True)
+
+    timer = threading.Timer(0.2, resource.unlock, args=("test",))
+    timer.start()
+
+    start = time.monotonic()
+    other.lock("test", timeout=10, blocking=True)
+    assert time.monotonic() - start < 5
+    assert resource.is_locked("test")
+
+    timer.join()
+
+
+def test_lock_status_not_locking(resource, other):
+    """
+    Test if lock status checks don't make lock attempts fail.
+    """
+    resource.push("test", dict(test0="data0"))
+    stop = threading.Event()
+
+    def check():
+        while not stop.is_set():
+            other.is_locked("test")
+
+    thread = threading.Thread(target=check)
+    thread.start()
+
+    try:
+        for _ in range(200):
+            resource.lock("test")
+            resource.unlock("test")
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_lock_empty_owner(resource, other):
+    """
+    Test if a lock whose owner has not been written yet is reported locked.
+    """
+    resource.push("test", dict(test0="data0"))
+
+    fd = os.open(resource._lock_path("test"), os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.fcntl(fd, F_OFD_SETLK, WHOLE_FILE_LOCK)
+
+        assert other.is_locked("test")
+        assert other.status_many(["test"])["test"] == \
+            ConfigStatus(True, True, "")
+
+        with pytest.raises(ResourceLockError):
+            other.lock("test")
+    finally:
+        os.close(fd)
+
+    assert not other.is_locked("test")
+
+
+def test_lock_released_by_dead_process(tmp_path, resource):
+    """
+    Test if lock is released when the process holding it dies.
+    """
+    resource.push("test", dict(test0="data0"))
+
+    code = (
+        "import sys, time\n"
+        "from cdist.file import FileResource\n"
+        "FileResource(path=sys.argv[1], owner='child').lock('test')\n"
+        "print('locked', flush=True)\n"
+        "time.sleep(60)\n"
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-c", code, str(tmp_path)],
+        stdout=subprocess.PIPE)
+
+    try:
+        assert proc.stdout.readline().strip() == b"locked"
+        assert resource.status_many(["test"])["test"].owner == "child"
+
+        with pytest.raises(ResourceLockError):
+            resource.lock("test")
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+    assert not resource.is_locked("test")
+    resource.lock("test")
+
+
+def test_lock_any(resource, other):
+    """
+    Test if the first free configuration of a group is locked.
+    """
+    resource.push("rig-0", dict(cdist_tags="arm"))
+    resource.push("rig-1", dict(cdist_tags="arm,lab"))
+
+    assert resource.lock_any("rig-*", ["arm"]) == "rig-0"
+    assert other.lock_any("rig-*", ["arm"]) == "rig-1"
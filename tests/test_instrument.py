@@ -0,0 +1,217 @@
+"""
+Unittests for resource operations instrumentation.
+"""
+import json
+import asyncio
+import threading
+import pytest
+from cdist import instrument
+from cdist.memory import MemoryResource
+from cdist.redis import RedisResource
+from cdist.resource import ResourceNotExistError
+
+pytest_plugins = ["pytester"]
+
+
+@pytest.fixture
+def operations():
+    """
+    Operations reported to a listener.
+    """
+    items = list()
+    instrument.add_listener(items.append)
+    yield items
+    instrument.remove_listener(items.append)
+
+
+def test_no_listeners(cdist_memory):
+    """
+    Test if operations are not measured without listeners.
+    """
+    cdist_memory.push("test", dict(option="value"))
+
+    assert instrument.current() is None
+
+
+def test_operations(cdist_memory, operations):
+    """
+    Test if every operation is reported once, with its key and error.
+    """
+    cdist_memory.push("test", dict(option="value"))
+    cdist_memory.lock("test")
+    cdist_memory.unlock("test")
+
+    with pytest.raises(ResourceNotExistError):
+        cdist_memory.pull("other")
+
+    assert [(item.name, item.key) for item in operations] == [
+        ("push", "test"),
+        ("lock", "test"),
+        ("unlock", "test"),
+        ("pull", "other"),
+    ]
+    assert all(item.duration >= 0 for item in operations)
+    assert isinstance(operations[-1].error, ResourceNotExistError)
+
+
+def test_operations_keyword(cdist_memory, operations):
+    """
+    Test if keys passed as keyword arguments are reported.
+    """
+    cdist_memory.push(key="test", config=dict(option="value"))
+    cdist_memory.lock(key="test", blocking=False)
+    cdist_memory.pull_many(["test"])
+
+    assert [(item.name, item.key) for item in operations] == [
+        ("push", "test"),
+        ("lock", "test"),
+        ("pull_many", None),
+    ]
+
+
+def test_nested_operations(cdist_memory, operations):
+    """
+    Test if operations executed by another operation are not reported.
+    """
+    errors = cdist_memory.push_many([
+        ("test0", dict(option="value")),
+        ("test1", dict(option="value")),
+    ])
+    assert not errors
+
+    assert [(item.name, item.key) for item in operations] == [
+        ("push_many", None),
+    ]
+
+
+def test_lock_wait(cdist_memory_url, operations):
+    """
+    Test if time spent waiting for a lock is measured.
+    """
+    owner = MemoryResource.from_url(cdist_memory_url)
+    waiter = MemoryResource.from_url(cdist_memory_url)
+
+    owner.push("test", dict(option="value"))
+    owner.lock("test")
+
+    timer = threading.Timer(0.2, owner.unlock, args=("test",))
+    timer.start()
+    waiter.lock("test", timeout=5, blocking=True)
+    timer.join()
+
+    lock = [item for item in operations
+            if item.name == "lock" and item.wait > 0]
+    assert len(lock) == 1
+    assert 0.1 < lock[0].wait <= lock[0].duration
+
+
+def test_redis_roundtrips(address, operations):
+    """
+    Test if round trips and transferred bytes of a Redis resource are
+    measured.
+    """
+    resource = RedisResource(hostname=address[0], port=address[1])
+    resource.push("instrument", dict(option="value"))
+    operations.clear()
+
+    assert resource.pull("instrument") == dict(option="value")
+
+    pull = operations[0]
+    assert pull.name == "pull"
+    assert pull.roundtrips == 1
+    assert pull.sent > 0
+    assert pull.received > 0
+
+    resource.delete("instrument")
+
+
+def test_async_operations(address, operations):
+    """
+    Test if operations of an asynchronous resource are measured.
+    """
+    from cdist.aioredis import AsyncRedisResource
+
+    async def _run():
+        resource = AsyncRedisResource(hostname=address[0], port=address[1])
+        await resource.push("instrument", dict(option="value"))
+        await resource.pull("instrument")
+        await resource.delete("instrument")
+        await resource.close()
+
+    asyncio.run(_run())
+
+    assert [item.name for item in operations] == ["push", "pull", "delete"]
+    assert operations[1].roundtrips == 1
+    assert operations[1].sent > 0
+
+
+def test_plugin_timings(testdir, cdist_memory, cdist_memory_url):
+    """
+    Test if plugin reports the operations with the pytest hook, the
+    terminal summary and the JSON file.
+    """
+    cdist_memory.push("test", dict(test_param="full"))
+
+    testdir.makeconftest(
+        """
+        def pytest_cdist_operation(config, operation):
+            with open("operations.txt", "a") as data:
+                data.write(operation.name + "\\n")
+    """)
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_url = %s
+    """ % cdist_memory_url)
+    testdir.makepyfile(test_instrument_plugin="""
+        def test_parameter():
+            pass
+    """)
+
+    result = testdir.runpytest(
+        "--cdist-config=test",
+        "--cdist-timings",
+        "--cdist-timings-json=timings.json")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        "*cdist operations*",
+        "operation*calls*",
+        "lock *1*",
+        "pull *1*",
+        "unlock *1*",
+    ])
+
+    with open(str(testdir.tmpdir.join("operations.txt"))) as data:
+        assert data.read().split() == ["lock", "version", "pull", "unlock"]
+
+    with open(str(testdir.tmpdir.join("timings.json"))) as data:
+        timings = json.load(data)
+
+    assert [item["name"] for item in timings] == [
+        "lock", "version", "pull", "unlock"]
+    assert timings[0]["key"] == "test"
+    assert timings[0]["error"] is None
+
+
+def test_plugin_disabled(testdir, cdist_memory, cdist_memory_url):
+    """
+    Test if plugin doesn't measure operations when timings are not
+    requested.
+    """
+    cdist_memory.push("test", dict(test_param="full"))
+
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_url = %s
+    """ % cdist_memory_url)
+    testdir.makepyfile(test_instrument_plugin="""
+        from cdist import instrument
+
+        def test_listeners():
+            assert not instrument._LISTENERS
+    """)
+
+    result = testdir.runpytest("--cdist-config=test")
+    result.assert_outcomes(passed=1)
+    assert "cdist operations" not in result.stdout.str()
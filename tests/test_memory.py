@@ -0,0 +1,339 @@
+"""
+memory module tests.
+"""
+import time
+import threading
+import pytest
+from cdist.memory import MemoryResource
+from cdist.registry import from_url
+from cdist.resource import config_hash
+from cdist import ConfigStatus
+from cdist import ResourcePushError
+from cdist import ResourceInheritanceError
+from cdist import ResourceLockError
+from cdist import ResourceUnlockError
+from cdist import ResourceNotExistError
+
+pytest_plugins = ["pytester"]
+
+
+@pytest.fixture
+def other(cdist_memory_url):
+    """
+    Another resource sharing the same store.
+    """
+    return from_url(cdist_memory_url, owner="other")
+
+
+def test_from_url(cdist_memory, cdist_memory_url, other):
+    """
+    Test if resources created with the same URL share the same store.
+    """
+    assert isinstance(other, MemoryResource)
+
+    cdist_memory.push("test", dict(test0="data0"))
+    assert other.pull("test") == dict(test0="data0")
+
+    # namespaces are separated
+    assert from_url(cdist_memory_url, namespace="other").keys() == []
+    assert from_url("memory://other").keys() == []
+
+
+def test_args_error(cdist_memory):
+    """
+    Test methods with wrong arguments.
+    """
+    for method in ["pull", "version", "lock", "unlock", "renew",
+                   "is_locked", "delete"]:
+        with pytest.raises(ValueError):
+            getattr(cdist_memory, method)("")
+
+    with pytest.raises(ValueError):
+        cdist_memory.push("test", None)
+
+    with pytest.raises(ResourcePushError):
+        cdist_memory.push("test", dict())
+
+
+def test_push_and_pull(cdist_memory):
+    """
+    Push a configuration, pull it and delete it.
+    """
+    config = dict(test0="data0", test1="data1")
+
+    assert cdist_memory.push("test", config)
+    assert not cdist_memory.push("test", dict(test1="data1", test0="data0"))
+    version = cdist_memory.version("test")
+
+    # stored configuration can't be changed by the caller
+    cdist_memory.pull("test")["test0"] = "changed"
+    config["test0"] = "changed"
+    assert cdist_memory.pull("test") == dict(test0="data0", test1="data1")
+
+    assert cdist_memory.push("test", config)
+    assert cdist_memory.version("test") != version
+    assert cdist_memory.keys() == ["test"]
+
+    cdist_memory.delete("test")
+    assert cdist_memory.keys() == []
+
+    for method in ["pull", "version", "lock", "unlock", "is_locked",
+                   "delete"]:
+        with pytest.raises(ResourceNotExistError):
+            getattr(cdist_memory, method)("test")
+
+
+def test_lock_and_unlock(cdist_memory, other):
+    """
+    Test locks ownership and status.
+    """
+    cdist_memory.push("test", dict(test0="data0"))
+    cdist_memory.lock("test")
+    cdist_memory.lock("test")
+    cdist_memory.renew("test")
+
+    assert other.status_many(["test", "missing"]) == dict(
+        test=ConfigStatus(True, True, cdist_memory.owner),
+        missing=ConfigStatus(False, False, None),
+    )
+
+    with pytest.raises(ResourceLockError):
+        other.lock("test")
+
+    # attempts without waiting don't create any queue
+    assert not cdist_memory._store.queues
+
+    with pytest.raises(ResourceUnlockError):
+        other.unlock("test")
+
+    with pytest.raises(ResourceLockError):
+        other.renew("test")
+
+    other.unlock("test", force=True)
+    assert not cdist_memory.is_locked("test")
+
+    with pytest.raises(ResourceLockError):
+        cdist_memory.renew("test")
+
+
+def test_lock_ttl(cdist_memory_url):
+    """
+    Test if a lock expires when it's not renewed.
+    """
+    resource = from_url(cdist_memory_url, lock_ttl=0.1)
+    other = from_url(cdist_memory_url, owner="other")
+
+    resource.push("test", dict(test0="data0"))
+    resource.lock("test")
+
+    start = time.monotonic()
+    other.lock("test", timeout=5, blocking=True)
+    assert 0.05 < time.monotonic() - start < 2
+
+    with pytest.raises(ResourceLockError):
+        resource.renew("test")
+
+
+def test_lock_blocking_fifo(cdist_memory_url):
+    """
+    Test if waiters are served in arrival order.
+    """
+    owner = from_url(cdist_memory_url, owner="owner")
+    owner.push("test", dict(test0="data0"))
+    owner.lock("test")
+
+    order = []
+
+    def _wait(name):
+        waiter = from_url(cdist_memory_url, owner=name)
+        waiter.lock("test", timeout=10, blocking=True)
+        order.append(name)
+        waiter.unlock("test")
+
+    threads = []
+    for index in range(5):
+        thread = threading.Thread(target=_wait, args=("waiter%d" % index,))
+        thread.start()
+        threads.append(thread)
+
+        # wait until the waiter is queued
+        while len(owner._store.queues.get(("cdist", "test"), [])) <= index:
+            time.sleep(0.001)
+
+    # waiters can't overtake the queue
+    with pytest.raises(ResourceLockError):
+        from_url(cdist_memory_url, owner="late").lock("test")
+
+    owner.unlock("test")
+    for thread in threads:
+        thread.join()
+
+    assert order == ["waiter%d" % index for index in range(5)]
+
+
+def test_lock_blocking_timeout(cdist_memory, other):
+    """
+    Test if waiting for a locked configuration times out.
+    """
+    cdist_memory.push("test", dict(test0="data0"))
+    cdist_memory.lock("test")
+
+    start = time.monotonic()
+    with pytest.raises(ResourceLockError):
+        other.lock("test", timeout=0.1, blocking=True)
+    assert time.monotonic() - start < 2
+
+    assert not cdist_memory._store.queues
+
+
+def test_lock_contention(cdist_memory_url):
+    """
+    Test if many threads competing for the same lock never own it at the
+    same time.
+    """
+    from_url(cdist_memory_url).push("test", dict(test0="data0"))
+
+    holders = []
+    overlaps = []
+
+    def _client(name):
+        resource = from_url(cdist_memory_url, owner=name)
+        for _ in range(50):
+            resource.lock("test", timeout=30, blocking=True)
+            holders.append(name)
+            if len(holders) > 1:
+                overlaps.append(list(holders))
+            holders.remove(name)
+            resource.unlock("test")
+
+    threads = [threading.Thread(target=_client, args=("client%d" % i,))
+               for i in range(16)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert not overlaps
+
+
+def test_lock_any(cdist_memory, other):
+    """
+    Test if the first free configuration of a group is locked.
+    """
+    cdist_memory.push("rig-0", dict(cdist_tags="arm"))
+    cdist_memory.push("rig-1", dict(cdist_tags="arm,lab"))
+
+    assert cdist_memory.lock_any("rig-*", ["arm"]) == "rig-0"
+    assert other.lock_any("rig-*", ["arm"]) == "rig-1"
+
+
+def test_extends(cdist_memory):
+    """
+    Test if configurations inherit the options of their parents.
+    """
+    cdist_memory.push("base", dict(
+        test0="base", test1="base", cdist_tags="base"))
+    cdist_memory.push("lab", dict(
+        test1="lab", test2="lab", cdist_extends="base"))
+    cdist_memory.push("other", dict(test2="other"))
+    cdist_memory.push("rig", dict(test3="rig", cdist_extends="lab, other"))
+
+    assert cdist_memory.pull("rig") == dict(
+        test0="base",
+        test1="lab",
+        test2="other",
+        test3="rig",
+        cdist_extends="lab, other")
+    assert cdist_memory.pull("rig", resolve=False) == dict(
+        test3="rig", cdist_extends="lab, other")
+    assert cdist_memory.pull_many(["rig", "none"])["none"] is None
+
+    # version changes when a parent is pushed
+    version = cdist_memory.version("rig")
+    cdist_memory.push("base", dict(test0="changed"))
+    assert cdist_memory.pull("rig")["test0"] == "changed"
+    assert cdist_memory.version("rig") != version
+    assert cdist_memory.version("base") == config_hash(dict(test0="changed"))
+
+
+def test_extends_error(cdist_memory):
+    """
+    Test if missing parents and circular inheritance can't be resolved.
+    """
+    cdist_memory.push("rig", dict(test0="rig", cdist_extends="lab"))
+
+    with pytest.raises(ResourceInheritanceError):
+        cdist_memory.pull("rig")
+
+    with pytest.raises(ResourceInheritanceError):
+        cdist_memory.version("rig")
+
+    errors = dict()
+    assert cdist_memory.pull_many(["rig", "none"], errors=errors) == dict(
+        rig=None, none=None)
+    assert list(errors) == ["rig"]
+
+    cdist_memory.push("lab", dict(test0="lab", cdist_extends="rig"))
+
+    with pytest.raises(ResourceInheritanceError):
+        cdist_memory.pull("rig")
+
+    with pytest.raises(ResourceNotExistError):
+        cdist_memory.pull("none")
+
+
+def test_watch(cdist_memory, other):
+    """
+    Test if changes of the matching configurations are watched.
+    """
+    def _changes():
+        time.sleep(0.2)
+        other.push("rig-0", dict(option="value"))
+        other.push("test", dict(option="value"))
+        other.lock("rig-0")
+        other.renew("rig-0")
+        other.unlock("rig-0")
+
+    thread = threading.Thread(target=_changes)
+    thread.start()
+    events = list(cdist_memory.watch(pattern="rig-*", timeout=1))
+    thread.join()
+
+    assert [(event.kind, event.name) for event in events] == [
+        ("push", "rig-0"),
+        ("lock", "rig-0"),
+        ("unlock", "rig-0"),
+    ]
+
+    with pytest.raises(NotImplementedError):
+        next(cdist_memory.watch(since="1"))
+
+
+def test_plugin(testdir, cdist_memory, cdist_memory_url):
+    """
+    Test if the plugin runs with a memory resource.
+    """
+    cdist_memory.push("test", dict(test_param="full"))
+
+    testdir.makeconftest(
+        """
+        def pytest_addoption(parser):
+            parser.addini("test_param", "test parameter", default="empty")
+    """)
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_url = %s
+    """ % cdist_memory_url)
+    testdir.makepyfile(test_memory_plugin="""
+        def test_parameter(pytestconfig):
+            assert pytestconfig.getini("test_param") == "full"
+    """)
+
+    result = testdir.inline_run(
+        "--cdist-config=test",
+        "-p", "no:cacheprovider")
+    result.assertoutcome(passed=1)
+
+    assert not cdist_memory.is_locked("test")
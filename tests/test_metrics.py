@@ -0,0 +1,92 @@
+"""
+Unittests for lock statistics exporter.
+"""
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from cdist import LockStats
+from cdist.metrics import MetricsServer
+from cdist.metrics import format_metrics
+from cdist.redis import RedisResource
+
+
+def test_format_metrics():
+    """
+    Test if lock statistics are formatted in the Prometheus text format.
+    """
+    inf = float("inf")
+    stats = {
+        'my"config': LockStats(
+            acquired=3,
+            stale=1,
+            hold={1.0: 1, 5.0: 2, inf: 2},
+            hold_sum=4.5,
+            wait={0.1: 3, inf: 3},
+            wait_sum=0.0),
+    }
+
+    lines = format_metrics(stats).splitlines()
+
+    assert "# TYPE cdist_lock_acquisitions_total counter" in lines
+    assert 'cdist_lock_acquisitions_total{config="my\\"config"} 3' in lines
+    assert 'cdist_lock_stale_total{config="my\\"config"} 1' in lines
+    assert "# TYPE cdist_lock_hold_seconds histogram" in lines
+    assert lines.index(
+        'cdist_lock_hold_seconds_bucket{config="my\\"config",le="1.0"} 1') \
+        < lines.index(
+        'cdist_lock_hold_seconds_bucket{config="my\\"config",le="+Inf"} 2')
+    assert 'cdist_lock_hold_seconds_sum{config="my\\"config"} 4.5' in lines
+    assert 'cdist_lock_hold_seconds_count{config="my\\"config"} 2' in lines
+    assert 'cdist_lock_wait_seconds_count{config="my\\"config"} 3' in lines
+
+
+@pytest.fixture
+def server(address):
+    """
+    Metrics server of a Redis resource.
+    """
+    resource = RedisResource(hostname=address[0], port=address[1])
+    server = MetricsServer(("127.0.0.1", 0), resource)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server, resource
+
+    server.shutdown()
+    server.server_close()
+    resource.close()
+
+
+def test_serve_metrics(request, server):
+    """
+    Test if metrics are served over HTTP.
+    """
+    server, resource = server
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+    resource.unlock(key)
+
+    url = "http://%s:%d/metrics" % server.server_address[:2]
+    with urllib.request.urlopen(url) as response:
+        assert response.headers["Content-Type"].startswith("text/plain")
+        body = response.read().decode()
+
+    assert 'cdist_lock_acquisitions_total{config="%s"} 1' % key in body
+
+    resource.delete(key)
+
+
+def test_serve_metrics_not_found(server):
+    """
+    Test if metrics are served on the /metrics path only.
+    """
+    server, _ = server
+
+    url = "http://%s:%d/other" % server.server_address[:2]
+    with pytest.raises(urllib.error.HTTPError) as err:
+        urllib.request.urlopen(url)
+
+    assert err.value.code == 404
@@ -1,8 +1,13 @@
 """
 cdist plugin tests.
 """
+import sys
+import time
+import threading
+import subprocess
 import pytest
 import cdist
+from cdist.session import Heartbeat
 
 pytest_plugins = ["pytester"]
 
@@ -34,8 +39,10 @@ def _setup(testdir, mocker):
 
     mocker.patch('cdist.redis.RedisResource.__init__', return_value=None)
     mocker.patch("cdist.redis.RedisResource.pull", return_value=config_dict)
+    mocker.patch("cdist.redis.RedisResource.version", return_value="v1")
     mocker.patch("cdist.redis.RedisResource.lock")
     mocker.patch("cdist.redis.RedisResource.unlock")
+    mocker.patch("cdist.redis.RedisResource.renew")
 
 
 def test_pull_config(testdir, mocker):
@@ -66,13 +73,451 @@ def test_parameters(testdir, mocker):
         [pytest]
         cdist_hostname = 192.168.1.1
         cdist_port = 2244
+        cdist_namespace = mynamespace
         cdist_autolock = False
     """)
 
     result = testdir.runpytest("--cdist-config=test")
 
     cdist.redis.RedisResource.__init__.assert_called_with(
-        hostname="192.168.1.1", port=2244)
+        hostname="192.168.1.1",
+        port=2244,
+        namespace="mynamespace",
+        lock_ttl=60.0)
     cdist.redis.RedisResource.pull.assert_called_with("test")
     cdist.redis.RedisResource.lock.assert_not_called()
     cdist.redis.RedisResource.unlock.assert_not_called()
+
+
+def test_lock_heartbeat(testdir, mocker):
+    """
+    Test if lock lease is renewed while session is running.
+    """
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_lock_ttl = 0.3
+    """)
+
+    testdir.makepyfile(
+        """
+        import time
+
+        def test_slow():
+            time.sleep(0.5)
+    """)
+
+    result = testdir.runpytest("--cdist-config=test")
+    result.assert_outcomes(passed=1)
+
+    cdist.redis.RedisResource.__init__.assert_called_with(
+        hostname="localhost",
+        port=6379,
+        namespace="cdist",
+        lock_ttl=0.3)
+    cdist.redis.RedisResource.lock.assert_called_with("test")
+    cdist.redis.RedisResource.renew.assert_called_with("test")
+    cdist.redis.RedisResource.unlock.assert_called_with("test")
+
+
+def test_heartbeat_lock_lost(mocker):
+    """
+    Test if heartbeat stops when lock has been lost.
+    """
+    client = mocker.Mock()
+    client.renew.side_effect = cdist.ResourceLockError()
+
+    heartbeat = Heartbeat(client, "test", 0.01)
+    heartbeat.start()
+    heartbeat.join(timeout=5)
+
+    assert not heartbeat.is_alive()
+    assert isinstance(heartbeat.error, cdist.ResourceLockError)
+    client.renew.assert_called_once_with("test")
+
+
+def test_heartbeat_connection_error(mocker):
+    """
+    Test if heartbeat keeps renewing lock after temporary errors.
+    """
+    client = mocker.Mock()
+
+    def _renew(key):
+        if client.renew.call_count == 1:
+            raise cdist.ResourceConnectionError()
+
+    client.renew.side_effect = _renew
+
+    heartbeat = Heartbeat(client, "test", 0.01)
+    heartbeat.start()
+
+    deadline = time.time() + 5
+    while client.renew.call_count < 3 and time.time() < deadline:
+        time.sleep(0.01)
+
+    heartbeat.stop()
+
+    assert client.renew.call_count >= 3
+    assert heartbeat.error is None
+
+
+def test_lock_timeout(testdir, mocker):
+    """
+    Test if session waits for a locked configuration.
+    """
+    testdir.makepyfile(
+        """
+        def test_parameter(pytestconfig):
+            assert pytestconfig.getini("test_param1") == "full"
+    """)
+
+    result = testdir.runpytest(
+        "--cdist-config=test",
+        "--cdist-lock-timeout=10")
+    result.assert_outcomes(passed=1)
+
+    cdist.redis.RedisResource.lock.assert_called_with(
+        "test", timeout=10.0, blocking=True)
+    cdist.redis.RedisResource.unlock.assert_called_with("test")
+
+
+def test_configurations_group(testdir, mocker):
+    """
+    Test if the first free configuration of a group is used.
+    """
+    mocker.patch("cdist.redis.RedisResource.lock_any", return_value="rig-02")
+
+    testdir.makepyfile(
+        """
+        def test_parameter(pytestconfig):
+            assert pytestconfig.getini("test_param1") == "full"
+    """)
+
+    result = testdir.runpytest(
+        "--cdist-config=rig-*",
+        "--cdist-tags=arm,lab")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        "*configuration: rig-02*",
+        "*pattern: rig-[*], tags: arm,lab*",
+    ])
+
+    cdist.redis.RedisResource.lock_any.assert_called_with(
+        "rig-*", ["arm", "lab"])
+    cdist.redis.RedisResource.lock.assert_not_called()
+    cdist.redis.RedisResource.pull.assert_called_with("rig-02")
+    cdist.redis.RedisResource.unlock.assert_called_with("rig-02")
+
+
+def test_configurations_group_no_autolock(testdir, mocker):
+    """
+    Test if configurations group can't be used without autolock.
+    """
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_autolock = False
+    """)
+
+    result = testdir.runpytest("--cdist-tags=arm")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+
+
+def test_config_cache(testdir, mocker):
+    """
+    Test if cached configuration is used when its version didn't change.
+    """
+    testdir.makepyfile(
+        """
+        def test_parameter(pytestconfig):
+            assert pytestconfig.getini("test_param1") == "full"
+    """)
+
+    result = testdir.runpytest("--cdist-config=test")
+    result.assert_outcomes(passed=1)
+    assert cdist.redis.RedisResource.pull.call_count == 1
+
+    result = testdir.runpytest("--cdist-config=test")
+    result.assert_outcomes(passed=1)
+    assert cdist.redis.RedisResource.pull.call_count == 1
+    assert cdist.redis.RedisResource.version.call_count == 2
+
+    cdist.redis.RedisResource.version.return_value = "v2"
+
+    result = testdir.runpytest("--cdist-config=test")
+    result.assert_outcomes(passed=1)
+    assert cdist.redis.RedisResource.pull.call_count == 2
+
+
+def test_config_cache_max_age(testdir, mocker):
+    """
+    Test if cached configuration isn't validated within its maximum age.
+    """
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_cache_max_age = 3600
+    """)
+
+    for _ in range(2):
+        result = testdir.runpytest("--cdist-config=test")
+        assert result.ret == pytest.ExitCode.NO_TESTS_COLLECTED
+
+    assert cdist.redis.RedisResource.pull.call_count == 1
+    assert cdist.redis.RedisResource.version.call_count == 1
+
+
+def test_config_cache_disabled(testdir, mocker):
+    """
+    Test if configuration is always pulled when cache is disabled.
+    """
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_cache = False
+    """)
+
+    for _ in range(2):
+        result = testdir.runpytest("--cdist-config=test")
+        assert result.ret == pytest.ExitCode.NO_TESTS_COLLECTED
+
+    assert cdist.redis.RedisResource.pull.call_count == 2
+    cdist.redis.RedisResource.version.assert_not_called()
+
+
+def test_xdist_worker(testdir, mocker):
+    """
+    Test if xdist workers use the configuration received by the controller,
+    without connecting to the resource.
+    """
+    testdir.makeconftest(
+        """
+        def pytest_addoption(parser):
+            parser.addini(
+                "test_param1",
+                "test parameter 1",
+                default="empty"
+            )
+
+        def pytest_configure(config):
+            config.workerinput = dict(
+                workerid="gw0",
+                cdist_config_name="test",
+                cdist_config=dict(test_param1="worker"),
+            )
+    """)
+
+    testdir.makepyfile(
+        """
+        def test_parameter(pytestconfig):
+            assert pytestconfig.getini("test_param1") == "worker"
+    """)
+
+    result = testdir.runpytest("--cdist-config=test")
+    result.assert_outcomes(passed=1)
+
+    cdist.redis.RedisResource.__init__.assert_not_called()
+    cdist.redis.RedisResource.pull.assert_not_called()
+    cdist.redis.RedisResource.lock.assert_not_called()
+    cdist.redis.RedisResource.unlock.assert_not_called()
+
+
+def test_xdist_controller(testdir, mocker):
+    """
+    Test if xdist controller shares the configuration with workers.
+    """
+    testdir.makeconftest(
+        """
+        import pytest
+
+        def pytest_addoption(parser):
+            parser.addini(
+                "test_param1",
+                "test parameter 1",
+                default="empty"
+            )
+
+        @pytest.hookimpl(trylast=True)
+        def pytest_sessionstart(session):
+            class Node:
+                workerinput = dict(workerid="gw0")
+
+            node = Node()
+            plugin = session.config.pluginmanager.get_plugin("plugin.cdist")
+            plugin.pytest_configure_node(node)
+            assert node.workerinput["cdist_config_name"] == "test"
+            assert node.workerinput["cdist_config"] == dict(
+                test_param0="empty",
+                test_param1="full")
+    """)
+
+    result = testdir.runpytest("--cdist-config=test")
+    assert result.ret == pytest.ExitCode.NO_TESTS_COLLECTED
+
+    cdist.redis.RedisResource.lock.assert_called_once_with("test")
+    cdist.redis.RedisResource.unlock.assert_called_once_with("test")
+
+
+def test_url(testdir, mocker):
+    """
+    Test if resource is created from cdist_url.
+    """
+    testdir.makeini(
+        """
+        [pytest]
+        cdist_url = redis://:secret@myhost:2244/2
+        cdist_hostname = ignored
+    """)
+
+    result = testdir.runpytest("--cdist-config=test")
+    assert result.ret == pytest.ExitCode.NO_TESTS_COLLECTED
+    result.stdout.fnmatch_lines([
+        "*resource: redis://:[*][*][*]@myhost:2244/2*"])
+    assert "secret" not in result.stdout.str()
+
+    cdist.redis.RedisResource.__init__.assert_called_with(
+        hostname="myhost",
+        port=2244,
+        db=2,
+        password="secret",
+        namespace="cdist",
+        lock_ttl=60.0)
+
+
+def test_url_error(testdir, mocker):
+    """
+    Test if an unknown backend is a usage error.
+    """
+    result = testdir.runpytest(
+        "--cdist-config=test",
+        "-o", "cdist_url=unknown://myhost")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+
+
+def test_prefetch(testdir, mocker):
+    """
+    Test if configuration is fetched in background during the startup.
+    """
+    threads = list()
+
+    def _lock(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+
+    mocker.patch("cdist.redis.RedisResource.lock", side_effect=_lock)
+
+    testdir.makepyfile(
+        """
+        def test_parameter(pytestconfig):
+            assert pytestconfig.getini("test_param1") == "full"
+    """)
+
+    result = testdir.runpytest("--cdist-config=test")
+    result.assert_outcomes(passed=1)
+
+    assert threads == ["cdist-prefetch"]
+    cdist.redis.RedisResource.unlock.assert_called_with("test")
+
+
+def test_prefetch_timeout(testdir, mocker):
+    """
+    Test if a slow fetch is a usage error and if configuration is unlocked
+    once the abandoned fetch completes.
+    """
+    def _lock(*args, **kwargs):
+        time.sleep(0.5)
+
+    mocker.patch("cdist.redis.RedisResource.lock", side_effect=_lock)
+
+    result = testdir.runpytest(
+        "--cdist-config=test",
+        "-o", "cdist_prefetch_timeout=0.1")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+
+    cdist.redis.RedisResource.unlock.assert_not_called()
+
+    deadline = time.monotonic() + 5
+    while not cdist.redis.RedisResource.unlock.called:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    cdist.redis.RedisResource.unlock.assert_called_with("test")
+
+
+def test_prefetch_error(testdir, mocker):
+    """
+    Test if a failed fetch is a usage error and if configuration is
+    unlocked.
+    """
+    mocker.patch(
+        "cdist.redis.RedisResource.pull",
+        side_effect=cdist.ResourceError("connection lost"))
+
+    result = testdir.runpytest(
+        "--cdist-config=test",
+        "-o", "cdist_cache=False")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+
+    cdist.redis.RedisResource.unlock.assert_called_with("test")
+
+
+def test_prefetch_help(testdir, mocker):
+    """
+    Test if configuration is not locked when session doesn't start.
+    """
+    result = testdir.runpytest("--cdist-config=test", "--help")
+    assert result.ret == pytest.ExitCode.OK
+
+    cdist.redis.RedisResource.lock.assert_not_called()
+
+
+def test_session(testdir, mocker):
+    """
+    Test if session identifier is stored inside the lock records.
+    """
+    result = testdir.runpytest(
+        "--cdist-config=test",
+        "-o", "cdist_session=job-1")
+    assert result.ret == pytest.ExitCode.NO_TESTS_COLLECTED
+
+    cdist.redis.RedisResource.__init__.assert_called_with(
+        hostname="localhost",
+        port=6379,
+        namespace="cdist",
+        lock_ttl=60.0,
+        session="job-1")
+
+
+def test_inactive(testdir, mocker):
+    """
+    Test if plugin doesn't register any hook when cdist is not used.
+    """
+    testdir.makepyfile(
+        """
+        def test_plugin(pytestconfig):
+            manager = pytestconfig.pluginmanager
+            assert manager.get_plugin("plugin.cdist") is None
+    """)
+
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=1)
+
+    cdist.redis.RedisResource.__init__.assert_not_called()
+
+
+def test_import():
+    """
+    Test if plugin entry point doesn't import the resources, measuring the
+    imported modules with -X importtime.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import cdist.plugin"],
+        stderr=subprocess.PIPE,
+        check=True).stderr.decode()
+
+    modules = set(line.rsplit("|", 1)[-1].strip()
+                  for line in output.splitlines()
+                  if line.startswith("import time:"))
+
+    assert set(name for name in modules if name.startswith("cdist")) == {
+        "cdist", "cdist.hooks", "cdist.plugin"}
+    assert "redis" not in modules
@@ -2,13 +2,19 @@
 redis module tests.
 """
 import os
+import socket
+import time
+import threading
 import redis
 import pytest
 from cdist.redis import RedisResource
+from cdist.redis import RedisConnectionPool
+from cdist import ConfigStatus
 from cdist import ResourceError
 from cdist import ResourceConnectionError
 from cdist import ResourcePushError
 from cdist import ResourcePullError
+from cdist import ResourceInheritanceError
 from cdist import ResourceLockError
 from cdist import ResourceUnlockError
 from cdist import ResourceNotExistError
@@ -16,25 +22,22 @@ from cdist import ResourceDeleteError
 
 # mock it's used to find bugs when redis server is not available, but tests
 # should be always executed with a real environment. Use docker in this case.
+# When mocked, a local stand-in of the Redis server is used.
 MOCKED = os.environ.get("CDIST_MOCKED", None)
 
 
 @pytest.fixture
-def resource(request, mocker):
+def resource(address):
     """
     Resource to test.
     """
-    if MOCKED:
-        mocker.patch('redis.Redis.__init__', return_value=None)
-        mocker.patch('redis.Redis.__del__')
-        mocker.patch('redis.Redis.close')
-
     kwargs = dict(
-        hostname="localhost",
-        port="61324"
+        hostname=address[0],
+        port=address[1]
     )
     resource = RedisResource(**kwargs)
-    return resource
+    yield resource
+    resource.close()
 
 
 def test_connection_error(mocker):
@@ -59,6 +62,66 @@ def test_connection_error(mocker):
         resource._connect()
 
 
+def test_shared_connection(resource):
+    """
+    Test if all the operations share the same client and connection pool.
+    """
+    client = resource._connect()
+    assert client is resource._connect()
+    assert isinstance(resource._pool, RedisConnectionPool)
+
+
+def test_pool_parameters():
+    """
+    Test if connection pool parameters are used.
+    """
+    kwargs = dict(
+        hostname="localhost",
+        port="61324",
+        max_connections=4,
+        pool_timeout=2,
+        idle_timeout=5,
+        health_check_interval=10,
+    )
+    resource = RedisResource(**kwargs)
+    resource._connect()
+
+    pool = resource._pool
+    assert pool.max_connections == 4
+    assert pool.timeout == 2
+    assert pool.idle_timeout == 5
+    assert pool.connection_kwargs["health_check_interval"] == 10
+
+
+def test_pool_idle_timeout(mocker):
+    """
+    Test if idle connections are closed before being used again.
+    """
+    mocker.patch('redis.connection.Connection.connect')
+    mocker.patch('redis.connection.Connection.can_read', return_value=False)
+
+    pool = RedisConnectionPool(
+        host="localhost",
+        port=61324,
+        max_connections=1,
+        idle_timeout=5)
+
+    connection = pool.get_connection()
+    pool.release(connection)
+
+    mocker.spy(connection, "disconnect")
+
+    # recently used connection is kept
+    assert pool.get_connection() is connection
+    pool.release(connection)
+    connection.disconnect.assert_not_called()
+
+    # idle connection is closed
+    connection.cdist_last_used -= 10
+    assert pool.get_connection() is connection
+    connection.disconnect.assert_called_once()
+
+
 def test_push_args_error(resource):
     """
     Test push method arguments when they are not valid.
@@ -94,15 +157,17 @@ def test_push_error(request, mocker, resource):
     key = request.node.name
 
     if MOCKED:
-        mocker.patch('redis.Redis.hmset', side_effect=redis.RedisError())
-        mocker.patch('redis.Redis.set')
+        mocker.patch('redis.commands.core.Script.__call__',
+                     side_effect=redis.RedisError())
 
     with pytest.raises(ResourcePushError):
-        resource.push(key, dict())
+        resource.push(key, dict(test0="data0"))
 
     if MOCKED:
-        mocker.patch('redis.Redis.hmset')
-        mocker.patch('redis.Redis.set', side_effect=redis.RedisError())
+        redis.commands.core.Script.__call__.assert_called()
+
+    # empty configurations are refused
+    mocker.stopall()
 
     with pytest.raises(ResourcePushError):
         resource.push(key, dict())
@@ -121,42 +186,33 @@ def test_pull_error(request, mocker, resource):
     key = request.node.name
 
     if MOCKED:
-        mocker.patch('redis.Redis.hgetall', side_effect=redis.RedisError())
-        mocker.patch('redis.Redis.exists', return_value=True)
+        mocker.patch(
+            'redis.Redis.execute_command',
+            side_effect=redis.RedisError())
 
     with pytest.raises(ResourcePullError):
         resource.pull(key)
 
     if MOCKED:
-        redis.Redis.hgetall.assert_called_with(key)
-        redis.Redis.exists.assert_called()
+        redis.Redis.execute_command.assert_called_with(
+            "EVALSHA",
+            resource._scripts["resolve"].sha,
+            0,
+            *resource._resolve_script_args(key, "config"),
+            NEVER_DECODE=True)
 
 
-def test_pull_resource_not_exist_error(request, mocker, resource):
+def test_pull_resource_not_exist_error(request, resource):
     """
     Test pull method when it raises a ResourceNotExistError exception.
-
-    Hard to test the behaviour without exceptions inside Redis. This
-    test is expected to fail without mocking.
     """
-    if not MOCKED:
-        pytest.xfail("need mocking")
-
     key = request.node.name
 
-    if MOCKED:
-        mocker.patch('redis.Redis.hgetall')
-        mocker.patch('redis.Redis.exists', return_value=False)
-
     with pytest.raises(ResourceNotExistError):
         resource.pull(key)
 
-    if MOCKED:
-        redis.Redis.hgetall.assert_not_called()
-        redis.Redis.exists.assert_called()
-
 
-def test_push_and_pull(request, mocker, resource):
+def test_push_and_pull(request, resource):
     """
     Push and pull data, then check if worked fine.
     """
@@ -168,14 +224,6 @@ def test_push_and_pull(request, mocker, resource):
         test2="data2"
     )
 
-    if MOCKED:
-        mocker.patch('redis.Redis.hmset')
-        mocker.patch('redis.Redis.keys', return_value=[key])
-        mocker.patch('redis.Redis.get', return_value="")
-        mocker.patch('redis.Redis.set')
-        mocker.patch('redis.Redis.hgetall', return_value=data)
-        mocker.patch('redis.Redis.exists', return_value=True)
-
     # push data
     resource.push(key, data)
     assert key in resource.keys()
@@ -185,13 +233,6 @@ def test_push_and_pull(request, mocker, resource):
     data0 = resource.pull(key)
     assert data == data0
 
-    if MOCKED:
-        redis.Redis.hmset.assert_called_with(key, data)
-        redis.Redis.keys.assert_called()
-        redis.Redis.get.assert_called()
-        redis.Redis.hgetall.assert_called_with(key)
-        redis.Redis.exists.assert_called()
-
 
 def test_lock_args_error(resource):
     """
@@ -209,28 +250,16 @@ def test_unlock_args_error(resource):
         resource.unlock(None)
 
 
-def test_lock_resource_not_exist_error(request, mocker, resource):
+def test_lock_resource_not_exist_error(request, resource):
     """
     Test lock method when it raises a ResourceNotExistError exception.
-
-    Hard to test the behaviour without exceptions inside Redis. This
-    test is expected to fail without mocking.
     """
-    if not MOCKED:
-        pytest.xfail("need mocking")
-
     key = request.node.name
 
-    if MOCKED:
-        mocker.patch('redis.Redis.exists', return_value=False)
-        mocker.patch('redis.Redis.set')
-
     with pytest.raises(ResourceNotExistError):
         resource.lock(key)
 
-    if MOCKED:
-        redis.Redis.set.assert_not_called()
-        redis.Redis.exists.assert_called()
+    assert key not in resource.keys()
 
 
 def test_lock_error(request, mocker, resource):
@@ -245,40 +274,29 @@ def test_lock_error(request, mocker, resource):
 
     key = request.node.name
 
+    resource.push(key, dict(test0="data0"))
+
     if MOCKED:
-        mocker.patch('redis.Redis.exists', return_value=True)
-        mocker.patch('redis.Redis.set', side_effect=redis.RedisError())
+        mocker.patch('redis.commands.core.Script.__call__',
+                     side_effect=redis.RedisError())
 
     with pytest.raises(ResourceLockError):
         resource.lock(key)
 
     if MOCKED:
-        redis.Redis.set.assert_called()
-        redis.Redis.exists.assert_called()
+        redis.commands.core.Script.__call__.assert_called()
 
 
-def test_unlock_resource_not_exist_error(request, mocker, resource):
+def test_unlock_resource_not_exist_error(request, resource):
     """
     Test unlock method when it raises a ResourceNotExistError exception.
-
-    Hard to test the behaviour without exceptions inside Redis. This
-    test is expected to fail without mocking.
     """
-    if not MOCKED:
-        pytest.xfail("need mocking")
-
     key = request.node.name
 
-    if MOCKED:
-        mocker.patch('redis.Redis.exists', return_value=False)
-        mocker.patch('redis.Redis.set')
-
     with pytest.raises(ResourceNotExistError):
         resource.unlock(key)
 
-    if MOCKED:
-        redis.Redis.set.assert_not_called()
-        redis.Redis.exists.assert_called()
+    assert key not in resource.keys()
 
 
 def test_unlock_error(request, mocker, resource):
@@ -293,16 +311,17 @@ def test_unlock_error(request, mocker, resource):
 
     key = request.node.name
 
+    resource.push(key, dict(test0="data0"))
+
     if MOCKED:
-        mocker.patch('redis.Redis.exists', return_value=True)
-        mocker.patch('redis.Redis.set', side_effect=redis.RedisError())
+        mocker.patch('redis.commands.core.Script.__call__',
+                     side_effect=redis.RedisError())
 
     with pytest.raises(ResourceUnlockError):
         resource.unlock(key)
 
     if MOCKED:
-        redis.Redis.set.assert_called()
-        redis.Redis.exists.assert_called()
+        redis.commands.core.Script.__call__.assert_called()
 
 
 def test_is_locked_args_error(resource):
@@ -313,29 +332,15 @@ def test_is_locked_args_error(resource):
         resource.is_locked(None)
 
 
-def test_is_locked_resource_not_exist_error(request, mocker, resource):
+def test_is_locked_resource_not_exist_error(request, resource):
     """
     Test is_locked method when it raises a ResourceNotExistError exception.
-
-    Hard to test the behaviour without exceptions inside Redis. This
-    test is expected to fail without mocking.
     """
-    if not MOCKED:
-        pytest.xfail("need mocking")
-
     key = request.node.name
 
-    if MOCKED:
-        mocker.patch('redis.Redis.exists', return_value=False)
-        mocker.patch('redis.Redis.get')
-
     with pytest.raises(ResourceNotExistError):
         resource.is_locked(key)
 
-    if MOCKED:
-        redis.Redis.get.assert_not_called()
-        redis.Redis.exists.assert_called()
-
 
 def test_is_locked_error(request, mocker, resource):
     """
@@ -350,15 +355,14 @@ def test_is_locked_error(request, mocker, resource):
     key = request.node.name
 
     if MOCKED:
-        mocker.patch('redis.Redis.exists', return_value=True)
-        mocker.patch('redis.Redis.get', side_effect=redis.RedisError())
+        mocker.patch('redis.client.Pipeline.execute',
+                     side_effect=redis.RedisError())
 
     with pytest.raises(ResourceError):
         resource.is_locked(key)
 
     if MOCKED:
-        redis.Redis.get.assert_called()
-        redis.Redis.exists.assert_called()
+        redis.client.Pipeline.execute.assert_called()
 
 
 def test_keys_error(request, mocker, resource):
@@ -372,16 +376,16 @@ def test_keys_error(request, mocker, resource):
         pytest.xfail("need mocking")
 
     if MOCKED:
-        mocker.patch('redis.Redis.keys', side_effect=redis.RedisError())
+        mocker.patch('redis.Redis.scan_iter', side_effect=redis.RedisError())
 
     with pytest.raises(ResourceConnectionError):
         resource.keys()
 
     if MOCKED:
-        redis.Redis.keys.assert_called()
+        redis.Redis.scan_iter.assert_called()
 
 
-def test_lock_and_unlock(request, mocker, resource):
+def test_lock_and_unlock(request, resource):
     """
     Lock and unlock a key, then check if worked fine.
     """
@@ -393,28 +397,14 @@ def test_lock_and_unlock(request, mocker, resource):
         test2="data2"
     )
 
-    if MOCKED:
-        mocker.patch('redis.Redis.get', return_value="1")
-        mocker.patch('redis.Redis.set')
-        mocker.patch('redis.Redis.hmset')
-        mocker.patch('redis.Redis.exists', return_value=True)
-
     # lock data
     resource.push(key, data)
     resource.lock(key)
-    assert resource.is_locked(key)  # useless without a real case
-
-    if MOCKED:
-        mocker.patch('redis.Redis.get', return_value="")
+    assert resource.is_locked(key)
 
     # unlock data
     resource.unlock(key)
-    assert not resource.is_locked(key)  # useless without a real case
-
-    if MOCKED:
-        redis.Redis.set.assert_called_with(key + ".lock", "")
-        redis.Redis.get.assert_called_with(key + ".lock")
-        redis.Redis.exists.assert_called()
+    assert not resource.is_locked(key)
 
 
 def test_delete_args_error(resource):
@@ -425,28 +415,20 @@ def test_delete_args_error(resource):
         resource.delete(None)
 
 
-def test_delete_resource_not_exist_error(request, mocker, resource):
+def test_delete_resource_not_exist_error(request, resource):
     """
     Test delete method when it raises a ResourceNotExistError exception.
-
-    Hard to test the behaviour without exceptions inside Redis. This
-    test is expected to fail without mocking.
     """
-    if not MOCKED:
-        pytest.xfail("need mocking")
-
     key = request.node.name
 
-    if MOCKED:
-        mocker.patch('redis.Redis.delete')
-        mocker.patch('redis.Redis.exists', return_value=False)
+    client = resource._connect()
+    events = client.xlen(resource._events_name())
 
     with pytest.raises(ResourceNotExistError):
         resource.delete(key)
 
-    if MOCKED:
-        redis.Redis.delete.assert_not_called()
-        redis.Redis.exists.assert_called()
+    # nothing has been deleted, so nothing is notified
+    assert client.xlen(resource._events_name()) == events
 
 
 def test_delete_error(request, mocker, resource):
@@ -462,18 +444,17 @@ def test_delete_error(request, mocker, resource):
     key = request.node.name
 
     if MOCKED:
-        mocker.patch('redis.Redis.delete', side_effect=redis.RedisError())
-        mocker.patch('redis.Redis.exists', return_value=True)
+        mocker.patch('redis.commands.core.Script.__call__',
+                     side_effect=redis.RedisError())
 
     with pytest.raises(ResourceDeleteError):
         resource.delete(key)
 
     if MOCKED:
-        redis.Redis.delete.assert_called()
-        redis.Redis.exists.assert_called()
+        redis.commands.core.Script.__call__.assert_called()
 
 
-def test_push_and_delete(request, mocker, resource):
+def test_push_and_delete(request, resource):
     """
     Push a configuration and then it deletes it.
     """
@@ -485,28 +466,909 @@ def test_push_and_delete(request, mocker, resource):
         test2="data2"
     )
 
-    if MOCKED:
-        mocker.patch('redis.Redis.hmset')
-        mocker.patch('redis.Redis.keys', return_value=[key])
-        mocker.patch('redis.Redis.set')
-        mocker.patch('redis.Redis.delete')
-        mocker.patch('redis.Redis.exists', return_value=True)
-
     # push data
     resource.push(key, data)
     assert key in resource.keys()
 
     # delete data
     resource.delete(key)
+    assert key not in resource.keys()
+
+    with pytest.raises(ResourceNotExistError):
+        resource.is_locked(key)
+
+
+def _warm_up(resource, key):
+    """
+    Open the pooled connection and load the scripts on the server, so only
+    the operations round trips are counted.
+    """
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+    resource.unlock(key)
+
+
+@pytest.mark.parametrize("operation", [
+    "push",
+    "pull",
+    "version",
+    "lock",
+    "unlock",
+    "is_locked",
+    "delete",
+])
+def test_single_roundtrip(request, resource, roundtrips, operation):
+    """
+    Test if every operation is done with a single round trip.
+    """
+    if not MOCKED:
+        pytest.skip("round trips are counted on the stand-in server")
+
+    key = request.node.name
+    _warm_up(resource, key)
+    roundtrips.reset_mock()
+
+    if operation == "push":
+        resource.push(key, dict(test0="data1", test1="data2"))
+    else:
+        getattr(resource, operation)(key)
+
+    assert roundtrips.call_count == 1
+
+
+def test_push_keeps_lock(request, resource):
+    """
+    Test if push doesn't unlock a configuration which is in use.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+    assert resource.is_locked(key)
+
+    resource.push(key, dict(test0="data1"))
+    assert resource.is_locked(key)
+    assert resource.pull(key) == dict(test0="data1")
+
+
+def test_push_incremental(request, resource, roundtrips):
+    """
+    Test if push skips unchanged configurations and writes only the changed
+    options.
+    """
+    key = request.node.name
+    config = dict(test0="data0", test1="data1", test2="data2")
+
+    assert resource.push(key, config)
+    version = resource.version(key)
+
+    # options order doesn't matter
+    roundtrips.reset_mock()
+    assert not resource.push(key, dict(reversed(list(config.items()))))
+    assert resource.version(key) == version
+    if MOCKED:
+        assert roundtrips.call_count == 2
+
+    changed = dict(test0="data0", test2="new", test3="data3")
+    assert resource.push(key, changed)
+    assert resource.pull(key) == changed
+    assert resource.version(key) != version
+
+    # same content has the same version
+    assert resource.push(key, config)
+    assert resource.pull(key) == config
+    assert resource.version(key) == version
+
+
+def test_delete_removes_lock(request, resource):
+    """
+    Test if delete removes the lock in the same transaction.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+    resource.delete(key)
+
+    client = resource._connect()
+    assert not client.exists(resource._config_name(key))
+    assert not client.exists(resource._lock_name(key))
+
+
+def test_version(request, resource):
+    """
+    Test if every push of a changed configuration stamps a new version.
+    """
+    key = request.node.name
+
+    with pytest.raises(ValueError):
+        resource.version("")
+
+    with pytest.raises(ResourceNotExistError):
+        resource.version(key)
+
+    resource.push(key, dict(test0="data0"))
+    version = resource.version(key)
+    assert version
+    assert resource.version(key) == version
+
+    resource.lock(key)
+    resource.unlock(key)
+    assert resource.version(key) == version
+
+    resource.push(key, dict(test0="data1"))
+    assert resource.version(key) != version
+
+    resource.delete(key)
+    client = resource._connect()
+    assert not client.exists(resource._version_name(key))
+
+
+def test_push_many_and_pull_many(request, address, roundtrips):
+    """
+    Test if many configurations are pushed and pulled in batches, reporting
+    failing configurations without stopping the others.
+    """
+    key = request.node.name
+    resource = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        batch_size=3)
+
+    items = [("%s-%d" % (key, i), dict(test0="data%d" % i)) for i in range(5)]
+    items.insert(1, ("", dict(test0="data0")))
+    items.insert(2, (key + "-empty", dict()))
+
+    # open the pooled connection
+    resource.pull_many([key + "-missing"])
+
+    roundtrips.reset_mock()
+    errors = resource.push_many(iter(items))
+    assert set(errors) == {"", key + "-empty"}
+    assert isinstance(errors[""], ValueError)
+    assert isinstance(errors[key + "-empty"], ResourcePushError)
+
+    names = ["%s-%d" % (key, i) for i in range(5)]
+    configs = resource.pull_many(names + [key + "-missing"])
+    assert configs == dict(
+        [(name, config) for name, config in items if name in names],
+        **{key + "-missing": None})
 
     if MOCKED:
-        mocker.patch('redis.Redis.keys', return_value=[])
+        # batches of 3 items: 3 for push_many and 2 for pull_many
+        assert roundtrips.call_count == 5
+
+    with pytest.raises(ValueError):
+        resource.pull_many([""])
+
+    resource.close()
+
+
+def test_iter_keys(request, address, resource):
+    """
+    Test if keys are fetched incrementally, within the cdist namespace only.
+    """
+    key = request.node.name
+
+    other = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        namespace="other*")
+
+    for i in range(10):
+        resource.push("%s%d" % (key, i), dict(test0="data0"))
+
+    other.push(key, dict(test0="data0"))
+    resource._connect().set("%s_foreign" % key, "data")
+
+    keys = resource.iter_keys(count=3)
+    assert not isinstance(keys, list)
+
+    keys = [item for item in keys if item.startswith(key)]
+    assert sorted(keys) == sorted("%s%d" % (key, i) for i in range(10))
+    assert other.keys() == [key]
+
+    other.delete(key)
+    other.close()
+
+
+def test_status_many(request, resource, roundtrips):
+    """
+    Test if status of many configurations is fetched with one round trip
+    per batch.
+    """
+    key = request.node.name
+
+    resource._batch_size = 4
+    keys = ["%s%d" % (key, i) for i in range(10)]
+    for item in keys[:8]:
+        resource.push(item, dict(test0="data0"))
+
+    resource.lock(keys[0])
+
+    roundtrips.reset_mock()
+    statuses = resource.status_many(keys)
+
+    if MOCKED:
+        assert roundtrips.call_count == 3
+
+    assert statuses[keys[0]] == ConfigStatus(True, True, resource.owner)
+    for item in keys[1:8]:
+        assert statuses[item] == ConfigStatus(True, False, None)
+    for item in keys[8:]:
+        assert statuses[item] == ConfigStatus(False, False, None)
+
+
+@pytest.fixture
+def other(address):
+    """
+    Another client of the same Redis server, owning different locks.
+    """
+    resource = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        owner="other")
+    yield resource
+    resource.close()
+
+
+def test_lock_owner(request, resource, other):
+    """
+    Test if a lock can be released by its owner only.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+
+    # lock is already owned by resource
+    with pytest.raises(ResourceLockError):
+        other.lock(key)
+
+    with pytest.raises(ResourceUnlockError):
+        other.unlock(key)
+
+    assert resource.is_locked(key)
+
+    # owner can lock again
+    resource.lock(key)
+    resource.unlock(key)
+    assert not resource.is_locked(key)
+
+    # lock owned by others can be forced
+    other.lock(key)
+    resource.unlock(key, force=True)
+    assert not other.is_locked(key)
+
+
+def test_lock_ttl(request, address, other):
+    """
+    Test if lock expires when it's not renewed.
+    """
+    key = request.node.name
+
+    resource = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        lock_ttl=0.3)
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+
+    # lease is extended
+    for _ in range(3):
+        time.sleep(0.15)
+        resource.renew(key)
+        assert resource.is_locked(key)
+
+    # lease expires
+    time.sleep(0.5)
+    assert not resource.is_locked(key)
+
+    with pytest.raises(ResourceLockError):
+        resource.renew(key)
+
+    other.lock(key)
+    resource.close()
+
+
+def test_lock_race(request, address, resource):
+    """
+    Test if only one of many clients racing on the same lock acquires it.
+    """
+    key = request.node.name
+    resource.push(key, dict(test0="data0"))
+
+    clients = [
+        RedisResource(hostname=address[0], port=address[1])
+        for _ in range(8)
+    ]
+    barrier = threading.Barrier(len(clients))
+    owners = []
+
+    def _lock(client):
+        barrier.wait()
+        try:
+            client.lock(key)
+            owners.append(client.owner)
+        except ResourceLockError:
+            pass
+
+    threads = [
+        threading.Thread(target=_lock, args=(client,))
+        for client in clients
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(owners) == 1
+    assert resource.status_many([key])[key].owner == owners[0]
+
+    for client in clients:
+        client.close()
+
+
+def _waiter(resource, key, timeout, results):
+    """
+    Start a thread waiting for a lock.
+    """
+    def _lock():
+        try:
+            resource.lock(key, timeout=timeout, blocking=True)
+            results.append((resource.owner, time.monotonic()))
+        except ResourceLockError as err:
+            results.append((resource.owner, err))
+
+    thread = threading.Thread(target=_lock)
+    thread.start()
+    return thread
+
+
+def test_lock_blocking(request, resource, other):
+    """
+    Test if a waiter is woken up as soon as lock is released.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+
+    results = []
+    thread = _waiter(other, key, 5, results)
+
+    time.sleep(0.2)
+    assert not results
+
+    released = time.monotonic()
+    resource.unlock(key)
+    thread.join()
+
+    owner, acquired = results[0]
+    assert owner == "other"
+    assert acquired - released < 0.5
+    assert other.status_many([key])[key].owner == "other"
+
+    other.unlock(key)
+
+
+def test_lock_blocking_timeout(request, resource, other):
+    """
+    Test if a waiter stops waiting after timeout.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+
+    start = time.monotonic()
+    with pytest.raises(ResourceLockError):
+        other.lock(key, timeout=0.3, blocking=True)
+
+    assert time.monotonic() - start < 1
+
+    # waiter is not queued anymore
+    resource.unlock(key)
+    assert not resource.is_locked(key)
+
+    client = resource._connect()
+    assert not client.exists(resource._queue_name(key))
+
+
+def test_lock_blocking_stale_wake(request, resource, other):
+    """
+    Test if a hand over which has not been consumed doesn't acquire the
+    lock during the next wait of the same owner.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+
+    # lock acquired by the waiter before it read its wake list
+    client = resource._connect()
+    client.rpush(other._wake_prefix(key) + other.owner, "1")
+    other.lock(key)
+    assert not client.exists(other._wake_prefix(key) + other.owner)
+    other.unlock(key)
+
+    resource.lock(key)
+    with pytest.raises(ResourceLockError):
+        other.lock(key, timeout=0.3, blocking=True)
+
+    assert resource.status_many([key])[key].owner == resource.owner
+    resource.unlock(key)
+
+
+def test_lock_blocking_fifo(request, address, resource):
+    """
+    Test if waiters acquire the lock in arrival order.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+
+    waiters = [
+        RedisResource(
+            hostname=address[0],
+            port=address[1],
+            owner="waiter%d" % i)
+        for i in range(4)
+    ]
+
+    results = []
+    threads = []
+    for waiter in waiters:
+        threads.append(_waiter(waiter, key, 10, results))
+        time.sleep(0.1)
+
+    # release the lock to the next waiter, one by one
+    resource.unlock(key)
+    for i, waiter in enumerate(waiters):
+        threads[i].join()
+        assert results[i][0] == waiter.owner
+        waiter.unlock(key)
+
+    assert not resource.is_locked(key)
+
+    for waiter in waiters:
+        waiter.close()
+
+
+def test_lock_blocking_expired(request, address, other):
+    """
+    Test if a waiter acquires a lock which expired without being released.
+    """
+    key = request.node.name
+
+    resource = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        lock_ttl=0.2)
+
+    resource.push(key, dict(test0="data0"))
+    resource.lock(key)
+
+    other.lock(key, timeout=5, blocking=True)
+    assert other.status_many([key])[key].owner == "other"
+
+    other.unlock(key)
+    resource.close()
+
+
+def test_lock_any(request, address, resource, other, roundtrips):
+    """
+    Test if the first free configuration of a group is locked with an
+    incremental scan of the group and a single script call.
+    """
+    key = request.node.name
+
+    for i in range(3):
+        resource.push("%s-%02d" % (key, i), dict(test0="data0"))
+
+    other.lock("%s-00" % key)
+
+    roundtrips.reset_mock()
+    assert resource.lock_any("%s-*" % key) == "%s-01" % key
+    if MOCKED:
+        assert roundtrips.call_count == 2
+
+    assert resource.lock_any("%s-*" % key) == "%s-01" % key
+    other.unlock("%s-00" % key)
+    assert other.lock_any("%s-*" % key) == "%s-00" % key
+    assert other.lock_any("%s-*" % key) == "%s-00" % key
+
+    other.unlock("%s-00" % key)
+    other.lock("%s-02" % key)
+    assert resource.lock_any("%s-0[02]" % key) == "%s-00" % key
+
+    # all configurations are locked by others
+    third = RedisResource(hostname=address[0], port=address[1])
+    with pytest.raises(ResourceLockError):
+        third.lock_any("%s-*" % key)
+
+    with pytest.raises(ResourceNotExistError):
+        third.lock_any("%s-missing*" % key)
+
+    third.close()
+
+
+def test_lock_any_batches(request, address, resource, other):
+    """
+    Test if groups larger than a batch are locked in name order.
+    """
+    key = request.node.name
+    batched = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        batch_size=2)
+
+    for i in range(5):
+        resource.push("%s-%02d" % (key, i), dict(test0="data0"))
+
+    for i in range(3):
+        other.lock("%s-%02d" % (key, i))
+
+    assert batched.lock_any("%s-*" % key) == "%s-03" % key
+    assert batched.lock_any("%s-*" % key) == "%s-03" % key
+
+    other.unlock("%s-01" % key)
+    assert other.lock_any("%s-*" % key) == "%s-00" % key
+    assert batched.lock_any("%s-*" % key) == "%s-01" % key
+
+    batched.close()
+
+
+def test_lock_any_tags(request, resource, other):
+    """
+    Test if the first free configuration having all the tags is locked.
+    """
+    key = request.node.name
+
+    resource.push("%s-00" % key, dict(test0="data0", cdist_tags="x86"))
+    resource.push("%s-01" % key, dict(test0="data0", cdist_tags="arm, lab"))
+    resource.push("%s-02" % key, dict(test0="data0", cdist_tags="arm,lab,fast"))
+
+    pattern = "%s-*" % key
+    assert resource.lock_any(pattern, ["arm", "lab"]) == "%s-01" % key
+    assert other.lock_any(pattern, ["lab", "arm"]) == "%s-02" % key
+    assert other.lock_any(pattern, ["x86"]) == "%s-00" % key
+
+    with pytest.raises(ResourceLockError):
+        resource.lock_any(pattern, ["arm", "fast"])
+
+    with pytest.raises(ResourceNotExistError):
+        other.lock_any(pattern, ["mips"])
+
+
+def test_lock_any_blocking(request, resource, other):
+    """
+    Test if a group waiter acquires the first released configuration.
+    """
+    key = request.node.name
+
+    for i in range(2):
+        resource.push("%s-%02d" % (key, i), dict(test0="data0"))
+        resource.lock("%s-%02d" % (key, i))
+
+    with pytest.raises(ResourceLockError):
+        other.lock_any("%s-*" % key, timeout=0.2, blocking=True)
+
+    def _unlock():
+        time.sleep(0.2)
+        resource.unlock("%s-01" % key)
+
+    thread = threading.Thread(target=_unlock)
+    thread.start()
+    name = other.lock_any("%s-*" % key, timeout=5, blocking=True)
+    thread.join()
+
+    assert name == "%s-01" % key
+
+
+def test_lock_stats(request, address, resource, other):
+    """
+    Test if lock acquisitions, hold and wait times and stale locks are
+    counted by the lock scripts.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    assert key not in resource.lock_stats()
+
+    # lock held for a while, then handed over to a waiter
+    resource.lock(key)
+    results = []
+    thread = _waiter(other, key, 5, results)
+    time.sleep(0.2)
+    resource.unlock(key)
+    thread.join()
+
+    # lock broken by another owner
+    resource.unlock(key, force=True)
+
+    # lock expired without being released
+    expiring = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        lock_ttl=0.1)
+    expiring.lock(key)
+    time.sleep(0.2)
+    resource.lock(key)
+
+    # locking again doesn't count as a new acquisition
+    resource.lock(key)
+    resource.unlock(key)
+    expiring.close()
+
+    stats = resource.lock_stats()[key]
+    assert stats.acquired == 4
+    assert stats.stale == 2
+
+    # the waiter waited for the first lock to be released
+    assert stats.wait[float("inf")] == 4
+    assert stats.wait[0.1] == 3
+    assert 0.1 < stats.wait_sum < 1
+
+    # first lock has been held while the waiter was waiting
+    assert stats.hold[float("inf")] == 3
+    assert stats.hold[1.0] == 3
+    assert 0.1 < stats.hold_sum < 1
 
-    assert key not in resource.keys()
 
+def test_locks(request, address, resource):
+    """
+    Test if lock records carry their owner metadata and if stale locks can
+    be broken.
+    """
+    key = request.node.name
+    stale_key = key + "-stale"
+
+    owner = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        owner="owner",
+        session="job-1",
+        lock_ttl=60)
+    expiring = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        owner="expiring",
+        lock_ttl=0.1)
+
+    resource.push(key, dict(test0="data0"))
+    resource.push(stale_key, dict(test0="data0"))
+
+    started = time.time()
+    owner.lock(key)
+    expiring.lock(stale_key)
+    time.sleep(0.2)
+
+    locks = resource.locks()
+    info = locks[key]
+    assert info.owner == "owner"
+    assert info.host == socket.gethostname()
+    assert info.pid == os.getpid()
+    assert info.session == "job-1"
+    assert started - 1 < info.acquired < time.time() + 1
+    assert info.expires - info.acquired == pytest.approx(60, abs=0.01)
+    assert not info.stale
+
+    # expired lock is free, but its record is kept
+    info = locks[stale_key]
+    assert info.owner == "expiring"
+    assert info.session is None
+    assert info.stale
+    assert not resource.is_locked(stale_key)
+
+    # only stale locks are broken
+    broken = resource.break_stale()
+    assert stale_key in broken
+    assert key not in broken
+
+    locks = resource.locks()
+    assert key in locks
+    assert stale_key not in locks
+    assert stale_key not in resource.break_stale()
+
+    owner.unlock(key)
+    assert key not in resource.locks()
+
+    owner.close()
+    expiring.close()
+
+
+def test_subscribe(request, address, resource):
+    """
+    Test if changes of configurations and locks are published.
+    """
+    key = request.node.name
+    events = list()
+
+    owner = RedisResource(hostname=address[0], port=address[1], lock_ttl=60)
+    subscription = resource.subscribe(
+        lambda *event: events.append(event) if event[1] == key else None)
+
+    try:
+        owner.push(key, dict(test0="data0"))
+        owner.push(key, dict(test0="data0"))
+        owner.lock(key)
+        owner.renew(key)
+        owner.unlock(key)
+        owner.delete(key)
+
+        deadline = time.monotonic() + 5
+        while len(events) < 5:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        subscription.close()
+        owner.close()
+
+    assert [event[0] for event in events] == [
+        "push", "lock", "renew", "unlock", "delete"]
+    assert events[1][2] == pytest.approx(time.time() + 60, abs=5)
+    assert events[2][2] == pytest.approx(time.time() + 60, abs=5)
+    assert events[0][2] is None
+
+
+def test_watch(request, resource):
+    """
+    Test if changes are watched and if watching can be resumed after the
+    last received event.
+    """
+    key = request.node.name
+
+    resource.push(key, dict(test0="data0"))
+    resource.push(key + "-other", dict(test0="data0"))
+
+    events = [event for event in resource.watch(
+        pattern=key, since="0-0", timeout=0.5) if event.kind != "reset"]
+    assert [(event.kind, event.name) for event in events] == [
+        ("push", key)]
+
+    # renewals are not kept inside the stream
+    resource.lock(key)
+    resource.renew(key)
+    resource.unlock(key)
+
+    resumed = list(resource.watch(
+        pattern=key, since=events[-1].id, timeout=0.5))
+    assert [event.kind for event in resumed] == ["lock", "unlock"]
+    assert resumed[0].id > events[-1].id
+
+    # new events are received as soon as they happen
+    timer = threading.Timer(0.2, resource.delete, args=(key,))
+    timer.start()
+    started = time.monotonic()
+    for event in resource.watch(pattern=key, timeout=5):
+        assert event.kind == "delete"
+        break
+    timer.join()
+
+    assert time.monotonic() - started < 2
+
+    resource.delete(key + "-other")
+
+
+def test_push_blob(request, address, resource):
+    """
+    Test if large configurations are stored as a compressed blob, which
+    is readable together with the configurations stored as hash fields.
+    """
+    key = request.node.name
+    blob = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        blob_threshold=100)
+
+    small = dict(test0="data0")
+    large = dict(addopts="-v " * 1000, cdist_tags="blob", testpaths=1)
+
+    assert blob.push(key, small)
+    assert blob.push(key + "-large", large)
+
+    client = resource._connect()
+    assert set(client.hkeys(resource._config_name(key))) == {"test0"}
+    assert set(client.hkeys(resource._config_name(key + "-large"))) == {
+        ":blob", "cdist_tags"}
+    assert client.hstrlen(resource._config_name(key + "-large"), ":blob") \
+        < 200
+
+    large["testpaths"] = "1"
+    assert resource.pull(key) == small
+    assert resource.pull(key + "-large") == large
+    assert resource.pull_many([key, key + "-large"]) == {
+        key: small, key + "-large": large}
+    assert not blob.push(key + "-large", large)
+
+    # tags are readable without decoding the blob
+    assert resource.lock_any(key + "*", tags=["blob"]) == key + "-large"
+    resource.unlock(key + "-large")
+
+    # blob is converted back to hash fields by older clients
+    resource.push(key + "-large", dict(test0="data0"))
+    assert set(client.hkeys(resource._config_name(key + "-large"))) == {
+        "test0"}
+
+    resource.delete(key)
+    resource.delete(key + "-large")
+    blob.close()
+
+
+def test_extends(request, address, resource, roundtrips):
+    """
+    Test if inherited configurations, stored as hash fields or as blobs,
+    are merged by pull with a single round trip.
+    """
+    key = request.node.name
+    blob = RedisResource(
+        hostname=address[0],
+        port=address[1],
+        blob_threshold=0)
+
+    resource.push(key + "-base", dict(
+        test0="base", test1="base", cdist_tags="base"))
+    blob.push(key + "-lab", dict(test1="lab", test2="lab"))
+    blob.push(key, dict(
+        test2="rig", cdist_extends="%s-base,%s-lab" % (key, key)))
+
+    merged = dict(
+        test0="base",
+        test1="lab",
+        test2="rig",
+        cdist_extends="%s-base,%s-lab" % (key, key))
+
+    version = resource.version(key)
+    roundtrips.reset_mock()
+    assert resource.pull(key) == merged
     if MOCKED:
-        redis.Redis.hmset.assert_called_with(key, data)
-        redis.Redis.keys.assert_called()
-        redis.Redis.set.assert_called()
-        redis.Redis.delete.assert_called()
-        redis.Redis.exists.assert_called()
+        assert roundtrips.call_count == 1
+
+    assert resource.pull_many([key, key + "-none"]) == {
+        key: merged, key + "-none": None}
+    assert resource.pull(key, resolve=False) == dict(
+        test2="rig", cdist_extends="%s-base,%s-lab" % (key, key))
+
+    # pushing a parent changes the merged configuration and its version
+    resource.push(key + "-base", dict(test0="changed"))
+    assert resource.pull(key)["test0"] == "changed"
+    assert resource.version(key) != version
+
+    resource.delete(key + "-lab")
+    with pytest.raises(ResourceInheritanceError):
+        resource.pull(key)
+
+    # broken configurations don't stop the others from being pulled
+    with pytest.raises(ResourceInheritanceError):
+        resource.pull_many([key, key + "-base"])
+
+    errors = dict()
+    assert resource.pull_many([key, key + "-base"], errors=errors) == {
+        key: None, key + "-base": dict(test0="changed")}
+    assert list(errors) == [key]
+    assert isinstance(errors[key], ResourceInheritanceError)
+
+    resource.push(key + "-lab", dict(cdist_extends=key))
+    with pytest.raises(ResourceInheritanceError):
+        resource.pull(key)
+
+    for name in (key, key + "-base", key + "-lab"):
+        resource.delete(name)
+    blob.close()
+
+
+def test_pull_blob_error(request, resource):
+    """
+    Test if corrupted blobs can't be pulled.
+    """
+    key = request.node.name
+
+    client = resource._connect()
+    client.hset(resource._config_name(key), ":blob", "corrupted")
+
+    with pytest.raises(ResourcePullError):
+        resource.pull(key)
+
+    resource.delete(key)